@@ -0,0 +1,70 @@
+"""Compare CSRF token extraction with html5lib and the streaming scanner.
+
+Usage: python benchmarks/csrf.py [page.html ...]
+
+Without arguments a synthetic admin page is used. Captured admin pages can
+be passed to measure real-world pages.
+"""
+
+import sys
+import time
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+
+from inzetbooster.inzetrooster import get_csrf
+
+ROWS = "\n".join(
+    f'<tr><td><a href="/org/admin/people/{i}">Person {i}</a></td>'
+    f"<td>person{i}@example.com</td><td>{i % 28 + 1}-03-2024</td></tr>"
+    for i in range(500)
+)
+
+SYNTHETIC_PAGE = f"""<!DOCTYPE html>
+<html lang="nl">
+<head>
+  <meta charset="utf-8">
+  <title>Inzetrooster</title>
+  <meta name="csrf-param" content="authenticity_token">
+  <meta name="csrf-token" content="c2VjcmV0LXRva2Vu">
+  <link rel="stylesheet" href="/assets/application.css">
+  <script src="/assets/application.js"></script>
+</head>
+<body>
+  <nav><ul>{"".join(f"<li><a href='/org/{i}'>Item {i}</a></li>" for i in range(40))}</ul></nav>
+  <form action="/org/admin/people/export" method="post">
+    <input type="hidden" name="authenticity_token" value="c2VjcmV0LXRva2Vu">
+    <table>{ROWS}</table>
+  </form>
+</body>
+</html>
+"""
+
+
+def get_csrf_html5lib(html: str) -> str:
+    return get_csrf(soup=BeautifulSoup(html, "html5lib"))
+
+
+def measure(label: str, html: str, func, count: int) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        func(html)
+    elapsed = (time.perf_counter() - start) / count
+    print(f"  {label:<10} {elapsed * 1000:8.3f} ms")
+    return elapsed
+
+
+def main(paths: list[str]) -> None:
+    pages = {path: Path(path).read_text() for path in paths} or {
+        "synthetic admin page": SYNTHETIC_PAGE
+    }
+    for name, html in pages.items():
+        assert get_csrf(html=html) == get_csrf_html5lib(html)
+        print(f"{name} ({len(html)} bytes)")
+        slow = measure("html5lib", html, get_csrf_html5lib, 20)
+        fast = measure("scanner", html, lambda html: get_csrf(html=html), 200)
+        print(f"  speedup    {slow / fast:8.1f}x")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
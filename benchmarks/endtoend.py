@@ -0,0 +1,272 @@
+"""Run the inzetbooster commands against local inzetrooster and SMTP stand-ins.
+
+Usage: python benchmarks/endtoend.py [--shifts N] [--users N] [--json PATH]
+
+The fake inzetrooster server from the tests implements the login, export
+and import pages with generated CSV exports, and an SMTP sink accepts and
+counts all mail.
+Every command runs in its own process, the way it runs in production, and
+is measured for wall time, HTTP requests, mails per second and peak memory.
+Use --json to store the results for comparison between versions.
+"""
+
+import argparse
+import csv
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+
+from aiosmtpd.controller import Controller
+from openpyxl import Workbook
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "tests"))
+
+from fakeinzetrooster import (  # noqa: E402
+    FakeInzetrooster,
+    RecordingHandler,
+    free_port,
+    serving,
+)
+
+ORGANISATION = "bench"
+USERNAME = "admin"
+PASSWORD = "secret"
+
+SHIFT_HEADER = [
+    "Dienst_id",
+    "Groep_id",
+    "Groep_naam",
+    "Datum",
+    "Dag",
+    "Starttijd",
+    "Eindtijd",
+    "Tijdsduur",
+    "Gebruiker_id",
+    "Naam",
+    "Email",
+    "Telefoon",
+    "Locatie_id",
+    "Locatie_naam",
+    "Afwezig",
+    "Geannuleerd",
+    "Starred",
+    "Opmerkingen",
+]
+GROUPS = [(10736, "Bar"), (11703, "Schoonmaak"), (12079, "Bar met ervaring")]
+USER_HEADER = [
+    "Gebruiker_id",
+    "Voornaam",
+    "Tussen",
+    "Achternaam",
+    "Email",
+    "Gebruikersnaam",
+    "Vrijgesteld",
+    "Actief_datum",
+    "Inactief_datum",
+    "Rol_en_rechten",
+    "Laatste_login",
+]
+MANEGEPLAN_HEADER = ["Roepnaam", "Tussenvoegsels", "Achternaam", "E_Mail", "Persoon_ID"]
+
+
+def generate_shifts(rows: int) -> bytes:
+    """Shifts in the default export window, of which 60% are covered."""
+    output = io.StringIO(newline="")
+    writer = csv.writer(output, dialect=csv.unix_dialect)
+    writer.writerow(SHIFT_HEADER)
+    today = datetime.date.today()
+    for i in range(rows):
+        group_id, group_name = GROUPS[i % len(GROUPS)]
+        covered = i % 5 < 3
+        writer.writerow(
+            [
+                str(2_000_000 + i),
+                str(group_id),
+                group_name,
+                (today + datetime.timedelta(days=i % 300)).strftime("%d-%m-%Y"),
+                " Zaterdag",
+                f"{8 + i % 12:02d}:00",
+                "22:00",
+                "02:00",
+                f"PRS{i}" if covered else "",
+                f"Volunteer {i}" if covered else "",
+                f"volunteer{i}@example.com" if covered else "",
+                "",
+                "",
+                "",
+                "",
+                "",
+                "",
+                "",
+            ]
+        )
+    return output.getvalue().encode("utf-8")
+
+
+def generate_users(rows: int) -> bytes:
+    output = io.StringIO(newline="")
+    writer = csv.writer(output, dialect=csv.unix_dialect)
+    writer.writerow(USER_HEADER)
+    for i in range(rows):
+        writer.writerow(
+            [
+                f"PRS{i}",
+                f"Member {i}",
+                "",
+                "Rider",
+                f"m{i}@example.com",
+                "",
+                "false",
+                "01-01-2024",
+                "",
+                "Vrijwilliger",
+                "",
+            ]
+        )
+    return output.getvalue().encode("utf-8")
+
+
+def generate_manegeplan(path: Path, rows: int) -> None:
+    """A Manegeplan export where 10% of the members changed their address."""
+    wb = Workbook(write_only=True)
+    sheet = wb.create_sheet()
+    sheet.append(MANEGEPLAN_HEADER)
+    for i in range(rows):
+        email = f"new{i}@example.com" if i % 10 == 0 else f"m{i}@example.com"
+        sheet.append([f"Member {i}", None, "Rider", email, f"PRS{i}"])
+    wb.save(path)
+
+
+@dataclass
+class Result:
+    command: str
+    seconds: float
+    requests: int
+    mails: int
+    mails_per_second: float
+    peak_rss_mb: float
+
+
+def run_command(
+    name: str,
+    args: list[str],
+    server: FakeInzetrooster,
+    sink: RecordingHandler,
+    workdir: Path,
+) -> Result:
+    """Run an inzetbooster command in a new process and measure it."""
+    env = {
+        **os.environ,
+        "ORGANIZATION": ORGANISATION,
+        "USERNAME": USERNAME,
+        "PASSWORD": PASSWORD,
+        "INZETROOSTER_URL": server.base_url,
+        "AUDITLOG": str(workdir / "audit.db"),
+        "SESSION_FILE": str(workdir / "sessions.json"),
+        "TEMPLATE_CACHE": str(workdir / "templates"),
+    }
+    server.request_count()
+    sink.messages.clear()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "inzetbooster.cli", *args],
+        env=env,
+        cwd=workdir,
+        stdout=subprocess.DEVNULL,
+    )
+    _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - started
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode:
+        raise SystemExit(f"{name} failed with exit code {process.returncode}")
+    return Result(
+        command=name,
+        seconds=round(seconds, 3),
+        requests=server.request_count(),
+        mails=len(sink.messages),
+        mails_per_second=round(len(sink.messages) / seconds, 1),
+        peak_rss_mb=round(usage.ru_maxrss / 1024, 1),
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--shifts", type=int, default=2_000)
+    parser.add_argument("--users", type=int, default=2_000)
+    parser.add_argument("--smtp-connections", type=int, default=4)
+    parser.add_argument("--json", type=Path, help="Write the results to this file")
+    options = parser.parse_args()
+
+    server = FakeInzetrooster(
+        generate_shifts(options.shifts),
+        generate_users(options.users),
+        groups=GROUPS,
+        organisation=ORGANISATION,
+        username=USERNAME,
+        password=PASSWORD,
+    )
+    sink = RecordingHandler()
+    smtp = Controller(sink, hostname="127.0.0.1", port=free_port())
+    smtp_options = [
+        f"--smtp-server={smtp.hostname}",
+        f"--smtp-port={smtp.port}",
+        "--smtp-use-ssl=false",
+        "--email-from-addr=coordinator@example.com",
+        f"--smtp-connections={options.smtp_connections}",
+    ]
+
+    results = []
+    smtp.start()
+    try:
+        with serving(server), tempfile.TemporaryDirectory() as tmpdir:
+            workdir = Path(tmpdir)
+            manegeplan = workdir / "manegeplan.xlsx"
+            generate_manegeplan(manegeplan, options.users)
+            commands = [
+                ("export-shifts", ["--no-reuse-session", "export-shifts"]),
+                ("send-shift-mails", ["send-shift-mails", *smtp_options]),
+                ("send-shift-mails (no changes)", ["send-shift-mails", *smtp_options]),
+                (
+                    "sync-users-from-manegeplan",
+                    ["sync-users-from-manegeplan", str(manegeplan)],
+                ),
+            ]
+            for name, args in commands:
+                results.append(run_command(name, args, server, sink, workdir))
+    finally:
+        smtp.stop()
+
+    print(f"{options.shifts} shifts, {options.users} users")
+    print(
+        f"{'command':<30} {'seconds':>8} {'requests':>9} {'mails':>6}"
+        f" {'mails/s':>8} {'peak MB':>8}"
+    )
+    for result in results:
+        print(
+            f"{result.command:<30} {result.seconds:8.2f} {result.requests:9}"
+            f" {result.mails:6} {result.mails_per_second:8.1f}"
+            f" {result.peak_rss_mb:8.1f}"
+        )
+
+    if options.json is not None:
+        report = {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "shifts": options.shifts,
+            "users": options.users,
+            "smtp_connections": options.smtp_connections,
+            "results": [asdict(result) for result in results],
+        }
+        options.json.write_text(json.dumps(report, indent=2) + "\n")
+
+
+if __name__ == "__main__":
+    main()
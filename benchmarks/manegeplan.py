@@ -0,0 +1,76 @@
+"""Compare reading a large Manegeplan export in full and read-only mode.
+
+Usage: python benchmarks/manegeplan.py [rows]
+
+Every reader runs in its own process so peak memory use can be measured.
+"""
+
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from openpyxl import Workbook, load_workbook
+
+from inzetbooster.users import read_manegeplan_export
+
+HEADER = ["Roepnaam", "Tussenvoegsels", "Achternaam", "E_Mail", "Persoon_ID"]
+
+
+def generate_workbook(path: Path, rows: int) -> None:
+    wb = Workbook(write_only=True)
+    sheet = wb.create_sheet()
+    sheet.append(HEADER)
+    for i in range(rows):
+        sheet.append(
+            [
+                f"Member {i}",
+                "van" if i % 5 == 0 else None,
+                "Rider",
+                f"m{i}@example.com",
+                f"PRS{i}",
+            ]
+        )
+    wb.save(path)
+
+
+def read_full(path: str) -> int:
+    """Read the workbook the way inzetbooster used to."""
+    sheet = load_workbook(path).active
+    rows = sheet.rows
+    next(rows)
+    return sum(1 for row in rows if any(c.value is not None for c in row))
+
+
+def read_streaming(path: str) -> int:
+    return sum(1 for _ in read_manegeplan_export(path))
+
+
+READERS = {"full": read_full, "read-only": read_streaming}
+
+
+def run_reader(name: str, path: str) -> None:
+    start = time.perf_counter()
+    count = READERS[name](path)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"{name:<10} {count} people in {elapsed:6.2f} s, peak RSS {peak:7.1f} MB")
+
+
+def main(rows: int) -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = Path(tmpdir) / "export.xlsx"
+        generate_workbook(path, rows)
+        for name in READERS:
+            subprocess.run(
+                [sys.executable, __file__, "--reader", name, str(path)], check=True
+            )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == "--reader":
+        run_reader(sys.argv[2], sys.argv[3])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 50_000)
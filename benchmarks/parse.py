@@ -0,0 +1,119 @@
+"""Measure parsing of a large synthetic shift export.
+
+Usage: python benchmarks/parse.py [rows]
+"""
+
+import csv
+import datetime
+import io
+import logging
+import random
+import sys
+import time
+
+import structlog
+
+from inzetbooster.shifts import SHIFT_COLUMNS, Shift, parse_csv
+
+HEADER = [
+    "Dienst_id",
+    "Groep_id",
+    "Groep_naam",
+    "Datum",
+    "Dag",
+    "Starttijd",
+    "Eindtijd",
+    "Tijdsduur",
+    "Gebruiker_id",
+    "Naam",
+    "Email",
+    "Telefoon",
+    "Locatie_id",
+    "Locatie_naam",
+    "Afwezig",
+    "Geannuleerd",
+    "Starred",
+    "Opmerkingen",
+]
+assert set(SHIFT_COLUMNS) <= set(HEADER)
+
+
+def generate_export(rows: int) -> str:
+    rng = random.Random(42)
+    output = io.StringIO(newline="")
+    writer = csv.writer(output, dialect=csv.unix_dialect)
+    writer.writerow(HEADER)
+    start = datetime.date(2024, 1, 1)
+    for i in range(rows):
+        date = start + datetime.timedelta(days=rng.randrange(365))
+        covered = rng.random() < 0.6
+        writer.writerow(
+            [
+                str(2_000_000 + i),
+                rng.choice(["10736", "11703", "12079"]),
+                "Bar",
+                date.strftime("%d-%m-%Y"),
+                " Zaterdag",
+                f"{rng.randrange(8, 20):02d}:{rng.choice(['00', '30'])}",
+                "22:00",
+                "02:00",
+                f"PRS{i}" if covered else "",
+                f"Volunteer {i}" if covered else "",
+                f"volunteer{i}@example.com" if covered else "",
+                "",
+                "",
+                "",
+                "",
+                "",
+                "",
+                "",
+            ]
+        )
+    return output.getvalue()
+
+
+def parse_csv_dictreader(f: str) -> list[Shift]:
+    """The original DictReader and strptime based parser, for reference."""
+    result = []
+    for record in csv.DictReader(io.StringIO(f), dialect=csv.unix_dialect):
+        result.append(
+            Shift(
+                id=int(record["Dienst_id"]),
+                group_id=int(record["Groep_id"]),
+                group_name=record["Groep_naam"],
+                date=datetime.datetime.strptime(record["Datum"], "%d-%m-%Y").date(),
+                start_time=datetime.datetime.strptime(
+                    record["Starttijd"], "%H:%M"
+                ).time(),
+                end_time=datetime.datetime.strptime(record["Eindtijd"], "%H:%M").time(),
+                user_id=record["Gebruiker_id"] or None,
+                user_name=record["Naam"] or None,
+                user_email=record["Email"] or None,
+                comments=record["Opmerkingen"],
+            )
+        )
+    return result
+
+
+def measure(label: str, func, data: str, rows: int) -> list[Shift]:
+    start = time.perf_counter()
+    result = list(func(data))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<12} {elapsed:6.3f} s  {rows / elapsed:10.0f} rows/s")
+    return result
+
+
+def main(rows: int) -> None:
+    # Same as the default log level of the inzetbooster command
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING)
+    )
+    data = generate_export(rows)
+    print(f"{rows} rows, {len(data) / 1e6:.1f} MB")
+    reference = measure("DictReader", parse_csv_dictreader, data, rows)
+    fast = measure("parse_csv", parse_csv, data, rows)
+    assert reference == fast
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000)
@@ -0,0 +1,51 @@
+"""Compare the per-mail cost of rendering shift mails.
+
+Usage: python benchmarks/render.py [mails]
+"""
+
+import datetime
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from mjml import mjml2html
+
+from inzetbooster.mailtemplates import CompiledTemplates
+from inzetbooster.shifts import create_jinja_environment
+
+TEMPLATE = "shift-10736.html"
+
+
+def context(i: int) -> dict:
+    return {
+        "subject": "Aanmelding dienst Bar",
+        "name": f"Volunteer {i}",
+        "date": datetime.date(2024, 1, 1) + datetime.timedelta(days=i % 365),
+        "start_time": datetime.time(16, 0),
+        "end_time": datetime.time(18, 0),
+    }
+
+
+def measure(label: str, count: int, render) -> None:
+    start = time.perf_counter()
+    for i in range(count):
+        render(context(i))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {elapsed / count * 1000:8.3f} ms/mail")
+
+
+def main(count: int) -> None:
+    env = create_jinja_environment()
+    template = env.get_template(TEMPLATE)
+    measure("jinja + mjml per mail", count, lambda c: mjml2html(template.render(c)))
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cold = CompiledTemplates(env, Path(cache_dir))
+        measure("precompiled (cold)", count, lambda c: cold.render(TEMPLATE, c))
+        warm = CompiledTemplates(env, Path(cache_dir))
+        measure("precompiled (warm)", count, lambda c: warm.render(TEMPLATE, c))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
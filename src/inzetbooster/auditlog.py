@@ -1,37 +1,678 @@
+import datetime
+import secrets
 import sqlite3
+import threading
 import time
+from dataclasses import dataclass
+from typing import Iterable, Mapping
+
+# Schema migrations. The database `user_version` records how many of these
+# have been applied, so new migrations must always be appended.
+MIGRATIONS = [
+    """
+    CREATE TABLE IF NOT EXISTS mail_log (
+        id INTEGER PRIMARY KEY,
+        ts INTEGER NOT NULL,
+        shift_id INTEGER NOT NULL,
+        content_id TEXT NOT NULL,
+        email TEXT NOT NULL,
+        msg_id TEXT NOT NULL
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS mail_log_shift
+        ON mail_log (shift_id, content_id, email);
+    """,
+    """
+    CREATE TABLE shift_snapshot (
+        shift_id INTEGER PRIMARY KEY,
+        hash TEXT NOT NULL,
+        ts INTEGER NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE watermark (
+        organisation TEXT PRIMARY KEY,
+        ts INTEGER NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE outbox (
+        id INTEGER PRIMARY KEY,
+        ts INTEGER NOT NULL,
+        shift_id INTEGER NOT NULL,
+        content_id TEXT NOT NULL,
+        email TEXT NOT NULL,
+        name TEXT,
+        subject TEXT NOT NULL,
+        html TEXT NOT NULL,
+        msg_id TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        lease_until REAL,
+        lease_token TEXT,
+        last_error TEXT,
+        UNIQUE (shift_id, content_id, email)
+    );
+    """,
+    # The shifts included in a digest mail in the outbox
+    """
+    CREATE TABLE outbox_shift (
+        outbox_id INTEGER NOT NULL,
+        shift_id INTEGER NOT NULL,
+        content_id TEXT NOT NULL,
+        email TEXT NOT NULL,
+        UNIQUE (shift_id, content_id, email)
+    );
+    """,
+    """
+    CREATE INDEX outbox_shift_outbox ON outbox_shift (outbox_id);
+    """,
+    # Dates of the shifts that mails were sent for, to archive old entries
+    """
+    CREATE TABLE shift_date (
+        shift_id INTEGER PRIMARY KEY,
+        date TEXT NOT NULL
+    );
+    """,
+    """
+    CREATE INDEX shift_date_date ON shift_date (date);
+    """,
+    """
+    CREATE TABLE compaction (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        ts REAL NOT NULL,
+        archived_before TEXT NOT NULL
+    );
+    """,
+    # Queued mails are only sent by the organisation that queued them, with
+    # its own SMTP server and sender.
+    """
+    ALTER TABLE outbox ADD COLUMN organisation TEXT NOT NULL DEFAULT '';
+    """,
+    # Shift dates of the snapshot hashes, to prune hashes of past shifts
+    """
+    ALTER TABLE shift_snapshot ADD COLUMN date TEXT;
+    """,
+]
+
+ARCHIVE_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS archive.mail_log (
+        id INTEGER PRIMARY KEY,
+        ts INTEGER NOT NULL,
+        shift_id INTEGER NOT NULL,
+        content_id TEXT NOT NULL,
+        email TEXT NOT NULL,
+        msg_id TEXT NOT NULL,
+        shift_date TEXT
+    );
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS archive.mail_log_shift
+        ON mail_log (shift_id, content_id, email);
+    """,
+]
+
+# Stay well below SQLITE_MAX_VARIABLE_NUMBER for older SQLite versions.
+MAX_QUERY_PARAMETERS = 500
+
+# Seconds a sender may hold on to queued mails before others may send them
+OUTBOX_LEASE = 300
+# Seconds to wait before sending a mail again after a failed attempt
+OUTBOX_RETRY_DELAY = 300
+# Mails that failed this many times are left in the outbox, but not sent
+OUTBOX_MAX_ATTEMPTS = 5
+
+# Entries logged before shift dates were stored are archived once they were
+# logged this many days before the retention period, as the shift date is
+# at most a year (the default export window) after the mail was sent.
+UNDATED_RETENTION_MARGIN = 366
+
+OUTBOX_COLUMNS = (
+    "id, shift_id, content_id, email, name, subject, html, msg_id, attempts"
+)
+
+
+@dataclass(frozen=True, slots=True)
+class QueuedMail:
+    id: int
+    shift_id: int
+    content_id: str
+    email: str
+    name: str | None
+    subject: str
+    html: str
+    msg_id: str
+    attempts: int
+    # (shift_id, content_id) of every shift in a digest mail
+    shifts: tuple[tuple[int, str], ...] = ()
+    # Identifies the lease held by this sender
+    lease_token: str | None = None
+
+    @property
+    def logged_shifts(self) -> tuple[tuple[int, str], ...]:
+        """The (shift_id, content_id) pairs to log once the mail is sent."""
+        return self.shifts or ((self.shift_id, self.content_id),)
+
+
+@dataclass(frozen=True, slots=True)
+class OutboxStats:
+    depth: int
+    oldest_age: float | None
+    failed: int
+
+
+@dataclass(frozen=True, slots=True)
+class CompactionResult:
+    archived: int
+    archived_before: datetime.date
 
 
 class AuditLog:
+    """Log of all mails that have been sent.
+
+    By default every logged mail is committed and synced to disk on its own.
+    With a `batch_size` larger than one or a `batch_interval` the database
+    switches to WAL mode: every mail is still committed immediately, which
+    makes it survive a crash of the process, but syncing to disk is done
+    in groups once `batch_size` mails have been logged or `batch_interval`
+    seconds have passed since the first unsynced mail.
+
+    An audit log can be shared between threads.
+    """
+
     db: sqlite3.Connection
+    batch_size: int
+    batch_interval: float | None
+    _unsynced: int
+    _unsynced_since: float | None
+    _lock: threading.RLock
 
-    def __init__(self, path: str = "logs.db"):
-        self.db = sqlite3.connect(path)
-        with self.db:
-            self.db.execute("""
-                CREATE TABLE IF NOT EXISTS mail_log (
-                    id INTEGER PRIMARY KEY,
-                    ts INTEGER NOT NULL,
-                    shift_id INTEGER NOT NULL,
-                    content_id TEXT NOT NULL,
-                    email TEXT NOT NULL,
-                    msg_id TEXT NOT NULL
-                );
-                """)
+    def __init__(
+        self,
+        path: str = "logs.db",
+        *,
+        batch_size: int = 1,
+        batch_interval: float | None = None,
+    ):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.RLock()
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._unsynced = 0
+        self._unsynced_since = None
+        if self.is_batched:
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("PRAGMA synchronous = NORMAL")
+        # Only has an effect on new databases, see `compact`.
+        self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        self._migrate()
+
+    @property
+    def is_batched(self) -> bool:
+        return self.batch_size > 1 or self.batch_interval is not None
+
+    def _migrate(self) -> None:
+        (version,) = self.db.execute("PRAGMA user_version").fetchone()
+        for version, statement in enumerate(MIGRATIONS[version:], version + 1):
+            with self.db:
+                self.db.execute(statement)
+                self.db.execute(f"PRAGMA user_version = {version}")
 
     def close(self):
-        self.db.close()
+        with self._lock:
+            self.sync()
+            self.db.close()
+
+    def sync(self) -> None:
+        """Sync all logged mails to disk."""
+        with self._lock:
+            if self._unsynced and self.is_batched:
+                # With synchronous=NORMAL SQLite syncs the WAL before checkpointing.
+                self.db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+            self._unsynced = 0
+            self._unsynced_since = None
+
+    def _logged(self) -> None:
+        """Sync to disk if a batch of mails was logged."""
+        self._unsynced += 1
+        if self._unsynced_since is None:
+            self._unsynced_since = time.monotonic()
+        if self._unsynced >= self.batch_size or (
+            self.batch_interval is not None
+            and time.monotonic() - self._unsynced_since >= self.batch_interval
+        ):
+            self.sync()
 
     def log_mail(self, shift_id: int, content_id: str, email: str, msg_id: str):
-        with self.db:
+        with self._lock:
+            with self.db:
+                self.db.execute(
+                    "INSERT INTO mail_log (ts, shift_id, content_id, email, msg_id) VALUES (?, ?, ?, ?, ?)",
+                    (time.time(), shift_id, content_id, email, msg_id),
+                )
+            self._logged()
+
+    def was_mail_send(self, shift_id: int, content_id: str, email: str) -> bool:
+        with self._lock:
+            cursor = self.db.execute(
+                "SELECT ts FROM mail_log WHERE shift_id=? AND content_id=? AND email=?",
+                (shift_id, content_id, email),
+            )
+            return cursor.fetchone() is not None
+
+    def sent_mails(self, shift_ids: Iterable[int]) -> set[tuple[int, str, str]]:
+        """Return all logged mails for the given shifts.
+
+        The result is a set of `(shift_id, content_id, email)` tuples, which
+        allows checking many shifts with a handful of queries instead of
+        calling `was_mail_send` for every shift.
+        """
+        shift_ids = sorted(set(shift_ids))
+        sent = set()
+        for i in range(0, len(shift_ids), MAX_QUERY_PARAMETERS):
+            chunk = shift_ids[i : i + MAX_QUERY_PARAMETERS]
+            with self._lock:
+                cursor = self.db.execute(
+                    "SELECT shift_id, content_id, email FROM mail_log WHERE shift_id IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    chunk,
+                )
+                sent.update(cursor)
+        return sent
+
+    def shift_hashes(self, shift_ids: Iterable[int]) -> dict[int, str]:
+        """Return the stored content hashes for the given shifts."""
+        shift_ids = sorted(set(shift_ids))
+        hashes = {}
+        for i in range(0, len(shift_ids), MAX_QUERY_PARAMETERS):
+            chunk = shift_ids[i : i + MAX_QUERY_PARAMETERS]
+            with self._lock:
+                cursor = self.db.execute(
+                    "SELECT shift_id, hash FROM shift_snapshot WHERE shift_id IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    chunk,
+                )
+                hashes.update(cursor)
+        return hashes
+
+    def store_shift_hashes(
+        self,
+        organisation: str,
+        hashes: dict[int, str],
+        shift_dates: Mapping[int, datetime.date] | None = None,
+    ) -> None:
+        """Store shift content hashes and move the watermark to now.
+
+        `shift_dates` are stored so that `compact` can prune the hashes of
+        past shifts.
+        """
+        now = time.time()
+        shift_dates = shift_dates or {}
+        rows = []
+        for shift_id, hash in hashes.items():
+            date = shift_dates.get(shift_id)
+            rows.append((shift_id, hash, now, date.isoformat() if date else None))
+        with self._lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO shift_snapshot (shift_id, hash, ts, date) VALUES (?, ?, ?, ?)",
+                rows,
+            )
             self.db.execute(
-                "INSERT INTO mail_log (ts, shift_id, content_id, email, msg_id) VALUES (?, ?, ?, ?, ?)",
-                (time.time(), shift_id, content_id, email, msg_id),
+                "INSERT OR REPLACE INTO watermark (organisation, ts) VALUES (?, ?)",
+                (organisation, now),
             )
 
-    def was_mail_send(self, shift_id: int, content_id: str, email: str) -> bool:
-        cursor = self.db.execute(
-            "SELECT ts FROM mail_LOG WHERE shift_id=? AND content_id=? AND email=?",
-            (shift_id, content_id, email),
+    def watermark(self, organisation: str) -> float | None:
+        """Return the time of the last successful incremental run."""
+        with self._lock:
+            row = self.db.execute(
+                "SELECT ts FROM watermark WHERE organisation=?", (organisation,)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def enqueue_mail(
+        self,
+        shift_id: int,
+        content_id: str,
+        email: str,
+        name: str | None,
+        subject: str,
+        html: str,
+        msg_id: str,
+        *,
+        lease: bool = False,
+        shifts: Iterable[tuple[int, str]] = (),
+        shift_dates: Mapping[int, datetime.date] | None = None,
+        organisation: str = "",
+    ) -> QueuedMail | None:
+        """Add a rendered mail to the outbox.
+
+        Returns None if the mail is already in the outbox. With `lease` the
+        mail is leased to the caller straight away, to send it immediately.
+
+        A digest mail lists the (shift_id, content_id) of all its shifts in
+        `shifts`. Every one of them is logged when the mail is sent, and the
+        mail is not queued if any of them is already queued.
+
+        `shift_dates` are stored so that the log entries can be archived
+        once the shifts are in the past, see `compact`. The mail is only
+        leased to senders for the same `organisation`.
+        """
+        shifts = tuple(shifts)
+        now = time.time()
+        token = secrets.token_hex(8) if lease else None
+        with self._lock:
+            try:
+                with self.db:
+                    cursor = self.db.execute(
+                        "INSERT OR IGNORE INTO outbox (ts, organisation, shift_id, content_id, email, name, subject, html, msg_id, attempts, lease_until, lease_token) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (
+                            now,
+                            organisation,
+                            shift_id,
+                            content_id,
+                            email,
+                            name,
+                            subject,
+                            html,
+                            msg_id,
+                            1 if lease else 0,
+                            now + OUTBOX_LEASE if lease else None,
+                            token,
+                        ),
+                    )
+                    if cursor.rowcount and shifts:
+                        self.db.executemany(
+                            "INSERT INTO outbox_shift (outbox_id, shift_id, content_id, email) VALUES (?, ?, ?, ?)",
+                            (
+                                (cursor.lastrowid, included_id, included_content, email)
+                                for included_id, included_content in shifts
+                            ),
+                        )
+                    if cursor.rowcount and shift_dates:
+                        self.db.executemany(
+                            "INSERT OR REPLACE INTO shift_date (shift_id, date) VALUES (?, ?)",
+                            (
+                                (dated_id, date.isoformat())
+                                for dated_id, date in shift_dates.items()
+                            ),
+                        )
+            except sqlite3.IntegrityError:
+                return None
+        if not cursor.rowcount:
+            return None
+        return QueuedMail(
+            cursor.lastrowid or 0,
+            shift_id,
+            content_id,
+            email,
+            name,
+            subject,
+            html,
+            msg_id,
+            1 if lease else 0,
+            shifts,
+            token,
+        )
+
+    def lease_mails(self, limit: int = 100, organisation: str = "") -> list[QueuedMail]:
+        """Lease up to `limit` mails queued by `organisation`, oldest first.
+
+        Mails that are leased by another sender, are waiting to be retried
+        or have failed too often are skipped. The lease is taken in a single
+        statement, so concurrent runs never get the same mail.
+        """
+        now = time.time()
+        token = secrets.token_hex(8)
+        with self._lock:
+            with self.db:
+                self.db.execute(
+                    """
+                    UPDATE outbox SET lease_until=?, lease_token=?, attempts=attempts + 1
+                    WHERE id IN (
+                        SELECT id FROM outbox
+                        WHERE organisation = ?
+                            AND (lease_until IS NULL OR lease_until < ?)
+                            AND attempts < ?
+                        ORDER BY id LIMIT ?
+                    )
+                    """,
+                    (
+                        now + OUTBOX_LEASE,
+                        token,
+                        organisation,
+                        now,
+                        OUTBOX_MAX_ATTEMPTS,
+                        limit,
+                    ),
+                )
+            rows = self.db.execute(
+                f"SELECT {OUTBOX_COLUMNS} FROM outbox WHERE lease_token=? ORDER BY id",
+                (token,),
+            ).fetchall()
+            included: dict[int, list[tuple[int, str]]] = {}
+            cursor = self.db.execute(
+                "SELECT outbox_id, shift_id, content_id FROM outbox_shift WHERE outbox_id IN (SELECT id FROM outbox WHERE lease_token=?) ORDER BY rowid",
+                (token,),
+            )
+            for outbox_id, shift_id, content_id in cursor:
+                included.setdefault(outbox_id, []).append((shift_id, content_id))
+        return [
+            QueuedMail(*row, tuple(included.get(row[0], ())), token) for row in rows
+        ]
+
+    def renew_lease(self, mails: Iterable[QueuedMail]) -> None:
+        """Extend the lease on mails that are still being sent."""
+        with self._lock, self.db:
+            self.db.executemany(
+                "UPDATE outbox SET lease_until=? WHERE id=? AND lease_token=?",
+                (
+                    (time.time() + OUTBOX_LEASE, mail.id, mail.lease_token)
+                    for mail in mails
+                ),
+            )
+
+    def complete_mail(self, mail: QueuedMail, msg_id: str) -> bool:
+        """Move a sent mail from the outbox to the mail log.
+
+        All shifts of a digest mail are logged in the same transaction.
+        Returns False, without logging the mail, if the lease expired and
+        the mail was leased to another sender, which will log it instead.
+        """
+        now = time.time()
+        with self._lock:
+            with self.db:
+                deleted = self.db.execute(
+                    "DELETE FROM outbox WHERE id=? AND lease_token=?",
+                    (mail.id, mail.lease_token),
+                ).rowcount
+                if not deleted:
+                    return False
+                self.db.executemany(
+                    "INSERT INTO mail_log (ts, shift_id, content_id, email, msg_id) VALUES (?, ?, ?, ?, ?)",
+                    (
+                        (now, shift_id, content_id, mail.email, msg_id)
+                        for shift_id, content_id in mail.logged_shifts
+                    ),
+                )
+                self.db.execute(
+                    "DELETE FROM outbox_shift WHERE outbox_id=?", (mail.id,)
+                )
+            self._logged()
+        return True
+
+    def fail_mail(self, mail: QueuedMail, error: str) -> None:
+        """Record a failed attempt; the mail is retried after a delay."""
+        with self._lock, self.db:
+            self.db.execute(
+                "UPDATE outbox SET lease_until=?, lease_token=NULL, last_error=? WHERE id=? AND lease_token=?",
+                (time.time() + OUTBOX_RETRY_DELAY, error, mail.id, mail.lease_token),
+            )
+
+    def release_mails(self, mails: Iterable[QueuedMail]) -> None:
+        """Give up the lease on mails that were not attempted."""
+        with self._lock, self.db:
+            self.db.executemany(
+                "UPDATE outbox SET lease_until=NULL, lease_token=NULL, attempts=attempts - 1 WHERE id=? AND lease_token=?",
+                ((mail.id, mail.lease_token) for mail in mails),
+            )
+
+    def requeue_failed_mails(self) -> int:
+        """Try mails that failed too often again, returning how many."""
+        with self._lock, self.db:
+            return self.db.execute(
+                "UPDATE outbox SET attempts=0, lease_until=NULL, lease_token=NULL WHERE attempts >= ?",
+                (OUTBOX_MAX_ATTEMPTS,),
+            ).rowcount
+
+    def purge_failed_mails(self) -> int:
+        """Remove mails that failed too often, returning how many.
+
+        Their shifts are no longer handled, so the next run renders and
+        queues new mails for them. Their snapshot hashes are removed as
+        well, so incremental runs do not skip them.
+        """
+        with self._lock, self.db:
+            self.db.execute(
+                """
+                DELETE FROM shift_snapshot WHERE shift_id IN (
+                    SELECT shift_id FROM outbox WHERE attempts >= ?
+                    UNION
+                    SELECT outbox_shift.shift_id FROM outbox_shift
+                    JOIN outbox ON outbox.id = outbox_shift.outbox_id
+                    WHERE outbox.attempts >= ?
+                )
+                """,
+                (OUTBOX_MAX_ATTEMPTS, OUTBOX_MAX_ATTEMPTS),
+            )
+            self.db.execute(
+                "DELETE FROM outbox_shift WHERE outbox_id IN (SELECT id FROM outbox WHERE attempts >= ?)",
+                (OUTBOX_MAX_ATTEMPTS,),
+            )
+            return self.db.execute(
+                "DELETE FROM outbox WHERE attempts >= ?", (OUTBOX_MAX_ATTEMPTS,)
+            ).rowcount
+
+    def queued_mails(self, shift_ids: Iterable[int]) -> set[tuple[int, str, str]]:
+        """Return all mails in the outbox for the given shifts.
+
+        The result has the same form as `sent_mails`.
+        """
+        shift_ids = sorted(set(shift_ids))
+        queued = set()
+        for i in range(0, len(shift_ids), MAX_QUERY_PARAMETERS):
+            chunk = shift_ids[i : i + MAX_QUERY_PARAMETERS]
+            with self._lock:
+                for table in ("outbox", "outbox_shift"):
+                    cursor = self.db.execute(
+                        "SELECT shift_id, content_id, email FROM %s WHERE shift_id IN (%s)"
+                        % (table, ",".join("?" * len(chunk))),
+                        chunk,
+                    )
+                    queued.update(cursor)
+        return queued
+
+    def outbox_stats(self) -> OutboxStats:
+        """Number of queued mails, age of the oldest, and how many gave up."""
+        with self._lock:
+            depth, oldest, failed = self.db.execute(
+                "SELECT COUNT(*), MIN(ts), COUNT(CASE WHEN attempts >= ? THEN 1 END) FROM outbox",
+                (OUTBOX_MAX_ATTEMPTS,),
+            ).fetchone()
+        return OutboxStats(
+            depth, time.time() - oldest if oldest is not None else None, failed
+        )
+
+    def archived_before(self) -> datetime.date | None:
+        """Shifts before this date may have been archived, see `compact`."""
+        with self._lock:
+            row = self.db.execute(
+                "SELECT archived_before FROM compaction WHERE id=1"
+            ).fetchone()
+        return datetime.date.fromisoformat(row[0]) if row is not None else None
+
+    def last_compacted(self) -> float | None:
+        """Return the time of the last compaction."""
+        with self._lock:
+            row = self.db.execute("SELECT ts FROM compaction WHERE id=1").fetchone()
+        return row[0] if row is not None else None
+
+    def compact(self, archive_path: str, retention_days: int) -> CompactionResult:
+        """Move log entries for shifts older than `retention_days` to an archive.
+
+        The entries are moved to the `mail_log` table of the SQLite database
+        at `archive_path` in a single transaction, and the freed pages are
+        returned to the file system. Callers must not send mails for shifts
+        before `archived_before` any more, as their entries are gone.
+
+        Databases created before incremental vacuuming was enabled are
+        vacuumed in full once, which can take a while for a large log.
+        """
+        now = time.time()
+        archived_before = datetime.date.today() - datetime.timedelta(
+            days=retention_days
         )
-        return cursor.fetchone() is not None
+        undated_before = now - (retention_days + UNDATED_RETENTION_MARGIN) * 86400
+        with self._lock:
+            self.sync()
+            self.db.execute("ATTACH DATABASE ? AS archive", (archive_path,))
+            try:
+                with self.db:
+                    for statement in ARCHIVE_SCHEMA:
+                        self.db.execute(statement)
+                    self.db.execute("DROP TABLE IF EXISTS temp.expired")
+                    self.db.execute(
+                        """
+                        CREATE TEMP TABLE expired AS
+                        SELECT mail_log.id, mail_log.shift_id, shift_date.date
+                        FROM mail_log
+                        LEFT JOIN shift_date ON shift_date.shift_id = mail_log.shift_id
+                        WHERE shift_date.date < ?
+                            OR (shift_date.date IS NULL AND mail_log.ts < ?)
+                        """,
+                        (archived_before.isoformat(), undated_before),
+                    )
+                    self.db.execute("""
+                        INSERT INTO archive.mail_log (ts, shift_id, content_id, email, msg_id, shift_date)
+                        SELECT ts, mail_log.shift_id, content_id, email, msg_id, expired.date
+                        FROM mail_log JOIN expired ON expired.id = mail_log.id
+                        ORDER BY mail_log.id
+                        """)
+                    archived = self.db.execute(
+                        "DELETE FROM mail_log WHERE id IN (SELECT id FROM expired)"
+                    ).rowcount
+                    self.db.execute(
+                        """
+                        DELETE FROM shift_snapshot
+                        WHERE shift_id IN (SELECT shift_id FROM expired)
+                            OR date < ?
+                            OR (date IS NULL AND ts < ?)
+                        """,
+                        (archived_before.isoformat(), undated_before),
+                    )
+                    self.db.execute(
+                        "DELETE FROM shift_date WHERE date < ?",
+                        (archived_before.isoformat(),),
+                    )
+                    self.db.execute("DROP TABLE expired")
+                    self.db.execute(
+                        """
+                        INSERT INTO compaction (id, ts, archived_before) VALUES (1, ?, ?)
+                        ON CONFLICT (id) DO UPDATE SET
+                            ts=excluded.ts,
+                            archived_before=max(archived_before, excluded.archived_before)
+                        """,
+                        (now, archived_before.isoformat()),
+                    )
+            finally:
+                self.db.execute("DETACH DATABASE archive")
+            (auto_vacuum,) = self.db.execute("PRAGMA auto_vacuum").fetchone()
+            if auto_vacuum != 2:
+                # Switching to incremental vacuuming needs a full vacuum.
+                self.db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                self.db.execute("VACUUM")
+            else:
+                self.db.execute("PRAGMA incremental_vacuum").fetchall()
+            self.db.execute("ANALYZE")
+        return CompactionResult(archived, self.archived_before() or archived_before)
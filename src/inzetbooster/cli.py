@@ -1,29 +1,143 @@
+import datetime
 import logging
+import shutil
 import sys
-from typing import BinaryIO
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, BinaryIO, Callable
 
 import click
-import httpx
 import structlog
 from structlog.contextvars import bind_contextvars
 
-from . import shifts, users
-from .auditlog import AuditLog
-from .inzetrooster import Inzetrooster
-from .mailer import Mailer
+from . import logs
+from .paths import default_cache_dir, default_session_file
+from .session import SessionStore
+
+# The commands import their dependencies themselves, so starting the CLI
+# does not pay for importing everything.
+if TYPE_CHECKING:
+    import httpx
+
+    from .inzetrooster import Inzetrooster
+    from .organisations import Organisation, OrganisationResult
+
+
+def default_base_url() -> str:
+    from .inzetrooster import BASE_URL
+
+    return BASE_URL
 
 
 @click.group()
 @click.option(
-    "--org", default="rvliethorp", envvar="ORGANIZATION", help="Organization name"
+    "--org",
+    default=["rvliethorp"],
+    multiple=True,
+    envvar="ORGANIZATION",
+    help="Organization name, can be given multiple times",
+)
+@click.option("--user", envvar="USERNAME", help="Username")
+@click.option("--password", envvar="PASSWORD", help="Password")
+@click.option(
+    "--config",
+    envvar="INZETBOOSTER_CONFIG",
+    type=click.Path(exists=True, dir_okay=False, path_type=Path),
+    help="Configuration file with the organisations to handle",
+)
+@click.option(
+    "--workers",
+    envvar="WORKERS",
+    type=click.IntRange(min=1),
+    default=4,
+    help="Number of organisations from the configuration file to handle at once",
 )
-@click.option("--user", prompt=True, envvar="USERNAME", help="Username")
-@click.password_option(envvar="PASSWORD", confirmation_prompt=False)
 @click.option("--auditlog", envvar="AUDITLOG", default="audit.db")
+@click.option(
+    "--auditlog-batch-size",
+    envvar="AUDITLOG_BATCH_SIZE",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of audit log entries to sync to disk at once",
+)
+@click.option(
+    "--auditlog-batch-interval",
+    envvar="AUDITLOG_BATCH_INTERVAL",
+    type=click.FloatRange(min=0),
+    help="Maximum number of seconds before audit log entries are synced to disk",
+)
+@click.option(
+    "--audit-retention",
+    envvar="AUDIT_RETENTION",
+    type=click.IntRange(min=1),
+    help="Archive audit log entries for shifts more than this many days ago",
+)
+@click.option(
+    "--audit-archive",
+    envvar="AUDIT_ARCHIVE",
+    type=click.Path(dir_okay=False),
+    help="Database to archive audit log entries to (default: next to the audit log)",
+)
+@click.option(
+    "--base-url",
+    envvar="INZETROOSTER_URL",
+    default=default_base_url,
+    help="URL of the inzetrooster server (default: https://inzetrooster.nl)",
+)
+@click.option(
+    "--session-file",
+    envvar="SESSION_FILE",
+    type=click.Path(dir_okay=False, path_type=Path),
+    default=default_session_file,
+    help="File to store inzetrooster sessions in between runs",
+)
+@click.option(
+    "--reuse-session/--no-reuse-session",
+    envvar="REUSE_SESSION",
+    default=True,
+    help="Reuse the stored inzetrooster session instead of logging in",
+)
+@click.option(
+    "--http-retries",
+    envvar="HTTP_RETRIES",
+    type=click.IntRange(min=0),
+    default=3,
+    help="Number of times to retry a failed request to inzetrooster",
+)
+@click.option(
+    "--http-timeout",
+    envvar="HTTP_TIMEOUT",
+    type=click.FloatRange(min=0, min_open=True),
+    default=30,
+    help="Seconds to wait for inzetrooster to respond",
+)
+@click.option(
+    "--metrics-file",
+    envvar="METRICS_FILE",
+    type=click.Path(dir_okay=False, path_type=Path),
+    help="Write Prometheus metrics to this file for the textfile collector",
+)
 @click.option("-v", "--verbose", count=True)
 @click.pass_context
 def main(
-    ctx: click.Context, org: str, user: str, password: str, auditlog: str, verbose: int
+    ctx: click.Context,
+    org: tuple[str, ...],
+    user: str | None,
+    password: str | None,
+    config: Path | None,
+    workers: int,
+    auditlog: str,
+    auditlog_batch_size: int,
+    auditlog_batch_interval: float | None,
+    audit_retention: int | None,
+    audit_archive: str | None,
+    base_url: str,
+    session_file: Path,
+    reuse_session: bool,
+    http_retries: int,
+    http_timeout: float,
+    metrics_file: Path | None,
+    verbose: int,
 ):
     """Add-on utilities for inzetrooster"""
     log_level = logging.WARNING
@@ -31,94 +145,472 @@ def main(
         log_level = logging.DEBUG
     elif verbose >= 1:
         log_level = logging.INFO
-    structlog.configure(
-        wrapper_class=structlog.make_filtering_bound_logger(log_level),
-    )
+    logs.configure(log_level, json=not sys.stdout.isatty())
+    if metrics_file is not None:
+        from .metrics import write_textfile
 
-    if not sys.stdout.isatty():
-        structlog.configure(
-            processors=structlog.get_config()["processors"][:-1]
-            + [
-                structlog.processors.dict_tracebacks,
-                structlog.processors.JSONRenderer(),
-            ]
-        )
-    bind_contextvars(org=org)
+        ctx.call_on_close(lambda: write_textfile(metrics_file))
+
+    organisations = None
+    if config is not None:
+        from .organisations import load_config
+
+        try:
+            organisations = load_config(config)
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint="--config") from None
+    elif ctx.invoked_subcommand != "audit":
+        if user is None:
+            user = click.prompt("User")
+        if password is None:
+            password = click.prompt("Password", hide_input=True)
+        if len(org) == 1:
+            bind_contextvars(org=org[0])
+    if audit_archive is None:
+        path = Path(auditlog)
+        audit_archive = str(path.with_name(f"{path.stem}-archive{path.suffix}"))
     ctx.obj = {
         "user": user,
         "password": password,
-        "org": org,
+        "org": org[0],
+        "orgs": list(org),
         "auditlog": auditlog,
+        "auditlog_batch_size": auditlog_batch_size,
+        "auditlog_batch_interval": auditlog_batch_interval,
+        "audit_retention": audit_retention,
+        "audit_archive": audit_archive,
+        "base_url": base_url,
+        "session_store": SessionStore(session_file) if reuse_session else None,
+        "http_retries": http_retries,
+        "http_timeout": http_timeout,
+        "organisations": organisations,
+        "workers": workers,
+    }
+
+
+def organisation_obj(obj: dict, organisation: "Organisation") -> dict:
+    """Command settings for one organisation from the configuration file."""
+    return {
+        **obj,
+        "user": organisation.user,
+        "password": organisation.password,
+        "org": organisation.name,
+        "orgs": [organisation.name],
     }
 
 
+def report(results: list["OrganisationResult"], started: float) -> None:
+    from .organisations import format_summary
+
+    click.echo(format_summary(results, time.monotonic() - started), err=True)
+    if not all(result.ok for result in results):
+        sys.exit(1)
+
+
+def http_client(obj: dict) -> "httpx.Client":
+    from .inzetrooster import create_client
+
+    return create_client(retries=obj["http_retries"], timeout=obj["http_timeout"])
+
+
+def login(obj: dict, client: "httpx.Client") -> "Inzetrooster":
+    from .inzetrooster import Inzetrooster
+
+    ir = Inzetrooster(
+        client,
+        obj["org"],
+        session_store=obj["session_store"],
+        base_url=obj["base_url"],
+    )
+    ir.login(obj["user"], obj["password"])
+    return ir
+
+
+def export_window_options(func: Callable) -> Callable:
+    func = click.option(
+        "--shard-concurrency",
+        envvar="SHARD_CONCURRENCY",
+        type=click.IntRange(min=1, max=10),
+        default=4,
+        help="Number of export shards to request at once",
+    )(func)
+    func = click.option(
+        "--shard-export",
+        envvar="SHARD_EXPORT",
+        type=click.Choice(["group", "date"]),
+        help="Request the shift export per group or per four weeks",
+    )(func)
+    func = click.option(
+        "--to-date",
+        envvar="EXPORT_TO_DATE",
+        type=click.DateTime(formats=["%Y-%m-%d"]),
+        help="Last day to export shifts for (default: 52 weeks after from date)",
+    )(func)
+    func = click.option(
+        "--from-date",
+        envvar="EXPORT_FROM_DATE",
+        type=click.DateTime(formats=["%Y-%m-%d"]),
+        help="First day to export shifts for (default: today)",
+    )(func)
+    return func
+
+
 @main.command()
+@export_window_options
 @click.pass_obj
-def export_shifts(obj: dict[str, str]):
+def export_shifts(
+    obj: dict[str, str],
+    from_date: datetime.datetime | None,
+    to_date: datetime.datetime | None,
+    shard_export: str | None,
+    shard_concurrency: int,
+):
     """Export shifts"""
-    with httpx.Client(follow_redirects=True) as client:
-        ir = Inzetrooster(client, obj["org"])
-        ir.login(obj["user"], obj["password"])
-        print(ir.export_shifts())
+    window = {
+        "from_date": from_date.date() if from_date else None,
+        "to_date": to_date.date() if to_date else None,
+        "shard_by": shard_export,
+        "shard_concurrency": shard_concurrency,
+    }
+    if obj["organisations"]:
+        from .organisations import fan_out
+
+        exports = {}
+
+        def export_organisation(organisation: "Organisation") -> None:
+            organisation_settings = organisation_obj(obj, organisation)
+            organisation_window = {
+                **window,
+                "shard_by": organisation.options.get("shard_export", shard_export),
+            }
+            with http_client(organisation_settings) as client:
+                ir = login(organisation_settings, client)
+                exports[organisation.name] = ir.export_shifts(**organisation_window)
+
+        started = time.monotonic()
+        results = fan_out(obj["organisations"], export_organisation, obj["workers"])
+        for result in results:
+            if result.ok:
+                print(exports[result.name])
+        report(results, started)
+        return
+
+    if len(obj["orgs"]) > 1:
+        import asyncio
+
+        from .inzetrooster import export_shifts_for_organisations
+
+        exports = asyncio.run(
+            export_shifts_for_organisations(
+                obj["orgs"],
+                obj["user"],
+                obj["password"],
+                base_url=obj["base_url"],
+                retries=obj["http_retries"],
+                timeout=obj["http_timeout"],
+                session_store=obj["session_store"],
+                **window,
+            )
+        )
+        for export in exports.values():
+            print(export)
+        return
+
+    with http_client(obj) as client:
+        ir = login(obj, client)
+        with ir.stream_shifts(**window) as export:
+            shutil.copyfileobj(export, sys.stdout)
+
+
+def shift_mail_options(func: Callable) -> Callable:
+    options = [
+        click.option("--smtp-server", envvar="SMTP_SERVER", help="SMTP server"),
+        click.option(
+            "--smtp-port",
+            envvar="SMTP_PORT",
+            type=click.IntRange(min=1),
+            help="SMTP port",
+        ),
+        click.option(
+            "--smtp-use-ssl",
+            envvar="SMTP_SSL",
+            type=click.BOOL,
+            default="Connect to SMTP server with SSL",
+        ),
+        click.option(
+            "--smtp-user", envvar="SMTP_USER", help="Username for SMTP server"
+        ),
+        click.option(
+            "--smtp-password", envvar="SMTP_PASSWORD", help="Password for SMTP server"
+        ),
+        click.option(
+            "--email-from-addr",
+            envvar="EMAIL_FROM_ADDR",
+            help="Email address to send mail from",
+        ),
+        click.option(
+            "--email-from-name",
+            envvar="EMAIL_FROM_NAME",
+            default="Vrijwilligers coordinator",
+            help="Name of person sending the email",
+        ),
+        click.option(
+            "--smtp-connections",
+            envvar="SMTP_CONNECTIONS",
+            type=click.IntRange(min=1),
+            default=1,
+            help="Number of concurrent SMTP connections",
+        ),
+        click.option(
+            "--smtp-rate-limit",
+            envvar="SMTP_RATE_LIMIT",
+            type=click.FloatRange(min=0, min_open=True),
+            help="Maximum number of mails to send per second",
+        ),
+        click.option(
+            "--render-workers",
+            envvar="RENDER_WORKERS",
+            type=click.IntRange(min=0),
+            default=0,
+            help="Number of processes to render mails in, overlapping with sending",
+        ),
+        click.option(
+            "--digest",
+            envvar="DIGEST",
+            type=click.Choice(["off", "all", "same-group"]),
+            default="off",
+            help="Send one mail per volunteer listing all new shifts (same-group: "
+            "only if they are all in the same group)",
+        ),
+        click.option(
+            "--template-cache",
+            envvar="TEMPLATE_CACHE",
+            type=click.Path(file_okay=False, path_type=Path),
+            default=default_cache_dir,
+            help="Directory to store compiled mail templates",
+        ),
+        click.option(
+            "--incremental/--no-incremental",
+            envvar="INCREMENTAL",
+            default=False,
+            help="Only handle shifts that changed since the last successful run",
+        ),
+        click.option(
+            "--full-refresh-after",
+            envvar="FULL_REFRESH_AFTER",
+            type=click.FloatRange(min=0),
+            default=24,
+            help="Hours after which an incremental run checks all shifts again",
+        ),
+    ]
+    func = export_window_options(func)
+    for option in reversed(options):
+        func = option(func)
+    return func
 
 
 @main.command()
-@click.option("--smtp-server", envvar="SMTP_SERVER", help="SMTP server")
+@shift_mail_options
 @click.option(
-    "--smtp-port",
-    envvar="SMTP_PORT",
-    type=click.IntRange(min=1),
-    help="SMTP port",
+    "--profile",
+    envvar="PROFILE",
+    type=click.Path(file_okay=False, path_type=Path),
+    help="Write a Chrome trace of the run to this directory",
+)
+@click.option(
+    "--profile-render/--no-profile-render",
+    envvar="PROFILE_RENDER",
+    default=False,
+    help="With --profile, also write a cProfile dump of mail rendering",
+)
+@click.pass_obj
+def send_shift_mails(
+    obj: dict[str, str],
+    profile: Path | None,
+    profile_render: bool,
+    **options: Any,
+) -> None:
+    """Send a thank-you mail for new shift assignments"""
+    if profile is None:
+        _send_shift_mails(obj, options)
+        return
+
+    from . import tracing
+
+    tracer = tracing.enable(profile_render=profile_render)
+    try:
+        _send_shift_mails(obj, options)
+    finally:
+        tracing.disable()
+        for path in tracer.write(profile):
+            click.echo(f"Profile written to {path}", err=True)
+
+
+def _send_shift_mails(obj: dict, options: dict[str, Any]) -> None:
+    from .runner import ShiftMailRunner
+
+    if obj["organisations"]:
+        from .auditlog import AuditLog
+        from .organisations import fan_out
+
+        auditlog = AuditLog(
+            obj["auditlog"],
+            batch_size=obj["auditlog_batch_size"],
+            batch_interval=obj["auditlog_batch_interval"],
+        )
+
+        def send_organisation(organisation: "Organisation") -> int:
+            runner = ShiftMailRunner(
+                organisation_obj(obj, organisation),
+                auditlog=auditlog,
+                **{**options, **organisation.options},
+            )
+            try:
+                return runner.run()
+            finally:
+                runner.close()
+
+        started = time.monotonic()
+        try:
+            results = fan_out(obj["organisations"], send_organisation, obj["workers"])
+        finally:
+            auditlog.close()
+        report(results, started)
+        return
+
+    runner = ShiftMailRunner(obj, **options)
+    try:
+        runner.run()
+    finally:
+        runner.close()
+
+
+@main.command()
+@shift_mail_options
+@click.option(
+    "--interval",
+    envvar="INTERVAL",
+    type=click.FloatRange(min=0, min_open=True),
+    default=300,
+    help="Seconds between exports",
 )
 @click.option(
-    "--smtp-use-ssl",
-    envvar="SMTP_SSL",
-    type=click.BOOL,
-    default="Connect to SMTP server with SSL",
+    "--jitter",
+    envvar="JITTER",
+    type=click.FloatRange(min=0, max=1),
+    default=0.1,
+    help="Randomly vary the interval by up to this fraction",
 )
-@click.option("--smtp-user", envvar="SMTP_USER", help="Username for SMTP server")
 @click.option(
-    "--smtp-password", envvar="SMTP_PASSWORD", help="Password for SMTP server"
+    "--max-backoff",
+    envvar="MAX_BACKOFF",
+    type=click.FloatRange(min=0),
+    default=3600,
+    help="Maximum seconds to wait after repeated failures",
 )
 @click.option(
-    "--email-from-addr",
-    envvar="EMAIL_FROM_ADDR",
-    help="Email address to send mail from",
+    "--metrics-port",
+    envvar="METRICS_PORT",
+    type=click.IntRange(min=0, max=65535),
+    help="Serve Prometheus metrics over HTTP on this port",
 )
 @click.option(
-    "--email-from-name",
-    envvar="EMAIL_FROM_NAME",
-    default="Vrijwilligers coordinator",
-    help="Name of person sending the email",
+    "--metrics-addr",
+    envvar="METRICS_ADDR",
+    default="",
+    help="Address to serve Prometheus metrics on (default: all addresses)",
 )
 @click.pass_obj
-def send_shift_mails(
+def serve(
     obj: dict[str, str],
-    email_from_addr: str,
-    email_from_name: str,
-    smtp_server: str,
-    smtp_use_ssl: bool,
-    smtp_port: int = 0,
-    smtp_user: str | None = None,
-    smtp_password: str | None = None,
+    interval: float,
+    jitter: float,
+    max_backoff: float,
+    metrics_port: int | None,
+    metrics_addr: str,
+    **options: Any,
 ) -> None:
-    """Send a thank-you mail for new shift assignments"""
+    """Keep running and send shift mails periodically
+
+    The inzetrooster sessions, SMTP connections, compiled templates and
+    audit log are kept open between runs. Stops cleanly on SIGTERM.
+    """
+    from .daemon import Scheduler
+    from .runner import ShiftMailRunner
+
+    if obj["organisations"]:
+        raise click.UsageError("serve does not support --config")
+    metrics_server = None
+    if metrics_port is not None:
+        from .metrics import start_http_server
+
+        metrics_server = start_http_server(metrics_port, metrics_addr)
+    runner = ShiftMailRunner(obj, persistent=True, **options)
+    try:
+        Scheduler(
+            runner.run, interval, jitter=jitter, max_backoff=max_backoff
+        ).run_forever()
+    finally:
+        runner.close()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+
+
+@main.group()
+def audit() -> None:
+    """Maintain the audit log"""
+
+
+@audit.command()
+@click.option(
+    "--retention",
+    type=click.IntRange(min=1),
+    help="Archive entries for shifts more than this many days ago "
+    "(default: --audit-retention, or 365)",
+)
+@click.pass_obj
+def compact(obj: dict, retention: int | None) -> None:
+    """Archive entries for past shifts and shrink the audit log"""
+    from .auditlog import AuditLog
+
+    retention = retention or obj["audit_retention"] or 365
     auditlog = AuditLog(obj["auditlog"])
-    mailer = Mailer(
-        smtp_server=smtp_server,
-        smtp_port=smtp_port,
-        smtp_user=smtp_user,
-        smtp_password=smtp_password,
-        smtp_use_ssl=smtp_use_ssl,
-        from_address=email_from_addr,
-        from_name=email_from_name,
+    try:
+        result = auditlog.compact(obj["audit_archive"], retention)
+    finally:
+        auditlog.close()
+    click.echo(
+        f"Archived {result.archived} entries for shifts before"
+        f" {result.archived_before} to {obj['audit_archive']}",
+        err=True,
     )
+
+
+@audit.command()
+@click.pass_obj
+def requeue(obj: dict) -> None:
+    """Send queued mails that failed too often again"""
+    from .auditlog import AuditLog
+
+    auditlog = AuditLog(obj["auditlog"])
+    try:
+        click.echo(f"Requeued {auditlog.requeue_failed_mails()} mails", err=True)
+    finally:
+        auditlog.close()
+
+
+@audit.command()
+@click.pass_obj
+def purge(obj: dict) -> None:
+    """Remove queued mails that failed too often
+
+    New mails are rendered for their shifts by the next run.
+    """
+    from .auditlog import AuditLog
+
+    auditlog = AuditLog(obj["auditlog"])
     try:
-        with httpx.Client(follow_redirects=True) as client:
-            ir = Inzetrooster(client, obj["org"])
-            ir.login(obj["user"], obj["password"])
-            all_shifts = shifts.parse_csv(ir.export_shifts())
-            shifts.send_shift_mails(auditlog, mailer, all_shifts)
+        click.echo(f"Removed {auditlog.purge_failed_mails()} mails", err=True)
     finally:
         auditlog.close()
 
@@ -128,6 +620,10 @@ def send_shift_mails(
 @click.pass_obj
 def sync_users_from_manegeplan(obj: dict[str, str], manegeplan_export: BinaryIO):
     """Sync users with an export from manegeplan"""
+    from . import users
+
+    if len(obj["orgs"]) > 1 or obj["organisations"]:
+        raise click.UsageError("users can only be synced for one organization")
     logger = structlog.stdlib.get_logger(__name__)
 
     logger.debug("reading manegeplan data", path=manegeplan_export.name)
@@ -141,20 +637,27 @@ def sync_users_from_manegeplan(obj: dict[str, str], manegeplan_export: BinaryIO)
             people.append(person)
     logger.info("finished parsing manegeplan data", user_count=len(people))
 
-    with httpx.Client(follow_redirects=True) as client:
-        ir = Inzetrooster(client, obj["org"])
-        ir.login(obj["user"], obj["password"])
-        existing_people = list(users.parse_csv(ir.export_users()))
-        for person in existing_people:
-            if not person.is_manegeplan_user():
-                # Adding inzetrooster-native people to our list of people to
-                # import will reactive their account.
-                logger.info(
-                    "adding non-manegeplan user to import list", email=person.email
-                )
-                people.append(person)
-        ir.make_all_users_inactive()
-        user_csv = users.create_csv(people)
+    with http_client(obj) as client:
+        ir = login(obj, client)
+        existing_people = users.parse_csv(ir.export_users(include_inactive=True))
+        changes = users.diff_users(people, existing_people)
+        logger.info(
+            "computed user changes",
+            add=len(changes.add),
+            update=len(changes.update),
+            deactivate=len(changes.deactivate),
+            unchanged=len(changes.unchanged),
+        )
+        if not changes:
+            logger.info("users are already in sync")
+            return
+        if changes.deactivate:
+            # Inzetrooster can only deactivate all users at once, after which
+            # everybody who should stay active has to be imported again.
+            ir.make_all_users_inactive()
+            user_csv = users.create_csv(changes.active())
+        else:
+            user_csv = users.create_csv(changes.add + changes.update)
         with open("/tmp/users.csv", "wb") as output:
             output.write(user_csv.encode("utf-8"))
         ir.import_users(user_csv)
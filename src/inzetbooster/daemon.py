@@ -0,0 +1,113 @@
+import random
+import signal
+import threading
+import time
+from typing import Any, Callable
+
+import structlog.stdlib
+
+from . import metrics
+
+logger = structlog.stdlib.get_logger(__name__)
+
+RUNS = metrics.Counter(
+    "inzetbooster_scheduled_runs_total", "Number of scheduled runs", ["result"]
+)
+RUN_SECONDS = metrics.Histogram(
+    "inzetbooster_scheduled_run_duration_seconds",
+    "Duration of scheduled runs",
+    buckets=(1, 5, 10, 30, 60, 120, 300, 600),
+)
+LAST_SUCCESS = metrics.Gauge(
+    "inzetbooster_last_success_timestamp_seconds",
+    "Time of the last successful scheduled run",
+)
+
+
+class Scheduler:
+    """Call a job periodically until stopped.
+
+    The delay between runs is `interval` seconds, randomly varied by up to
+    `jitter` (a fraction of the delay) so several daemons do not hit
+    inzetrooster at the same moment. After a failed run the delay doubles
+    for every consecutive failure, up to `max_backoff` seconds.
+    """
+
+    job: Callable[[], Any]
+    interval: float
+    jitter: float
+    max_backoff: float
+    failures: int
+    runs: int
+
+    def __init__(
+        self,
+        job: Callable[[], Any],
+        interval: float,
+        *,
+        jitter: float = 0.1,
+        max_backoff: float = 3600,
+        rng: random.Random | None = None,
+    ):
+        self.job = job
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max(max_backoff, interval)
+        self.failures = 0
+        self.runs = 0
+        self._rng = rng or random.Random()
+        self._stop = threading.Event()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    @property
+    def stopped(self) -> bool:
+        return self._stop.is_set()
+
+    def next_delay(self) -> float:
+        delay = min(self.interval * 2**self.failures, self.max_backoff)
+        return delay * (1 + self._rng.uniform(-self.jitter, self.jitter))
+
+    def run_once(self) -> None:
+        started = time.monotonic()
+        try:
+            with RUN_SECONDS.time():
+                self.job()
+        except Exception:
+            self.failures += 1
+            RUNS.inc(result="failure")
+            logger.exception("scheduled run failed", failures=self.failures)
+        else:
+            self.failures = 0
+            RUNS.inc(result="success")
+            LAST_SUCCESS.set(time.time())
+            logger.info(
+                "scheduled run finished",
+                seconds=round(time.monotonic() - started, 3),
+            )
+        self.runs += 1
+
+    def run_forever(self) -> None:
+        """Run the job until `stop` is called or SIGTERM/SIGINT is received.
+
+        A run that is in progress when the signal arrives is finished first.
+        """
+        previous = {}
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                previous[signum] = signal.signal(signum, self._handle_signal)
+        try:
+            while not self.stopped:
+                self.run_once()
+                delay = self.next_delay()
+                logger.debug("waiting for next run", seconds=round(delay, 1))
+                self._stop.wait(delay)
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+        logger.info("scheduler stopped", runs=self.runs)
+
+    def _handle_signal(self, signum: int, frame: Any) -> None:
+        logger.info("received signal, stopping", signal=signal.Signals(signum).name)
+        self.stop()
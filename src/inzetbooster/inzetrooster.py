@@ -1,160 +1,980 @@
+import asyncio
+import contextlib
+import contextvars
+import csv
 import datetime
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    AsyncIterator,
+    Callable,
+    Iterable,
+    Iterator,
+    TextIO,
+)
 
 import httpx
 import structlog.stdlib
-from bs4 import BeautifulSoup, Tag
+from structlog.contextvars import bind_contextvars
 
+from . import metrics, tracing
+from .parsing import column_indexes, parse_date, parse_time
+from .retry import (
+    IDEMPOTENT,
+    AsyncRetryTransport,
+    CircuitBreaker,
+    RetryPolicy,
+    RetryTransport,
+)
+from .session import Session, SessionStore
+
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup
+
+BASE_URL = "https://inzetrooster.nl"
 CSRF_TOKEN_NAME = "authenticity_token"
 
+# Admin pages that are only loaded to get a CSRF token
+IMPORT_USERS_PAGE = "admin/person_imports/new"
+EXPORT_USERS_PAGE = "admin/people/export"
+DEACTIVATE_USERS_PAGE = "admin/people/destroy/all"
+
+# Ways to split the shift export into several smaller requests
+SHARD_MODES = ("group", "date")
+# Length of a date shard, in days
+DATE_SHARD_DAYS = 28
+DEFAULT_SHARD_CONCURRENCY = 4
+
+# Exports can take a while to generate, so allow for a slow response.
+DEFAULT_TIMEOUT = 30.0
+CONNECT_TIMEOUT = 10.0
+LIMITS = httpx.Limits(max_connections=10, max_keepalive_connections=5)
+
 logger = structlog.stdlib.get_logger(__name__)
 
+REQUEST_SECONDS = metrics.Histogram(
+    "inzetbooster_http_request_duration_seconds",
+    "Time to complete a request to inzetrooster, including the response body",
+    ["method", "endpoint", "status"],
+)
+RESPONSE_BYTES = metrics.Counter(
+    "inzetbooster_http_response_bytes_total",
+    "Number of bytes downloaded from inzetrooster",
+    ["endpoint"],
+)
+
+
+@tracing.traced("html5lib.parse")
+def to_soup(html: str) -> "BeautifulSoup":
+    # bs4 and html5lib are slow to import and only needed for pages that
+    # the fast scanner can not handle.
+    from bs4 import BeautifulSoup
 
-def to_soup(html: str) -> BeautifulSoup:
     return BeautifulSoup(html, "html5lib")
 
 
+def _endpoint(request: httpx.Request) -> str:
+    # Strip the organisation, so all organisations share a metric.
+    parts = request.url.path.strip("/").split("/", 1)
+    return parts[1] if len(parts) == 2 else request.url.path
+
+
+class _MeteredStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """Response body that records the request metrics once it is closed."""
+
+    def __init__(
+        self,
+        stream: httpx.SyncByteStream | httpx.AsyncByteStream,
+        request: httpx.Request,
+        status: int,
+        started: float,
+    ):
+        self._stream = stream
+        self._request = request
+        self._status = status
+        self._started = started
+        self._bytes = 0
+        self._recorded = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        assert isinstance(self._stream, httpx.SyncByteStream)
+        for chunk in self._stream:
+            self._bytes += len(chunk)
+            yield chunk
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        assert isinstance(self._stream, httpx.AsyncByteStream)
+        async for chunk in self._stream:
+            self._bytes += len(chunk)
+            yield chunk
+
+    def _record(self) -> None:
+        if self._recorded:
+            return
+        self._recorded = True
+        endpoint = _endpoint(self._request)
+        finished = time.perf_counter()
+        tracing.record(
+            f"http.{self._request.method} {endpoint}",
+            self._started,
+            finished,
+            status=self._status,
+            bytes=self._bytes,
+        )
+        REQUEST_SECONDS.observe(
+            finished - self._started,
+            method=self._request.method,
+            endpoint=endpoint,
+            status=str(self._status),
+        )
+        RESPONSE_BYTES.inc(self._bytes, endpoint=endpoint)
+
+    def close(self) -> None:
+        assert isinstance(self._stream, httpx.SyncByteStream)
+        try:
+            self._stream.close()
+        finally:
+            self._record()
+
+    async def aclose(self) -> None:
+        assert isinstance(self._stream, httpx.AsyncByteStream)
+        try:
+            await self._stream.aclose()
+        finally:
+            self._record()
+
+
+class MeteredTransport(httpx.BaseTransport):
+    """Transport that records request latency and response size metrics."""
+
+    def __init__(self, transport: httpx.BaseTransport | None = None):
+        self._transport = transport or httpx.HTTPTransport()
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        response = self._transport.handle_request(request)
+        assert isinstance(response.stream, httpx.SyncByteStream)
+        stream = _MeteredStream(response.stream, request, response.status_code, started)
+        if response.is_closed:
+            # The body was already read, for example by a mock transport.
+            stream._bytes = len(response.content)
+            stream._record()
+        else:
+            response.stream = stream
+        return response
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class AsyncMeteredTransport(httpx.AsyncBaseTransport):
+    """Async version of `MeteredTransport`."""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport | None = None):
+        self._transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        started = time.perf_counter()
+        response = await self._transport.handle_async_request(request)
+        assert isinstance(response.stream, httpx.AsyncByteStream)
+        stream = _MeteredStream(response.stream, request, response.status_code, started)
+        if response.is_closed:
+            stream._bytes = len(response.content)
+            stream._record()
+        else:
+            response.stream = stream
+        return response
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def create_client(
+    transport: httpx.BaseTransport | None = None,
+    *,
+    retries: int = 3,
+    timeout: float = DEFAULT_TIMEOUT,
+    breaker: CircuitBreaker | None = None,
+    sleep: Callable[[float], None] = time.sleep,
+) -> httpx.Client:
+    """Create an HTTP client for `Inzetrooster`.
+
+    Failed requests are retried up to `retries` times, a circuit breaker
+    stops sending requests while the server is down, and metrics are
+    recorded for every attempt.
+    """
+    if transport is None:
+        transport = httpx.HTTPTransport(limits=LIMITS)
+    return httpx.Client(
+        transport=RetryTransport(
+            MeteredTransport(transport), RetryPolicy(retries), breaker, sleep
+        ),
+        timeout=httpx.Timeout(timeout, connect=CONNECT_TIMEOUT),
+        follow_redirects=True,
+    )
+
+
+class _ByteStream(io.RawIOBase):
+    """Read-only file object for an iterator of byte chunks."""
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: Any) -> int:
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
 class Inzetrooster:
+    """Client for the inzetrooster admin pages.
+
+    With a `SessionStore` the session cookies and CSRF token are kept
+    between runs, so `login` does not have to talk to the server. If the
+    server has expired the session it redirects to the login page, in which
+    case we log in again and retry the request.
+    """
+
     client: httpx.Client
     organisation: str
+    base_url: str
     is_logged_in: bool
+    session_store: SessionStore | None
+    csrf_token: str | None
+    _credentials: tuple[str, str] | None
 
-    def __init__(self, client: httpx.Client, organisation: str):
+    def __init__(
+        self,
+        client: httpx.Client,
+        organisation: str,
+        session_store: SessionStore | None = None,
+        base_url: str = BASE_URL,
+    ):
         self.client = client
         self.organisation = organisation
+        self.base_url = base_url
         self.is_logged_in = False
+        self.session_store = session_store
+        self.csrf_token = None
+        self._credentials = None
+
+    def _url(self, path: str) -> str:
+        return f"{self.base_url}/{self.organisation}/{path}"
 
+    def _is_login_page(self, r: httpx.Response) -> bool:
+        if r.is_redirect:
+            return r.headers.get("location", "").endswith(f"/{self.organisation}/login")
+        return r.url.path.endswith(f"/{self.organisation}/login")
+
+    @tracing.traced("inzetrooster.login")
     def login(self, username: str, password: str) -> None:
+        self._credentials = (username, password)
+        if self.session_store is not None:
+            session = self.session_store.load(self.organisation, username)
+            if session is not None:
+                session.restore(self.client.cookies)
+                self.csrf_token = session.csrf_token
+                self.is_logged_in = True
+                logger.info("reusing stored session", username=username)
+                return
+        self._login()
+
+    def _login(self) -> None:
+        assert self._credentials is not None
+        username, password = self._credentials
+        self.client.cookies.clear()
         logger.debug("Fetching login page")
-        r = self.client.get(f"https://inzetrooster.nl/{self.organisation}/login")
+        r = self.client.get(self._url("login"))
         csrf_token = get_csrf(html=r.text)
         logger.debug("got CSRF token for login page", token=csrf_token)
 
         r = self.client.post(
-            f"https://inzetrooster.nl/{self.organisation}/login",
+            self._url("login"),
             data={
                 CSRF_TOKEN_NAME: csrf_token,
                 "username": username,
                 "password": password,
             },
+            extensions={IDEMPOTENT: True},
         )
         self.is_logged_in = "Geen geldige gebruikersnaam" not in r.text
         if not self.is_logged_in:
             logger.error("login failed", username=username)
             raise ValueError("invalid credentials")
         logger.info("login succeeded", username=username)
+        try:
+            self.csrf_token = get_csrf(html=r.text)
+        except ValueError:
+            self.csrf_token = None
+        self._save_session()
+
+    def _save_session(self) -> None:
+        if self.session_store is not None and self._credentials is not None:
+            self.session_store.save(
+                self.organisation,
+                self._credentials[0],
+                Session.capture(self.client.cookies, self.csrf_token),
+            )
+
+    def _relogin(self) -> None:
+        if self._credentials is None:
+            raise ValueError("session expired")
+        logger.info("session expired, logging in again")
+        self._login()
+
+    def _get(self, path: str, **kwargs: Any) -> httpx.Response:
+        """Fetch an admin page, logging in again if the session has expired."""
+        r = self.client.get(self._url(path), **kwargs)
+        if self._is_login_page(r):
+            self._relogin()
+            r = self.client.get(self._url(path), **kwargs)
+        return r
 
-    def export_shifts(self) -> str:
+    def _csrf(self, path: str) -> str:
+        """Return a CSRF token for the form on an admin page.
+
+        The session token is used if we have one, so the page does not have
+        to be loaded.
+        """
+        if self.csrf_token is None:
+            self.csrf_token = get_csrf(html=self._get(path).text)
+            self._save_session()
+        return self.csrf_token
+
+    def _submit(
+        self, page: str, path: str, make_data: Callable[[str], dict[str, Any]], **kwargs
+    ) -> httpx.Response:
+        """Submit a form, retrying once if the session or token was rejected."""
+        r = self.client.post(
+            self._url(path),
+            data=make_data(self._csrf(page)),
+            follow_redirects=False,
+            **kwargs,
+        )
+        if r.status_code == 422 or self._is_login_page(r):
+            if self._is_login_page(r):
+                self._relogin()
+            else:
+                logger.info("CSRF token rejected, fetching a new one")
+                self.csrf_token = None
+            r = self.client.post(
+                self._url(path),
+                data=make_data(self._csrf(page)),
+                follow_redirects=False,
+                **kwargs,
+            )
+        return r
+
+    def export_shifts(
+        self,
+        from_date: datetime.date | None = None,
+        to_date: datetime.date | None = None,
+        shard_by: str | None = None,
+        shard_concurrency: int = DEFAULT_SHARD_CONCURRENCY,
+    ) -> str:
+        with self.stream_shifts(from_date, to_date, shard_by, shard_concurrency) as f:
+            return f.read()
+
+    @contextlib.contextmanager
+    def stream_shifts(
+        self,
+        from_date: datetime.date | None = None,
+        to_date: datetime.date | None = None,
+        shard_by: str | None = None,
+        shard_concurrency: int = DEFAULT_SHARD_CONCURRENCY,
+    ) -> Iterator[TextIO]:
+        """Stream the shift export.
+
+        This returns a text stream for the CSV data, which is downloaded
+        while it is being read. The stream is opened with `newline=""` so it
+        can be passed to `csv.reader` directly.
+
+        By default shifts from today up to 52 weeks ahead are exported.
+
+        With `shard_by` set to "group" or "date" the export is requested per
+        group or per date range instead, with up to `shard_concurrency`
+        requests at once. The shards are merged into a single export, ordered
+        by date and time.
+        """
         assert self.is_logged_in, "You must be logged in to export shifts"
         logger.debug("loading export page to get CSRF and group ids")
-        r = self.client.get(
-            f"https://inzetrooster.nl/{self.organisation}/admin/shifts/export",
+        with tracing.span("inzetrooster.export_page"):
+            r = self._get("admin/shifts/export", follow_redirects=False)
+            assert r.status_code == 200
+            data = _export_shifts_form(r.text, from_date, to_date)
+        if shard_by is not None:
+            yield io.StringIO(
+                self._export_shards(data, shard_by, shard_concurrency), newline=""
+            )
+            return
+        logger.info("requesting CSV export", data=data)
+        with self.client.stream(
+            "POST",
+            self._url("admin/shifts/export.csv"),
+            data=data,
             follow_redirects=False,
+            extensions={IDEMPOTENT: True},
+        ) as r:
+            assert r.status_code == 200, "Export must return a 200 response"
+            assert r.headers["content-type"] == "text/csv", "Response must be CSV"
+            yield io.TextIOWrapper(
+                _ByteStream(r.iter_bytes()),
+                encoding=r.encoding or "utf-8",
+                newline="",
+            )
+
+    def _export_shard(self, shard: str, data: dict[str, Any]) -> str:
+        started = time.perf_counter()
+        with tracing.span("inzetrooster.export_shard", shard=shard):
+            r = self.client.post(
+                self._url("admin/shifts/export.csv"),
+                data=data,
+                follow_redirects=False,
+                extensions={IDEMPOTENT: True},
+            )
+        assert r.status_code == 200, "Export must return a 200 response"
+        assert r.headers["content-type"] == "text/csv", "Response must be CSV"
+        logger.info(
+            "exported shard",
+            shard=shard,
+            seconds=round(time.perf_counter() - started, 3),
+            bytes=len(r.content),
         )
-        assert r.status_code == 200
+        return r.text
 
-        export_soup = to_soup(r.text)
-        from_date = datetime.date.today()
-        to_date = from_date + datetime.timedelta(weeks=52)
-        data = {
-            CSRF_TOKEN_NAME: get_csrf(soup=export_soup),
-            "from_date": from_date.strftime("%Y-%m-%d"),
-            "to_date": to_date.strftime("%Y-%m-%d"),
-            "days[]": [str(d + 1) for d in range(7)],
-            "group_ids[]": [
-                tag.attrs["value"]
-                for tag in export_soup.find("select", {"name": "group_ids[]"}).find_all(
-                    "option"
+    def _export_shards(
+        self, data: dict[str, Any], shard_by: str, concurrency: int
+    ) -> str:
+        shards = _shard_export_form(data, shard_by)
+        logger.info("requesting sharded CSV export", shards=len(shards))
+        with ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="export"
+        ) as executor:
+            # Run every shard in a copy of our context, so logs and spans
+            # are tagged with the organisation.
+            futures = [
+                executor.submit(
+                    contextvars.copy_context().run, self._export_shard, name, form
                 )
-            ],
-            "button": "",
-        }
-        logger.info("requesting CSV export", data=data)
-        r = self.client.post(
-            f"https://inzetrooster.nl/{self.organisation}/admin/shifts/export.csv",
+                for name, form in shards
+            ]
+            return _merge_exports([future.result() for future in futures])
+
+    @tracing.traced("inzetrooster.import_users")
+    def import_users(self, csv_data: str) -> None:
+        assert self.is_logged_in, "You must be logged in to manage inactive users"
+        files = {"person_import[file]": ("users.csv", csv_data, "text/csv")}
+        r = self._submit(
+            IMPORT_USERS_PAGE,
+            "admin/person_imports",
+            lambda token: {CSRF_TOKEN_NAME: token},
+            files=files,
+        )
+        assert r.status_code == 302, "Export must return a 302 response"
+        assert r.headers["location"] == self._url("admin")
+
+    @tracing.traced("inzetrooster.export_users")
+    def export_users(self, include_inactive: bool = False) -> str:
+        assert self.is_logged_in, "You must be logged in to manage inactive users"
+        r = self._submit(
+            EXPORT_USERS_PAGE,
+            "admin/people/export.csv",
+            lambda token: _export_users_form(token, include_inactive),
+            extensions={IDEMPOTENT: True},
+        )
+        assert r.status_code == 200, "Export must return a 200 response"
+        assert r.headers["content-type"] == "text/csv", "Response must be CSV"
+        return r.text
+
+    @tracing.traced("inzetrooster.make_all_users_inactive")
+    def make_all_users_inactive(self) -> None:
+        assert self.is_logged_in, "You must be logged in to manage inactive users"
+        r = self._submit(
+            DEACTIVATE_USERS_PAGE,
+            DEACTIVATE_USERS_PAGE,
+            lambda token: {CSRF_TOKEN_NAME: token, "people_set_all": "inactive"},
+        )
+        assert r.status_code == 302, "Export must return a 302 response"
+
+
+class AsyncInzetrooster:
+    """Asynchronous version of `Inzetrooster`.
+
+    All methods are coroutines, so independent requests can run concurrently,
+    for example exports for several organisations over one connection pool.
+    Pages that are only fetched for their CSRF token can be loaded up front
+    with `prefetch_csrf`. Sessions are kept in the `SessionStore` the same
+    way as by `Inzetrooster`.
+    """
+
+    client: httpx.AsyncClient
+    organisation: str
+    is_logged_in: bool
+    session_store: SessionStore | None
+    _csrf_tokens: dict[str, str]
+    _credentials: tuple[str, str] | None
+
+    def __init__(
+        self,
+        client: httpx.AsyncClient,
+        organisation: str,
+        base_url: str = BASE_URL,
+        session_store: SessionStore | None = None,
+    ):
+        self.client = client
+        self.organisation = organisation
+        self.base_url = base_url
+        self.is_logged_in = False
+        self.session_store = session_store
+        self._csrf_tokens = {}
+        self._credentials = None
+
+    def _url(self, path: str) -> str:
+        return f"{self.base_url}/{self.organisation}/{path}"
+
+    def _is_login_page(self, r: httpx.Response) -> bool:
+        if r.is_redirect:
+            return r.headers.get("location", "").endswith(f"/{self.organisation}/login")
+        return r.url.path.endswith(f"/{self.organisation}/login")
+
+    async def _get(self, path: str, **kwargs: Any) -> httpx.Response:
+        """Fetch an admin page, logging in again if the session has expired."""
+        r = await self.client.get(self._url(path), **kwargs)
+        if self._is_login_page(r):
+            if self._credentials is None:
+                raise ValueError("session expired")
+            logger.info("session expired, logging in again")
+            await self._login()
+            r = await self.client.get(self._url(path), **kwargs)
+        return r
+
+    async def _fetch_csrf(self, path: str) -> str:
+        r = await self._get(path)
+        return get_csrf(html=r.text)
+
+    async def _csrf(self, path: str) -> str:
+        if (token := self._csrf_tokens.pop(path, None)) is not None:
+            return token
+        return await self._fetch_csrf(path)
+
+    async def prefetch_csrf(self, *paths: str) -> None:
+        """Concurrently fetch the CSRF tokens for the given admin pages.
+
+        Tokens are tied to the session, so this must be done after logging in.
+        """
+        assert self.is_logged_in, "You must be logged in to fetch CSRF tokens"
+        tokens = await asyncio.gather(*(self._fetch_csrf(path) for path in paths))
+        self._csrf_tokens.update(zip(paths, tokens))
+
+    async def login(self, username: str, password: str) -> None:
+        self._credentials = (username, password)
+        if self.session_store is not None:
+            session = self.session_store.load(self.organisation, username)
+            if session is not None:
+                session.restore(self.client.cookies)
+                self.is_logged_in = True
+                logger.info("reusing stored session", username=username)
+                return
+        await self._login()
+
+    async def _login(self) -> None:
+        assert self._credentials is not None
+        username, password = self._credentials
+        self.client.cookies.clear()
+        logger.debug("Fetching login page")
+        r = await self.client.get(self._url("login"))
+        csrf_token = get_csrf(html=r.text)
+        logger.debug("got CSRF token for login page", token=csrf_token)
+
+        r = await self.client.post(
+            self._url("login"),
+            data={
+                CSRF_TOKEN_NAME: csrf_token,
+                "username": username,
+                "password": password,
+            },
+            extensions={IDEMPOTENT: True},
+        )
+        self.is_logged_in = "Geen geldige gebruikersnaam" not in r.text
+        if not self.is_logged_in:
+            logger.error("login failed", username=username)
+            raise ValueError("invalid credentials")
+        self._csrf_tokens = {}
+        logger.info("login succeeded", username=username)
+        if self.session_store is not None:
+            try:
+                csrf_token = get_csrf(html=r.text)
+            except ValueError:
+                csrf_token = None
+            self.session_store.save(
+                self.organisation,
+                username,
+                Session.capture(self.client.cookies, csrf_token),
+            )
+
+    async def export_shifts(
+        self,
+        from_date: datetime.date | None = None,
+        to_date: datetime.date | None = None,
+        shard_by: str | None = None,
+        shard_concurrency: int = DEFAULT_SHARD_CONCURRENCY,
+    ) -> str:
+        assert self.is_logged_in, "You must be logged in to export shifts"
+        logger.debug("loading export page to get CSRF and group ids")
+        r = await self._get("admin/shifts/export", follow_redirects=False)
+        assert r.status_code == 200
+
+        data = _export_shifts_form(r.text, from_date, to_date)
+        if shard_by is None:
+            logger.info("requesting CSV export", data=data)
+            return await self._export_shard(None, data)
+
+        shards = _shard_export_form(data, shard_by)
+        logger.info("requesting sharded CSV export", shards=len(shards))
+        semaphore = asyncio.Semaphore(shard_concurrency)
+
+        async def export_shard(shard: str, data: dict[str, Any]) -> str:
+            async with semaphore:
+                return await self._export_shard(shard, data)
+
+        exports = await asyncio.gather(
+            *(export_shard(shard, data) for shard, data in shards)
+        )
+        return _merge_exports(exports)
+
+    async def _export_shard(self, shard: str | None, data: dict[str, Any]) -> str:
+        started = time.perf_counter()
+        r = await self.client.post(
+            self._url("admin/shifts/export.csv"),
             data=data,
             follow_redirects=False,
+            extensions={IDEMPOTENT: True},
         )
         assert r.status_code == 200, "Export must return a 200 response"
         assert r.headers["content-type"] == "text/csv", "Response must be CSV"
+        if shard is not None:
+            logger.info(
+                "exported shard",
+                shard=shard,
+                seconds=round(time.perf_counter() - started, 3),
+                bytes=len(r.content),
+            )
         return r.text
 
-    def import_users(self, csv_data: str) -> None:
+    async def import_users(self, csv_data: str) -> None:
         assert self.is_logged_in, "You must be logged in to manage inactive users"
-        r = self.client.get(
-            f"https://inzetrooster.nl/{self.organisation}/admin/person_imports/new"
-        )
         data = {
-            CSRF_TOKEN_NAME: get_csrf(html=r.text),
+            CSRF_TOKEN_NAME: await self._csrf(IMPORT_USERS_PAGE),
         }
         files = {"person_import[file]": ("users.csv", csv_data, "text/csv")}
-        r = self.client.post(
-            f"https://inzetrooster.nl/{self.organisation}/admin/person_imports",
+        r = await self.client.post(
+            self._url("admin/person_imports"),
             data=data,
             files=files,
             follow_redirects=False,
         )
         assert r.status_code == 302, "Export must return a 302 response"
-        assert (
-            r.headers["location"]
-            == f"https://inzetrooster.nl/{self.organisation}/admin"
-        )
+        assert r.headers["location"] == self._url("admin")
 
-    def export_users(self, include_inactive: bool = False) -> str:
+    async def export_users(self, include_inactive: bool = False) -> str:
         assert self.is_logged_in, "You must be logged in to manage inactive users"
-        r = self.client.get(
-            f"https://inzetrooster.nl/{self.organisation}/admin/people/export"
-        )
-        data = {
-            CSRF_TOKEN_NAME: get_csrf(html=r.text),
-            "group_ids[]": "0",
-            "field[]": [
-                "identity",
-                "first_name",
-                "infix",
-                "last_name",
-                "email",
-                "username",
-                "exempt",
-                "active_date",
-                "inactive_date",
-                "role",
-                "remarks",
-                "last_activity",
-            ],
-        }
-        if include_inactive:
-            data["inactive_people"] = "true"
-        r = self.client.post(
-            f"https://inzetrooster.nl/{self.organisation}/admin/people/export.csv",
+        data = _export_users_form(await self._csrf(EXPORT_USERS_PAGE), include_inactive)
+        r = await self.client.post(
+            self._url("admin/people/export.csv"),
             data=data,
             follow_redirects=False,
+            extensions={IDEMPOTENT: True},
         )
         assert r.status_code == 200, "Export must return a 200 response"
         assert r.headers["content-type"] == "text/csv", "Response must be CSV"
         return r.text
 
-    def make_all_users_inactive(self) -> None:
+    async def make_all_users_inactive(self) -> None:
         assert self.is_logged_in, "You must be logged in to manage inactive users"
-        r = self.client.get(
-            f"https://inzetrooster.nl/{self.organisation}/admin/people/destroy/all"
-        )
         data = {
-            CSRF_TOKEN_NAME: get_csrf(html=r.text),
+            CSRF_TOKEN_NAME: await self._csrf(DEACTIVATE_USERS_PAGE),
             "people_set_all": "inactive",
         }
-        r = self.client.post(
-            f"https://inzetrooster.nl/{self.organisation}/admin/people/destroy/all",
-            data=data,
-            follow_redirects=False,
+        r = await self.client.post(
+            self._url(DEACTIVATE_USERS_PAGE), data=data, follow_redirects=False
         )
         assert r.status_code == 302, "Export must return a 302 response"
 
 
-def get_csrf(*, html: str | None = None, soup: BeautifulSoup | None = None) -> str:
+async def export_shifts_for_organisations(
+    organisations: list[str],
+    username: str,
+    password: str,
+    max_connections: int = 10,
+    transport: httpx.AsyncBaseTransport | None = None,
+    from_date: datetime.date | None = None,
+    to_date: datetime.date | None = None,
+    base_url: str = BASE_URL,
+    shard_by: str | None = None,
+    shard_concurrency: int = DEFAULT_SHARD_CONCURRENCY,
+    retries: int = 3,
+    timeout: float = DEFAULT_TIMEOUT,
+    breaker: CircuitBreaker | None = None,
+    session_store: SessionStore | None = None,
+) -> dict[str, str]:
+    """Export the shifts for several organisations concurrently.
+
+    Every organisation gets its own client, so their session cookies do not
+    clash, but all clients use the same connection pool. Sessions in
+    `session_store` are reused.
+    """
+    if transport is None:
+        transport = httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=LIMITS.max_keepalive_connections,
+            )
+        )
+    transport = AsyncRetryTransport(
+        AsyncMeteredTransport(transport), RetryPolicy(retries), breaker
+    )
+
+    async def export(organisation: str) -> str:
+        bind_contextvars(org=organisation)
+        # Do not close the client: that would close the shared transport.
+        client = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(timeout, connect=CONNECT_TIMEOUT),
+            follow_redirects=True,
+        )
+        ir = AsyncInzetrooster(client, organisation, base_url, session_store)
+        await ir.login(username, password)
+        return await ir.export_shifts(from_date, to_date, shard_by, shard_concurrency)
+
+    async with transport:
+        exports = await asyncio.gather(*(export(org) for org in organisations))
+    return dict(zip(organisations, exports))
+
+
+def _export_shifts_form(
+    html: str,
+    from_date: datetime.date | None = None,
+    to_date: datetime.date | None = None,
+) -> dict[str, Any]:
+    scanner = _PageScanner(select_name="group_ids[]")
+    scanner.scan(html)
+    if scanner.csrf_token is not None and scanner.options:
+        csrf_token = scanner.csrf_token
+        group_ids = scanner.options
+    else:
+        logger.debug("falling back to html5lib to parse export page")
+        export_soup = to_soup(html)
+        csrf_token = get_csrf(soup=export_soup)
+        group_ids = [
+            tag.attrs["value"]
+            for tag in export_soup.find("select", {"name": "group_ids[]"}).find_all(
+                "option"
+            )
+        ]
+    if from_date is None:
+        from_date = datetime.date.today()
+    if to_date is None:
+        to_date = from_date + datetime.timedelta(weeks=52)
+    return {
+        CSRF_TOKEN_NAME: csrf_token,
+        "from_date": from_date.strftime("%Y-%m-%d"),
+        "to_date": to_date.strftime("%Y-%m-%d"),
+        "days[]": [str(d + 1) for d in range(7)],
+        "group_ids[]": group_ids,
+        "button": "",
+    }
+
+
+def _shard_export_form(
+    data: dict[str, Any], shard_by: str
+) -> list[tuple[str, dict[str, Any]]]:
+    """Split a shift export form into one form per group or date range."""
+    if shard_by == "group":
+        return [
+            (f"group {group_id}", {**data, "group_ids[]": [group_id]})
+            for group_id in data["group_ids[]"]
+        ]
+    if shard_by == "date":
+        from_date = datetime.date.fromisoformat(data["from_date"])
+        to_date = datetime.date.fromisoformat(data["to_date"])
+        shards = []
+        while from_date <= to_date:
+            last = min(
+                from_date + datetime.timedelta(days=DATE_SHARD_DAYS - 1), to_date
+            )
+            shards.append(
+                (
+                    f"{from_date} - {last}",
+                    {
+                        **data,
+                        "from_date": from_date.strftime("%Y-%m-%d"),
+                        "to_date": last.strftime("%Y-%m-%d"),
+                    },
+                )
+            )
+            from_date = last + datetime.timedelta(days=1)
+        return shards
+    raise ValueError(f"unknown shard mode {shard_by!r}")
+
+
+SHARD_ORDER_COLUMNS = ("Dienst_id", "Datum", "Starttijd")
+
+
+def _merge_exports(exports: list[str]) -> str:
+    """Merge shift exports into one, ordered by date, time and shift id.
+
+    Shifts that are in more than one export are only included once.
+    """
+    header: list[str] | None = None
+    rows: dict[str, tuple[datetime.date, datetime.time, int, list[str]]] = {}
+    for export in exports:
+        reader = csv.reader(io.StringIO(export, newline=""), dialect=csv.unix_dialect)
+        shard_header = next(reader, None)
+        if shard_header is None:
+            continue
+        if header is None:
+            header = shard_header
+            id_column, date_column, start_column = column_indexes(
+                header, SHARD_ORDER_COLUMNS
+            )
+        # Shards should have the same columns, but do not rely on the order.
+        reorder = None
+        if shard_header != header:
+            reorder = column_indexes(shard_header, tuple(header))
+        for row in reader:
+            if not row:
+                continue
+            if reorder is not None:
+                row = [row[i] for i in reorder]
+            shift_id = row[id_column]
+            rows[shift_id] = (
+                parse_date(row[date_column]),
+                parse_time(row[start_column]),
+                int(shift_id),
+                row,
+            )
+    if header is None:
+        return ""
+    output = io.StringIO(newline="")
+    writer = csv.writer(output, dialect=csv.unix_dialect)
+    writer.writerow(header)
+    writer.writerows(row for *_, row in sorted(rows.values()))
+    return output.getvalue()
+
+
+def _export_users_form(csrf_token: str, include_inactive: bool) -> dict[str, Any]:
+    data: dict[str, Any] = {
+        CSRF_TOKEN_NAME: csrf_token,
+        "group_ids[]": "0",
+        "field[]": [
+            "identity",
+            "first_name",
+            "infix",
+            "last_name",
+            "email",
+            "username",
+            "exempt",
+            "active_date",
+            "inactive_date",
+            "role",
+            "remarks",
+            "last_activity",
+        ],
+    }
+    if include_inactive:
+        data["inactive_people"] = "true"
+    return data
+
+
+class _StopScanning(Exception):
+    pass
+
+
+class _PageScanner(HTMLParser):
+    """Extract the CSRF token, and optionally the options of a select, from a page.
+
+    This is a lot cheaper than building a full html5lib tree. When only the
+    CSRF token is needed scanning stops at the `csrf-token` meta tag, which
+    is normally in the page head.
+    """
+
+    select_name: str | None
+    csrf_meta: str | None
+    csrf_input: str | None
+    options: list[str]
+    _in_select: bool
+
+    def __init__(self, select_name: str | None = None):
+        super().__init__()
+        self.select_name = select_name
+        self.csrf_meta = None
+        self.csrf_input = None
+        self.options = []
+        self._in_select = False
+
+    @property
+    def csrf_token(self) -> str | None:
+        return self.csrf_meta if self.csrf_meta is not None else self.csrf_input
+
+    def scan(self, html: str) -> None:
+        try:
+            self.feed(html)
+            self.close()
+        except _StopScanning:
+            pass
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:
+        if tag == "meta":
+            attributes = dict(attrs)
+            if attributes.get("name") == "csrf-token" and self.csrf_meta is None:
+                self.csrf_meta = attributes.get("content")
+                if self.select_name is None:
+                    raise _StopScanning()
+        elif tag == "input":
+            attributes = dict(attrs)
+            if (
+                attributes.get("type") == "hidden"
+                and attributes.get("name") == CSRF_TOKEN_NAME
+                and self.csrf_input is None
+            ):
+                self.csrf_input = attributes.get("value")
+        elif tag == "select" and self.select_name is not None:
+            self._in_select = dict(attrs).get("name") == self.select_name
+        elif tag == "option" and self._in_select:
+            value = dict(attrs).get("value")
+            if value is not None:
+                self.options.append(value)
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag == "select":
+            self._in_select = False
+
+
+def get_csrf(*, html: str | None = None, soup: "BeautifulSoup | None" = None) -> str:
     assert (html is None) != (soup is None)
     if soup is None:
+        scanner = _PageScanner()
+        scanner.scan(html)
+        if scanner.csrf_token is not None:
+            return scanner.csrf_token
         soup = to_soup(html)
 
+    from bs4 import Tag
+
     tag = soup.find("meta", {"name": "csrf-token"})
     if isinstance(tag, Tag):
         return tag.attrs["content"]
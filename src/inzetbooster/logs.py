@@ -0,0 +1,30 @@
+import structlog
+
+# The settings passed to `configure`, for processes started later
+_settings: tuple[int, bool] | None = None
+
+
+def configure(log_level: int, json: bool) -> None:
+    """Configure structlog for the command line, or a worker process.
+
+    With `json` every event is written as a JSON object, for when the output
+    is not a terminal.
+    """
+    global _settings
+    _settings = (log_level, json)
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(log_level),
+    )
+    if json:
+        structlog.configure(
+            processors=structlog.get_config()["processors"][:-1]
+            + [
+                structlog.processors.dict_tracebacks,
+                structlog.processors.JSONRenderer(),
+            ]
+        )
+
+
+def settings() -> tuple[int, bool] | None:
+    """The logging settings of this process, if it was configured."""
+    return _settings
@@ -1,10 +1,38 @@
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
 from email.message import EmailMessage
 from email.utils import make_msgid, formataddr
 import smtplib
+import threading
+import time
+from typing import Any
+
+import structlog.stdlib
+
+from . import metrics, tracing
+
+logger = structlog.stdlib.get_logger(__name__)
+
+SMTP_SEND_SECONDS = metrics.Histogram(
+    "inzetbooster_smtp_send_duration_seconds", "Time to send a mail over SMTP"
+)
+SMTP_FAILURES = metrics.Counter(
+    "inzetbooster_smtp_failures_total",
+    "Number of failed SMTP operations",
+    ["error"],
+)
+SMTP_CONNECTIONS = metrics.Counter(
+    "inzetbooster_smtp_connections_total", "Number of SMTP connections opened"
+)
 
 
 class Mailer:
-    server: smtplib.SMTP
+    smtp: smtplib.SMTP
+    smtp_server: str
+    smtp_port: int
+    smtp_use_ssl: bool
+    smtp_user: str | None
+    smtp_password: str | None
     from_address: str
     from_name: str | None
 
@@ -21,20 +49,180 @@ class Mailer:
     ):
         self.from_address = from_address
         self.from_name = from_name
-        if smtp_use_ssl:
-            self.smtp = smtplib.SMTP_SSL(host=smtp_server, port=smtp_port, timeout=5)
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.smtp_use_ssl = smtp_use_ssl
+        self.smtp_user = smtp_user
+        self.smtp_password = smtp_password
+        self._connect()
+
+    @tracing.traced("smtp.connect")
+    def _connect(self) -> None:
+        SMTP_CONNECTIONS.inc()
+        try:
+            self._open()
+        except Exception as e:
+            SMTP_FAILURES.inc(error=type(e).__name__)
+            raise
+
+    def _open(self) -> None:
+        if self.smtp_use_ssl:
+            self.smtp = smtplib.SMTP_SSL(
+                host=self.smtp_server, port=self.smtp_port, timeout=5
+            )
         else:
-            self.smtp = smtplib.SMTP(host=smtp_server, port=smtp_port, timeout=5)
-        if smtp_user and smtp_password:
-            self.smtp.login(smtp_user, smtp_password)
+            self.smtp = smtplib.SMTP(
+                host=self.smtp_server, port=self.smtp_port, timeout=5
+            )
+        if self.smtp_user and self.smtp_password:
+            self.smtp.login(self.smtp_user, self.smtp_password)
+
+    def close(self) -> None:
+        try:
+            self.smtp.quit()
+        except smtplib.SMTPServerDisconnected:
+            pass
+
+    @tracing.traced("smtp.send")
+    def send(
+        self,
+        to_addr: str,
+        to_name: str,
+        subject: str,
+        html: str,
+        msg_id: str | None = None,
+    ) -> str:
+        """Send a mail, returning its message id.
 
-    def send(self, to_addr: str, to_name: str, subject: str, html: str) -> str:
+        Pass `msg_id` to send the mail again with the same message id.
+        """
         message = EmailMessage()
         message["From"] = formataddr((self.from_name, self.from_address))
         message["To"] = formataddr((to_name, to_addr))
         message["Subject"] = subject
-        msg_id = make_msgid()
+        if msg_id is None:
+            msg_id = make_msgid()
         message["Message-Id"] = msg_id
         message.set_content(html, subtype="html")
-        self.smtp.send_message(message, from_addr=self.from_address, to_addrs=[to_addr])
+        with SMTP_SEND_SECONDS.time():
+            try:
+                self._send_message(message, to_addr)
+            except smtplib.SMTPServerDisconnected:
+                logger.info("SMTP server disconnected, reconnecting")
+                self._connect()
+                self._send_message(message, to_addr)
         return msg_id
+
+    def _send_message(self, message: EmailMessage, to_addr: str) -> None:
+        try:
+            self.smtp.send_message(
+                message, from_addr=self.from_address, to_addrs=[to_addr]
+            )
+        except Exception as e:
+            SMTP_FAILURES.inc(error=type(e).__name__)
+            raise
+
+
+class RateLimiter:
+    """Spread calls evenly so no more than `rate` happen per second."""
+
+    interval: float
+    _next: float
+    _lock: threading.Lock
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class MailerPool:
+    """Send mails concurrently over several SMTP connections.
+
+    Every worker thread lazily opens its own `Mailer` connection and keeps
+    it open until the pool is closed. The keyword arguments are passed on
+    to `Mailer`.
+    """
+
+    size: int
+    rate_limiter: RateLimiter | None
+
+    def __init__(
+        self, *, size: int = 4, rate_limit: float | None = None, **kwargs: Any
+    ):
+        self.size = size
+        self.rate_limiter = RateLimiter(rate_limit) if rate_limit else None
+        self._mailer_kwargs = kwargs
+        self._executor = ThreadPoolExecutor(size, thread_name_prefix="smtp")
+        self._local = threading.local()
+        self._mailers: list[Mailer] = []
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "MailerPool":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        for mailer in self._mailers:
+            mailer.close()
+        self._mailers = []
+
+    def _mailer(self) -> Mailer:
+        mailer = getattr(self._local, "mailer", None)
+        if mailer is None:
+            mailer = self._local.mailer = Mailer(**self._mailer_kwargs)
+            with self._lock:
+                self._mailers.append(mailer)
+        return mailer
+
+    def _send(
+        self,
+        to_addr: str,
+        to_name: str,
+        subject: str,
+        html: str,
+        msg_id: str | None = None,
+    ) -> str:
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait()
+        return self._mailer().send(
+            to_addr=to_addr, to_name=to_name, subject=subject, html=html, msg_id=msg_id
+        )
+
+    def submit(
+        self,
+        to_addr: str,
+        to_name: str,
+        subject: str,
+        html: str,
+        msg_id: str | None = None,
+    ) -> Future:
+        """Queue a mail for sending. The future resolves to the message id.
+
+        The mail is sent with the logging context of the caller.
+        """
+        context = contextvars.copy_context()
+        return self._executor.submit(
+            context.run, self._send, to_addr, to_name, subject, html, msg_id
+        )
+
+    def send(
+        self,
+        to_addr: str,
+        to_name: str,
+        subject: str,
+        html: str,
+        msg_id: str | None = None,
+    ) -> str:
+        return self.submit(to_addr, to_name, subject, html, msg_id).result()
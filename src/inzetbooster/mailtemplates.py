@@ -0,0 +1,184 @@
+import fnmatch
+import hashlib
+import importlib.metadata
+import re
+from pathlib import Path
+from typing import Any, Callable
+
+import jinja2
+import structlog.stdlib
+
+from . import tracing
+from .paths import write_atomic
+
+logger = structlog.stdlib.get_logger(__name__)
+
+JINJA_TAG = re.compile(r"{{.*?}}|{%.*?%}|{#.*?#}", re.DOTALL)
+
+try:
+    MJML_VERSION = importlib.metadata.version("mjml-python")
+except importlib.metadata.PackageNotFoundError:  # pragma: no cover
+    MJML_VERSION = "unknown"
+
+
+@tracing.traced("mjml.compile")
+def mjml2html(mjml: str) -> str:
+    # mjml is only imported when needed: with a warm template cache it is
+    # not used at all.
+    from mjml import mjml2html
+
+    return mjml2html(mjml)
+
+
+class CompiledTemplates:
+    """Render MJML mail templates without running MJML for every mail.
+
+    The MJML compiler only cares about the markup, not about the Jinja
+    expressions inside it, so we compile the raw template source to HTML
+    once and use the result as the Jinja template. The compiled HTML is
+    stored on disk, keyed by a hash of the template source and the MJML
+    version, so later runs can skip MJML entirely. The Jinja bytecode for
+    the compiled HTML is stored next to it.
+
+    If MJML mangles any of the Jinja tags in a template we fall back to
+    rendering the MJML for every mail.
+
+    The available templates are listed once, so templates that do not exist
+    are rejected without asking the loader again. Long-running processes
+    should call `refresh` to pick up changed, new or removed templates.
+    """
+
+    env: jinja2.Environment
+    cache_dir: Path | None
+    bytecode_cache: jinja2.BytecodeCache | None
+    _names: frozenset[str] | None
+    _templates: dict[str, jinja2.Template | None]
+    _missing: set[str]
+    _uptodate: dict[str, Callable[[], bool]]
+
+    def __init__(self, env: jinja2.Environment, cache_dir: Path | None = None):
+        self.env = env
+        self.cache_dir = cache_dir
+        self.bytecode_cache = None
+        if cache_dir is not None:
+            self.bytecode_cache = jinja2.FileSystemBytecodeCache(str(cache_dir))
+        self._names = None
+        self._templates = {}
+        self._missing = set()
+        self._uptodate = {}
+
+    @property
+    def names(self) -> frozenset[str]:
+        """Names of all available templates."""
+        if self._names is None:
+            self._names = frozenset(self.env.list_templates())
+        return self._names
+
+    def exists(self, name: str) -> bool:
+        """Check if template `name` exists, remembering it if it does not."""
+        if name in self.names:
+            return True
+        self._missing.add(name)
+        return False
+
+    def is_missing(self, name: str) -> bool:
+        """Check if `name` was already found to not exist."""
+        return name in self._missing
+
+    def preload(self, pattern: str = "shift-*.html") -> None:
+        """Compile all templates matching `pattern` up front."""
+        for name in sorted(fnmatch.filter(self.names, pattern)):
+            self._get(name)
+
+    def refresh(self) -> None:
+        """Forget templates that were added, removed or changed on disk."""
+        names = frozenset(self.env.list_templates())
+        if names != self._names:
+            logger.info("mail templates changed, reloading")
+            self._names = names
+            self._templates = {}
+            self._missing = set()
+            self._uptodate = {}
+            return
+        for name, uptodate in list(self._uptodate.items()):
+            if not uptodate():
+                logger.info("mail template changed, reloading", template=name)
+                del self._templates[name]
+                del self._uptodate[name]
+
+    def render(self, name: str, context: dict[str, Any]) -> str:
+        """Render the template `name` to HTML.
+
+        Raises `jinja2.TemplateNotFound` if the template does not exist.
+        """
+        template = self._get(name)
+        if template is None:
+            return mjml2html(self.env.get_template(name).render(context))
+        return template.render(context)
+
+    def _get(self, name: str) -> jinja2.Template | None:
+        if name not in self._templates:
+            if not self.exists(name):
+                raise jinja2.TemplateNotFound(name)
+            self._templates[name] = self._compile(name)
+        return self._templates[name]
+
+    def _compile(self, name: str) -> jinja2.Template | None:
+        if self.env.loader is None:
+            raise jinja2.TemplateNotFound(name)
+        source, _, uptodate = self.env.loader.get_source(self.env, name)
+        if uptodate is not None:
+            self._uptodate[name] = uptodate
+        key = hashlib.sha256(f"{MJML_VERSION}\0{source}".encode("utf-8")).hexdigest()
+        html = self._load(key)
+        if html is None:
+            logger.debug("compiling MJML template", template=name)
+            html = mjml2html(source)
+            if set(JINJA_TAG.findall(html)) != set(JINJA_TAG.findall(source)):
+                logger.warning(
+                    "MJML does not preserve template tags, can not precompile",
+                    template=name,
+                )
+                return None
+            self._store(key, html)
+        return self._from_html(key, html)
+
+    def _from_html(self, key: str, html: str) -> jinja2.Template:
+        """Create a template for compiled HTML, using the bytecode cache.
+
+        `Environment.from_string` always compiles the template, and only
+        templates loaded through the loader use the bytecode cache, so the
+        cache is used directly here.
+        """
+        if self.bytecode_cache is None:
+            return self.env.from_string(html)
+        bucket = self.bytecode_cache.get_bucket(self.env, key, None, html)
+        code = bucket.code
+        if code is None:
+            code = self.env.compile(html)
+            bucket.code = code
+            try:
+                self.bytecode_cache.set_bucket(bucket)
+            except OSError as e:
+                logger.warning("can not store template bytecode", error=e)
+        return self.env.template_class.from_code(
+            self.env, code, self.env.make_globals(None)
+        )
+
+    def _load(self, key: str) -> str | None:
+        if self.cache_dir is None:
+            return None
+        try:
+            return (self.cache_dir / f"{key}.html").read_text(encoding="utf-8")
+        except FileNotFoundError:
+            return None
+
+    def _store(self, key: str, html: str) -> None:
+        if self.cache_dir is None:
+            return
+        path = self.cache_dir / f"{key}.html"
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            write_atomic(path, html)
+        except OSError as e:
+            logger.warning("can not store compiled template", path=str(path), error=e)
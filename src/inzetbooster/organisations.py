@@ -0,0 +1,142 @@
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Iterable
+
+import structlog.stdlib
+from structlog.contextvars import bound_contextvars
+
+if sys.version_info >= (3, 11):
+    import tomllib
+else:  # pragma: no cover
+    import tomli as tomllib
+
+logger = structlog.stdlib.get_logger(__name__)
+
+# Settings that can be given per organisation, or in [defaults]
+OPTIONS = {
+    "smtp_server",
+    "smtp_port",
+    "smtp_use_ssl",
+    "smtp_user",
+    "smtp_password",
+    "email_from_addr",
+    "email_from_name",
+    "template_dir",
+    "shard_export",
+    "digest",
+}
+
+
+@dataclass
+class Organisation:
+    name: str
+    user: str
+    password: str = field(repr=False)
+    options: dict[str, Any] = field(default_factory=dict, repr=False)
+
+
+def load_config(path: Path | str) -> list[Organisation]:
+    """Read the organisations from a TOML configuration file.
+
+    Every organisation is a table in `organisations` with its credentials
+    and optional SMTP settings and template directory. Settings in the
+    `defaults` table apply to all organisations::
+
+        [defaults]
+        smtp_server = "smtp.example.com"
+
+        [organisations.rvliethorp]
+        user = "admin"
+        password = "secret"
+        template_dir = "templates/rvliethorp"
+
+    Relative template directories are relative to the configuration file.
+    """
+    path = Path(path)
+    with open(path, "rb") as f:
+        config = tomllib.load(f)
+    defaults = config.get("defaults", {})
+    organisations = []
+    for name, settings in config.get("organisations", {}).items():
+        settings = {**defaults, **settings}
+        try:
+            user = settings.pop("user")
+            password = settings.pop("password")
+        except KeyError as e:
+            raise ValueError(f"organisation {name} has no {e.args[0]}") from None
+        if unknown := set(settings) - OPTIONS:
+            raise ValueError(
+                f"unknown settings for organisation {name}: {', '.join(sorted(unknown))}"
+            )
+        if "template_dir" in settings:
+            settings["template_dir"] = path.parent / settings["template_dir"]
+        organisations.append(Organisation(name, user, password, settings))
+    if not organisations:
+        raise ValueError(f"no organisations configured in {path}")
+    return organisations
+
+
+@dataclass
+class OrganisationResult:
+    name: str
+    seconds: float = 0.0
+    mails: int | None = None
+    error: BaseException | None = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def fan_out(
+    organisations: Iterable[Organisation],
+    func: Callable[[Organisation], int | None],
+    workers: int = 4,
+) -> list[OrganisationResult]:
+    """Call `func` for every organisation, using at most `workers` threads.
+
+    A failure for one organisation does not stop the others. `func` can
+    return the number of mails sent, which is included in the results.
+    """
+
+    def run(organisation: Organisation) -> OrganisationResult:
+        result = OrganisationResult(organisation.name)
+        started = time.monotonic()
+        with bound_contextvars(org=organisation.name):
+            try:
+                result.mails = func(organisation)
+            except Exception as e:
+                logger.exception("organisation failed")
+                result.error = e
+            result.seconds = time.monotonic() - started
+            logger.info(
+                "organisation finished",
+                seconds=round(result.seconds, 3),
+                mails=result.mails,
+                ok=result.ok,
+            )
+        return result
+
+    with ThreadPoolExecutor(workers, thread_name_prefix="org") as executor:
+        return list(executor.map(run, organisations))
+
+
+def format_summary(results: list[OrganisationResult], seconds: float) -> str:
+    """Format the results as a table, with `seconds` as the total run time."""
+    width = max(len("organisation"), *(len(result.name) for result in results))
+    lines = [f"{'organisation':<{width}}  {'seconds':>8}  {'mails':>6}  status"]
+    for result in results:
+        mails = "-" if result.mails is None else str(result.mails)
+        status = "ok" if result.ok else f"failed: {result.error}"
+        lines.append(
+            f"{result.name:<{width}}  {result.seconds:>8.2f}  {mails:>6}  {status}"
+        )
+    total_mails = sum(result.mails or 0 for result in results)
+    failed = sum(not result.ok for result in results)
+    lines.append(
+        f"{'total':<{width}}  {seconds:>8.2f}  {total_mails:>6}  {failed} failed"
+    )
+    return "\n".join(lines)
@@ -0,0 +1,44 @@
+import datetime
+import functools
+import logging
+from typing import Any
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_date(value: str) -> datetime.date:
+    """Parse a dd-mm-yyyy date.
+
+    Exports contain the same few hundred dates over and over, so results
+    are cached.
+    """
+    if len(value) == 10 and value[2] == "-" and value[5] == "-":
+        try:
+            return datetime.date(int(value[6:]), int(value[3:5]), int(value[:2]))
+        except ValueError:
+            pass
+    return datetime.datetime.strptime(value, "%d-%m-%Y").date()
+
+
+@functools.lru_cache(maxsize=2048)
+def parse_time(value: str) -> datetime.time:
+    """Parse a HH:MM time."""
+    if len(value) == 5 and value[2] == ":":
+        try:
+            return datetime.time(int(value[:2]), int(value[3:]))
+        except ValueError:
+            pass
+    return datetime.datetime.strptime(value, "%H:%M").time()
+
+
+def column_indexes(header: list[str], columns: tuple[str, ...]) -> list[int]:
+    """Resolve the position of all columns in a CSV header."""
+    missing = [column for column in columns if column not in header]
+    if missing:
+        raise ValueError(f"missing CSV columns: {', '.join(missing)}")
+    return [header.index(column) for column in columns]
+
+
+def debug_enabled(logger: Any) -> bool:
+    """Check if debug logging is enabled, to skip building debug events."""
+    is_enabled_for = getattr(logger.bind(), "is_enabled_for", None)
+    return is_enabled_for is None or is_enabled_for(logging.DEBUG)
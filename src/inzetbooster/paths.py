@@ -0,0 +1,38 @@
+import contextlib
+import os
+import tempfile
+from pathlib import Path
+
+
+def cache_home() -> Path:
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "inzetbooster"
+
+
+def default_cache_dir() -> Path:
+    """Directory to store compiled mail templates in."""
+    return cache_home() / "mjml"
+
+
+def default_session_file() -> Path:
+    """File to store inzetrooster sessions in."""
+    return cache_home() / "sessions.json"
+
+
+def write_atomic(path: Path, data: str, mode: int = 0o644) -> None:
+    """Replace `path` with `data` in a single step.
+
+    The data is written to a temporary file of its own in the same directory
+    first, so readers never see a partial file and concurrent writers do not
+    get in each other's way.
+    """
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=".tmp")
+    try:
+        with open(fd, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
@@ -0,0 +1,271 @@
+import multiprocessing
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Iterable
+
+import structlog.stdlib
+
+from . import logs
+from .auditlog import AuditLog
+from .mailer import Mailer, MailerPool
+from .mailtemplates import CompiledTemplates
+from .shifts import (
+    MAILS_SKIPPED,
+    RENDER_SECONDS,
+    Shift,
+    ShiftMail,
+    covered_shift_chunks,
+    create_jinja_environment,
+    deliver_mail,
+    enqueue_mail,
+    render_shift_mail,
+    shift_context,
+)
+
+logger = structlog.stdlib.get_logger(__name__)
+
+_DONE = object()
+
+# Per-process template cache for the render workers
+_templates: CompiledTemplates | None = None
+
+
+def _init_render_worker(
+    template_cache_dir: Path | None,
+    template_dir: Path | None,
+    log_settings: tuple[int, bool] | None,
+) -> None:
+    global _templates
+    # Spawned processes start with the default structlog configuration.
+    if log_settings is not None:
+        logs.configure(*log_settings)
+    _templates = CompiledTemplates(
+        create_jinja_environment(template_dir=template_dir), template_cache_dir
+    )
+    _templates.preload()
+
+
+def _render_in_worker(shift: Shift) -> tuple[ShiftMail | None, float]:
+    # Metrics are not shared between processes, so the render time is
+    # returned to be recorded in the main process.
+    assert _templates is not None
+    started = time.perf_counter()
+    with shift_context(shift):
+        mail = render_shift_mail(_templates, set(), shift)
+    return mail, time.perf_counter() - started
+
+
+class PipelineAborted(Exception):
+    pass
+
+
+@dataclass
+class StageStats:
+    name: str
+    items: int = 0
+    started: float = 0.0
+    finished: float = 0.0
+    max_queue_depth: int = 0
+    _queue_depth_total: int = 0
+    _queue_samples: int = 0
+
+    def sample_queue(self, q: queue.Queue) -> None:
+        depth = q.qsize()
+        self.max_queue_depth = max(self.max_queue_depth, depth)
+        self._queue_depth_total += depth
+        self._queue_samples += 1
+
+    @property
+    def seconds(self) -> float:
+        return self.finished - self.started
+
+    @property
+    def throughput(self) -> float:
+        return self.items / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def mean_queue_depth(self) -> float:
+        if not self._queue_samples:
+            return 0.0
+        return self._queue_depth_total / self._queue_samples
+
+
+class ShiftMailPipeline:
+    """Send shift mails with overlapping filter, render and send stages.
+
+    - the producer filters out uncovered shifts and shifts that were already
+      mailed,
+    - the render stage renders mails in a process pool, since that is CPU
+      bound,
+    - the I/O stage sends the mails and writes the audit log.
+
+    The stages are connected with bounded queues, so a slow SMTP server
+    will not cause all mails to pile up in memory.
+    """
+
+    auditlog: AuditLog
+    mailer: Mailer | MailerPool
+    template_cache_dir: Path | None
+    template_dir: Path | None
+    render_workers: int
+    organisation: str
+    io_workers: int
+    queue_size: int
+    stats: dict[str, StageStats]
+
+    def __init__(
+        self,
+        auditlog: AuditLog,
+        mailer: Mailer | MailerPool,
+        *,
+        template_cache_dir: Path | None = None,
+        template_dir: Path | None = None,
+        render_workers: int = 2,
+        queue_size: int = 64,
+        organisation: str = "",
+    ):
+        self.auditlog = auditlog
+        self.mailer = mailer
+        self.template_cache_dir = template_cache_dir
+        self.template_dir = template_dir
+        self.render_workers = render_workers
+        self.organisation = organisation
+        self.io_workers = mailer.size if isinstance(mailer, MailerPool) else 1
+        self.queue_size = queue_size
+        self.stats = {name: StageStats(name) for name in ["producer", "render", "send"]}
+        self._render_queue: queue.Queue = queue.Queue(queue_size)
+        self._send_queue: queue.Queue = queue.Queue(queue_size)
+        self._abort = threading.Event()
+        self._errors: list[BaseException] = []
+        self._lock = threading.Lock()
+
+    def run(self, shifts: Iterable[Shift]) -> dict[str, StageStats]:
+        started = time.monotonic()
+        for stats in self.stats.values():
+            stats.started = started
+        threads = [
+            threading.Thread(
+                target=self._stage, args=("producer", self._produce, shifts)
+            ),
+            threading.Thread(target=self._stage, args=("render", self._render)),
+        ] + [
+            threading.Thread(target=self._stage, args=("send", self._send))
+            for _ in range(self.io_workers)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self._report()
+        if self._errors:
+            raise self._errors[0]
+        return self.stats
+
+    def _stage(self, name: str, func: Any, *args: Any) -> None:
+        try:
+            func(*args)
+        except PipelineAborted:
+            pass
+        except BaseException as e:
+            logger.exception("shift mail pipeline failed", stage=name)
+            self._errors.append(e)
+            self._abort.set()
+        finally:
+            stats = self.stats[name]
+            with self._lock:
+                stats.finished = max(stats.finished, time.monotonic())
+
+    def _put(self, q: queue.Queue, item: Any) -> None:
+        while True:
+            if self._abort.is_set():
+                raise PipelineAborted()
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, q: queue.Queue) -> Any:
+        while True:
+            if self._abort.is_set():
+                raise PipelineAborted()
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def _produce(self, shifts: Iterable[Shift]) -> None:
+        stats = self.stats["producer"]
+        for chunk, sent_mails in covered_shift_chunks(self.auditlog, shifts):
+            for shift in chunk:
+                template_id = f"shift-{shift.group_id}.html"
+                if (shift.id, template_id, shift.user_email) in sent_mails:
+                    with shift_context(shift):
+                        logger.debug("email already send for this shift")
+                    MAILS_SKIPPED.inc(reason="already_sent")
+                    continue
+                self.stats["render"].sample_queue(self._render_queue)
+                self._put(self._render_queue, shift)
+                stats.items += 1
+        self._put(self._render_queue, _DONE)
+
+    def _render(self) -> None:
+        in_flight: deque[Future] = deque()
+        # Do not fork: the other pipeline stages are running in threads.
+        with ProcessPoolExecutor(
+            self.render_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_render_worker,
+            initargs=(self.template_cache_dir, self.template_dir, logs.settings()),
+        ) as executor:
+            while (shift := self._get(self._render_queue)) is not _DONE:
+                in_flight.append(executor.submit(_render_in_worker, shift))
+                if len(in_flight) >= self.render_workers * 2:
+                    self._forward(in_flight.popleft())
+            while in_flight:
+                self._forward(in_flight.popleft())
+        for _ in range(self.io_workers):
+            self._put(self._send_queue, _DONE)
+
+    def _forward(self, future: Future) -> None:
+        mail, seconds = future.result()
+        RENDER_SECONDS.observe(seconds)
+        if mail is None:
+            # Already sent mails are filtered out by the producer.
+            MAILS_SKIPPED.inc(reason="no_template")
+        else:
+            self.stats["render"].items += 1
+            self.stats["send"].sample_queue(self._send_queue)
+            self._put(self._send_queue, mail)
+
+    def _send(self) -> None:
+        stats = self.stats["send"]
+        while (mail := self._get(self._send_queue)) is not _DONE:
+            with shift_context(mail.shift):
+                # The mail is stored in the outbox first, so a failed send
+                # is retried by the next run without rendering it again.
+                queued = enqueue_mail(
+                    self.auditlog, mail, lease=True, organisation=self.organisation
+                )
+                if queued is None:
+                    continue
+                deliver_mail(self.auditlog, self.mailer, queued)
+            with self._lock:
+                stats.items += 1
+
+    def _report(self) -> None:
+        for stats in self.stats.values():
+            logger.info(
+                "pipeline stage finished",
+                stage=stats.name,
+                items=stats.items,
+                seconds=round(stats.seconds, 3),
+                items_per_second=round(stats.throughput, 1),
+                max_queue_depth=stats.max_queue_depth,
+                mean_queue_depth=round(stats.mean_queue_depth, 1),
+            )
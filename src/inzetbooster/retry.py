@@ -0,0 +1,252 @@
+import asyncio
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable
+
+import httpx
+import structlog.stdlib
+
+from . import metrics
+
+logger = structlog.stdlib.get_logger(__name__)
+
+RETRIES = metrics.Counter(
+    "inzetbooster_http_retries_total",
+    "Number of requests to inzetrooster that were retried",
+    ["reason"],
+)
+CIRCUIT_OPEN = metrics.Gauge(
+    "inzetbooster_http_circuit_open",
+    "Whether requests to inzetrooster are blocked because it is failing",
+)
+
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+RETRY_STATUSES = frozenset({429, 502, 503, 504})
+# Errors that happen before the request was sent, so it is always safe to
+# send the request again.
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# Request extension to mark a POST as safe to repeat, such as an export.
+IDEMPOTENT = "inzetbooster.idempotent"
+
+
+class CircuitOpenError(httpx.TransportError):
+    """Raised instead of sending a request while the circuit is open."""
+
+
+class CircuitBreaker:
+    """Stop sending requests to a server that keeps failing.
+
+    After `failure_threshold` consecutive failures (transport errors or 5xx
+    responses) the circuit opens and requests fail immediately with
+    `CircuitOpenError`. After `reset_timeout` seconds one trial request is
+    let through: if it succeeds the circuit closes again, otherwise it stays
+    open for another `reset_timeout` seconds. If the outcome of the trial is
+    never recorded, for example because it was cancelled, another trial is
+    let through after `reset_timeout` seconds.
+    """
+
+    failure_threshold: int
+    reset_timeout: float
+    failures: int
+    state: str
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 60,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.state = "closed"
+        self._opened_at = 0.0
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def check(self, request: httpx.Request) -> None:
+        """Raise `CircuitOpenError` if the request may not be sent now."""
+        with self._lock:
+            if self.state == "closed":
+                return
+            now = self._clock()
+            if now - self._opened_at >= self.reset_timeout:
+                logger.info("circuit half-open, sending trial request")
+                self.state = "half-open"
+                self._opened_at = now
+                return
+        raise CircuitOpenError(
+            "inzetrooster is failing, not sending requests", request=request
+        )
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != "closed":
+                logger.info("circuit closed")
+            self.failures = 0
+            self.state = "closed"
+        CIRCUIT_OPEN.set(0)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == "half-open" or (
+                self.state == "closed" and self.failures >= self.failure_threshold
+            ):
+                logger.warning("circuit opened", failures=self.failures)
+                self.state = "open"
+                self._opened_at = self._clock()
+                CIRCUIT_OPEN.set(1)
+
+
+# All clients talk to the same server, so they share a circuit breaker.
+DEFAULT_BREAKER = CircuitBreaker()
+
+
+@dataclass(slots=True)
+class RetryPolicy:
+    """When and how long to wait before sending a request again.
+
+    Requests are retried on transport errors and on responses with a status
+    in `RETRY_STATUSES`. Requests that are not idempotent are only retried if
+    they could not be sent at all. The delay doubles for every attempt, with
+    full jitter, and a numeric Retry-After header is honoured.
+    """
+
+    retries: int = 3
+    backoff: float = 0.5
+    max_backoff: float = 30
+    rng: random.Random = field(default_factory=random.Random)
+
+    def is_idempotent(self, request: httpx.Request) -> bool:
+        return request.method in IDEMPOTENT_METHODS or bool(
+            request.extensions.get(IDEMPOTENT)
+        )
+
+    def should_retry(
+        self,
+        request: httpx.Request,
+        attempt: int,
+        *,
+        error: Exception | None = None,
+        status: int | None = None,
+    ) -> bool:
+        if attempt >= self.retries:
+            return False
+        if error is not None:
+            return isinstance(error, NOT_SENT_ERRORS) or self.is_idempotent(request)
+        return status in RETRY_STATUSES and self.is_idempotent(request)
+
+    def delay(self, attempt: int, response: httpx.Response | None = None) -> float:
+        if response is not None:
+            retry_after = response.headers.get("retry-after", "")
+            if retry_after.isdigit():
+                return min(float(retry_after), self.max_backoff)
+        return self.rng.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+
+def _log_retry(request: httpx.Request, reason: str, attempt: int, delay: float) -> None:
+    RETRIES.inc(reason=reason)
+    logger.warning(
+        "retrying inzetrooster request",
+        method=request.method,
+        url=str(request.url),
+        reason=reason,
+        attempt=attempt + 1,
+        delay=round(delay, 2),
+    )
+
+
+class RetryTransport(httpx.BaseTransport):
+    """Transport that retries failed requests and uses a circuit breaker."""
+
+    def __init__(
+        self,
+        transport: httpx.BaseTransport,
+        policy: RetryPolicy | None = None,
+        breaker: CircuitBreaker | None = None,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self._transport = transport
+        self.policy = policy or RetryPolicy()
+        self.breaker = breaker or DEFAULT_BREAKER
+        self._sleep = sleep
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            self.breaker.check(request)
+            try:
+                response = self._transport.handle_request(request)
+            except httpx.TransportError as e:
+                self.breaker.record_failure()
+                if not self.policy.should_retry(request, attempt, error=e):
+                    raise
+                reason = type(e).__name__
+                delay = self.policy.delay(attempt)
+            else:
+                if response.status_code >= 500:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                if not self.policy.should_retry(
+                    request, attempt, status=response.status_code
+                ):
+                    return response
+                reason = str(response.status_code)
+                delay = self.policy.delay(attempt, response)
+                response.close()
+            _log_retry(request, reason, attempt, delay)
+            self._sleep(delay)
+            attempt += 1
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class AsyncRetryTransport(httpx.AsyncBaseTransport):
+    """Async version of `RetryTransport`."""
+
+    def __init__(
+        self,
+        transport: httpx.AsyncBaseTransport,
+        policy: RetryPolicy | None = None,
+        breaker: CircuitBreaker | None = None,
+    ):
+        self._transport = transport
+        self.policy = policy or RetryPolicy()
+        self.breaker = breaker or DEFAULT_BREAKER
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            self.breaker.check(request)
+            try:
+                response = await self._transport.handle_async_request(request)
+            except httpx.TransportError as e:
+                self.breaker.record_failure()
+                if not self.policy.should_retry(request, attempt, error=e):
+                    raise
+                reason = type(e).__name__
+                delay = self.policy.delay(attempt)
+            else:
+                if response.status_code >= 500:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                if not self.policy.should_retry(
+                    request, attempt, status=response.status_code
+                ):
+                    return response
+                reason = str(response.status_code)
+                delay = self.policy.delay(attempt, response)
+                await response.aclose()
+            _log_retry(request, reason, attempt, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
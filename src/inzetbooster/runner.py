@@ -0,0 +1,218 @@
+import asyncio
+import datetime
+import time
+from pathlib import Path
+from typing import Iterable, TextIO
+
+import structlog.stdlib
+from structlog.contextvars import bound_contextvars
+
+from . import shifts, tracing
+from .auditlog import AuditLog
+from .inzetrooster import (
+    Inzetrooster,
+    create_client,
+    export_shifts_for_organisations,
+)
+from .mailer import Mailer, MailerPool
+from .mailtemplates import CompiledTemplates
+
+logger = structlog.stdlib.get_logger(__name__)
+
+# Seconds between automatic compactions of the audit log
+COMPACT_INTERVAL = 24 * 60 * 60
+
+
+class ShiftMailRunner:
+    """Export shifts and send shift mails.
+
+    The audit log, the SMTP connection and the compiled templates are kept
+    open between calls to `run`. With `persistent` every organisation also
+    keeps its own logged in HTTP session, instead of exporting all
+    organisations concurrently with fresh logins.
+
+    An `auditlog` that is passed in is shared with other runners and is not
+    closed by the runner.
+
+    With an `audit_retention` in `obj` the audit log is compacted once a
+    day, after a successful run.
+    """
+
+    def __init__(
+        self,
+        obj: dict,
+        *,
+        email_from_addr: str,
+        email_from_name: str,
+        smtp_server: str,
+        smtp_use_ssl: bool,
+        smtp_connections: int,
+        smtp_rate_limit: float | None,
+        render_workers: int,
+        template_cache: Path,
+        digest: str = "off",
+        incremental: bool,
+        full_refresh_after: float,
+        from_date: datetime.datetime | None,
+        to_date: datetime.datetime | None,
+        shard_export: str | None = None,
+        shard_concurrency: int = 4,
+        smtp_port: int = 0,
+        smtp_user: str | None = None,
+        smtp_password: str | None = None,
+        template_dir: Path | None = None,
+        persistent: bool = False,
+        auditlog: AuditLog | None = None,
+    ):
+        self.obj = obj
+        self.persistent = persistent
+        self.render_workers = render_workers
+        self.digest = digest
+        self.template_cache = template_cache
+        self.template_dir = template_dir
+        self.incremental = incremental
+        self.full_refresh_after = full_refresh_after
+        self.window = {
+            "from_date": from_date.date() if from_date else None,
+            "to_date": to_date.date() if to_date else None,
+            "shard_by": shard_export,
+            "shard_concurrency": shard_concurrency,
+        }
+        self.templates = CompiledTemplates(
+            shifts.create_jinja_environment(template_dir=template_dir), template_cache
+        )
+        if persistent:
+            self.templates.preload()
+            if digest != "off" and self.templates.exists(shifts.DIGEST_TEMPLATE):
+                self.templates.preload(shifts.DIGEST_TEMPLATE)
+        self._inzetroosters: dict[str, Inzetrooster] = {}
+        self._owns_auditlog = auditlog is None
+        if auditlog is None:
+            auditlog = AuditLog(
+                obj["auditlog"],
+                batch_size=obj["auditlog_batch_size"],
+                batch_interval=obj["auditlog_batch_interval"],
+            )
+        self.auditlog = auditlog
+        smtp_options = dict(
+            smtp_server=smtp_server,
+            smtp_port=smtp_port,
+            smtp_user=smtp_user,
+            smtp_password=smtp_password,
+            smtp_use_ssl=smtp_use_ssl,
+            from_address=email_from_addr,
+            from_name=email_from_name,
+        )
+        self.mailer: Mailer | MailerPool
+        try:
+            if smtp_connections > 1 or smtp_rate_limit:
+                self.mailer = MailerPool(
+                    size=smtp_connections, rate_limit=smtp_rate_limit, **smtp_options
+                )
+            else:
+                self.mailer = Mailer(**smtp_options)
+        except BaseException:
+            if self._owns_auditlog:
+                self.auditlog.close()
+            raise
+
+    def close(self) -> None:
+        for ir in self._inzetroosters.values():
+            ir.client.close()
+        self._inzetroosters = {}
+        self.mailer.close()
+        if self._owns_auditlog:
+            self.auditlog.close()
+
+    def _inzetrooster(self, org: str) -> Inzetrooster:
+        ir = self._inzetroosters.get(org)
+        if ir is None:
+            client = create_client(
+                retries=self.obj["http_retries"], timeout=self.obj["http_timeout"]
+            )
+            try:
+                ir = Inzetrooster(
+                    client,
+                    org,
+                    session_store=self.obj["session_store"],
+                    base_url=self.obj["base_url"],
+                )
+                ir.login(self.obj["user"], self.obj["password"])
+            except BaseException:
+                client.close()
+                raise
+            self._inzetroosters[org] = ir
+        return ir
+
+    def run(self) -> int:
+        """Send mails for all organisations, returning the number of mails sent."""
+        if self.persistent:
+            self.templates.refresh()
+        count = 0
+        if len(self.obj["orgs"]) > 1 and not self.persistent:
+            exports = asyncio.run(
+                export_shifts_for_organisations(
+                    self.obj["orgs"],
+                    self.obj["user"],
+                    self.obj["password"],
+                    base_url=self.obj["base_url"],
+                    retries=self.obj["http_retries"],
+                    timeout=self.obj["http_timeout"],
+                    session_store=self.obj["session_store"],
+                    **self.window,
+                )
+            )
+            for org, export in exports.items():
+                with bound_contextvars(org=org), tracing.span("organisation"):
+                    count += self.send(org, export)
+            self.compact()
+            return count
+
+        for org in self.obj["orgs"]:
+            with bound_contextvars(org=org), tracing.span("organisation"):
+                with self._inzetrooster(org).stream_shifts(**self.window) as export:
+                    count += self.send(org, export)
+        self.auditlog.sync()
+        self.compact()
+        return count
+
+    def compact(self) -> None:
+        """Archive old audit log entries, if the last compaction was a day ago."""
+        retention = self.obj["audit_retention"]
+        if retention is None:
+            return
+        last_compacted = self.auditlog.last_compacted()
+        if (
+            last_compacted is not None
+            and time.time() - last_compacted < COMPACT_INTERVAL
+        ):
+            return
+        with tracing.span("auditlog.compact"):
+            result = self.auditlog.compact(self.obj["audit_archive"], retention)
+        logger.info(
+            "compacted audit log",
+            archived=result.archived,
+            archived_before=str(result.archived_before),
+        )
+
+    def send(self, org: str, export: str | TextIO) -> int:
+        all_shifts: Iterable[shifts.Shift] = shifts.parse_csv(export)
+        if self.incremental:
+            snapshot = shifts.ShiftSnapshot(
+                self.auditlog, org, full_refresh_after=self.full_refresh_after * 3600
+            )
+            all_shifts = snapshot.changed(all_shifts)
+        count = shifts.send_shift_mails(
+            self.auditlog,
+            self.mailer,
+            all_shifts,
+            self.template_cache,
+            self.render_workers,
+            templates=self.templates,
+            template_dir=self.template_dir,
+            digest=self.digest,
+            organisation=org,
+        )
+        if self.incremental:
+            snapshot.commit()
+        return count
@@ -0,0 +1,106 @@
+import json
+import threading
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import structlog.stdlib
+
+from .paths import default_session_file, write_atomic
+
+if TYPE_CHECKING:
+    import httpx
+
+logger = structlog.stdlib.get_logger(__name__)
+
+
+@dataclass
+class Session:
+    """Cookies and CSRF token of a logged in inzetrooster session."""
+
+    cookies: list[dict[str, str]] = field(default_factory=list)
+    csrf_token: str | None = None
+
+    @classmethod
+    def capture(cls, cookies: "httpx.Cookies", csrf_token: str | None) -> "Session":
+        return cls(
+            cookies=[
+                {
+                    "name": cookie.name,
+                    "value": cookie.value or "",
+                    "domain": cookie.domain,
+                    "path": cookie.path,
+                }
+                for cookie in cookies.jar
+            ],
+            csrf_token=csrf_token,
+        )
+
+    def restore(self, cookies: "httpx.Cookies") -> None:
+        cookies.clear()
+        for cookie in self.cookies:
+            cookies.set(
+                cookie["name"],
+                cookie["value"],
+                domain=cookie["domain"],
+                path=cookie["path"],
+            )
+
+
+class SessionStore:
+    """Keep inzetrooster sessions on disk, so they can be reused between runs.
+
+    Sessions are stored per organisation and username in a single JSON file,
+    which is only readable by the current user since the cookies give full
+    access to the account.
+    """
+
+    path: Path
+
+    def __init__(self, path: Path | str | None = None):
+        self.path = Path(path) if path is not None else default_session_file()
+        # Organisations log in from several threads.
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(organisation: str, username: str) -> str:
+        return f"{organisation}:{username}"
+
+    def _read(self) -> dict[str, dict]:
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError):
+            logger.warning("could not read session file", path=str(self.path))
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def _write(self, data: dict[str, dict]) -> None:
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            write_atomic(self.path, json.dumps(data), mode=0o600)
+        except OSError:
+            logger.warning("could not write session file", path=str(self.path))
+
+    def load(self, organisation: str, username: str) -> Session | None:
+        session = self._read().get(self._key(organisation, username))
+        if session is None:
+            return None
+        try:
+            return Session(**session)
+        except TypeError:
+            return None
+
+    def save(self, organisation: str, username: str, session: Session) -> None:
+        with self._lock:
+            data = self._read()
+            data[self._key(organisation, username)] = asdict(session)
+            self._write(data)
+
+    def delete(self, organisation: str, username: str) -> None:
+        with self._lock:
+            data = self._read()
+            if data.pop(self._key(organisation, username), None) is not None:
+                self._write(data)
@@ -1,22 +1,85 @@
 import csv
 import datetime
+import functools
+import hashlib
 import io
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, wait
 from dataclasses import dataclass
-from typing import Iterable
+from email.utils import make_msgid
+from pathlib import Path
+from typing import Iterable, Iterator, TextIO
 
 import jinja2
 import structlog.stdlib
 from structlog.contextvars import bound_contextvars
-from babel.dates import format_date
-from mjml import mjml2html
 
-from .auditlog import AuditLog
-from .mailer import Mailer
+from . import metrics, tracing
+from .auditlog import MAX_QUERY_PARAMETERS, OUTBOX_LEASE, AuditLog, QueuedMail
+from .mailer import Mailer, MailerPool
+from .mailtemplates import CompiledTemplates
+from .parsing import column_indexes, debug_enabled, parse_date, parse_time
 
 logger = structlog.stdlib.get_logger(__name__)
 
+SHIFTS_PARSED = metrics.Counter(
+    "inzetbooster_shifts_parsed_total", "Number of shifts read from exports"
+)
+PARSE_SECONDS = metrics.Counter(
+    "inzetbooster_shift_parse_seconds_total",
+    "Time spent reading and parsing shift exports",
+)
+RENDER_SECONDS = metrics.Histogram(
+    "inzetbooster_mail_render_duration_seconds", "Time to render a shift mail"
+)
+MAILS_SENT = metrics.Counter(
+    "inzetbooster_shift_mails_sent_total", "Number of shift mails sent"
+)
+MAILS_SKIPPED = metrics.Counter(
+    "inzetbooster_shift_mails_skipped_total",
+    "Number of shifts for which no mail was sent",
+    ["reason"],
+)
+DIGEST_SHIFTS = metrics.Counter(
+    "inzetbooster_digest_shifts_total", "Number of shifts included in digest mails"
+)
+OUTBOX_DEPTH = metrics.Gauge(
+    "inzetbooster_outbox_mails", "Number of mails waiting in the outbox"
+)
+OUTBOX_AGE = metrics.Gauge(
+    "inzetbooster_outbox_oldest_age_seconds", "Age of the oldest mail in the outbox"
+)
+OUTBOX_FAILED = metrics.Gauge(
+    "inzetbooster_outbox_failed_mails",
+    "Number of mails in the outbox that failed too often to be sent",
+)
 
-@dataclass()
+# off: a mail per shift. all: one mail per volunteer listing all new
+# shifts. same-group: a digest only if all new shifts are in the same group,
+# otherwise a mail per shift with the instructions for that group.
+DIGEST_MODES = ("off", "all", "same-group")
+DIGEST_TEMPLATE = "digest.html"
+
+# Number of queued mails to lease at once
+OUTBOX_BATCH_SIZE = 20
+# Renew the lease on queued mails once a third of it has passed
+LEASE_RENEW_INTERVAL = OUTBOX_LEASE / 3
+
+SHIFT_COLUMNS = (
+    "Dienst_id",
+    "Groep_id",
+    "Groep_naam",
+    "Datum",
+    "Starttijd",
+    "Eindtijd",
+    "Gebruiker_id",
+    "Naam",
+    "Email",
+    "Opmerkingen",
+)
+
+
+@dataclass(frozen=True, slots=True)
 class Shift:
     id: int
     group_id: int
@@ -29,95 +92,632 @@ class Shift:
     user_name: str | None = None
     user_email: str | None = None
 
-    @classmethod
-    def from_record(cls, record: dict[str, str]):
-        logger.debug("parsing CSV record", data=record)
-        return cls(
-            id=int(record["Dienst_id"]),
-            group_id=int(record["Groep_id"]),
-            group_name=record["Groep_naam"],
-            date=datetime.datetime.strptime(record["Datum"], "%d-%m-%Y").date(),
-            start_time=datetime.datetime.strptime(record["Starttijd"], "%H:%M").time(),
-            end_time=datetime.datetime.strptime(record["Eindtijd"], "%H:%M").time(),
-            user_id=record["Gebruiker_id"] if record["Gebruiker_id"] else None,
-            user_name=record["Naam"] if record["Naam"] else None,
-            user_email=record["Email"] if record["Email"] else None,
-            comments=record["Opmerkingen"],
-        )
-
     @property
     def is_covered(self) -> bool:
         return self.user_id is not None
 
+    @property
+    def content_hash(self) -> str:
+        """Hash of the shift data that determines which mails are sent."""
+        data = "\0".join(
+            str(value)
+            for value in (
+                self.group_id,
+                self.group_name,
+                self.date,
+                self.start_time,
+                self.end_time,
+                self.user_id,
+                self.user_name,
+                self.user_email,
+            )
+        )
+        return hashlib.blake2b(data.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class ShiftSnapshot:
+    """Filter out shifts that did not change since the last successful run.
+
+    The content hash of every shift is stored in the audit log. `changed`
+    only passes on shifts whose hash differs from the stored one, and
+    `commit` stores the new and changed hashes. Only call `commit` after all changed
+    shifts have been handled, otherwise a failed mail will never be retried.
+
+    A changed covered shift is only stored if a mail for it was sent or is
+    queued, so shifts that were skipped, for example because their group
+    has no template yet, are looked at again by the next run.
 
-def parse_csv(f: str) -> Iterable[Shift]:
-    reader = csv.DictReader(io.StringIO(f), dialect=csv.unix_dialect)
-    return [Shift.from_record(row) for row in reader]
+    If the last successful run is older than `full_refresh_after` seconds
+    all shifts are passed on, so anything that was missed is picked up.
+    """
 
+    auditlog: AuditLog
+    organisation: str
+    full_refresh: bool
+    _hashes: dict[int, str]
+    _dates: dict[int, datetime.date]
+    _covered: list[Shift]
+
+    def __init__(
+        self,
+        auditlog: AuditLog,
+        organisation: str,
+        full_refresh_after: float | None = 24 * 60 * 60,
+    ):
+        self.auditlog = auditlog
+        self.organisation = organisation
+        watermark = auditlog.watermark(organisation)
+        self.full_refresh = watermark is None or (
+            full_refresh_after is not None
+            and time.time() - watermark > full_refresh_after
+        )
+        self._hashes = {}
+        self._dates = {}
+        self._covered = []
+
+    def changed(self, shifts: Iterable[Shift]) -> Iterator[Shift]:
+        chunk: list[Shift] = []
+        for shift in shifts:
+            chunk.append(shift)
+            if len(chunk) == MAX_QUERY_PARAMETERS:
+                yield from self._changed(chunk)
+                chunk = []
+        yield from self._changed(chunk)
+
+    def _changed(self, shifts: list[Shift]) -> Iterator[Shift]:
+        if not shifts:
+            return
+        with tracing.span("auditlog.shift_hashes"):
+            stored = self.auditlog.shift_hashes(shift.id for shift in shifts)
+        for shift in shifts:
+            content_hash = shift.content_hash
+            if stored.get(shift.id) != content_hash:
+                if shift.is_covered:
+                    self._covered.append(shift)
+                else:
+                    # Signing up changes the hash, so nothing can be missed.
+                    self._hashes[shift.id] = content_hash
+                    self._dates[shift.id] = shift.date
+                yield shift
+            elif self.full_refresh:
+                # The stored hash is still right, it does not need storing.
+                yield shift
+            else:
+                logger.debug("shift did not change, skipping", shift_id=shift.id)
+                MAILS_SKIPPED.inc(reason="unchanged")
+
+    def commit(self) -> None:
+        for i in range(0, len(self._covered), MAX_QUERY_PARAMETERS):
+            chunk = self._covered[i : i + MAX_QUERY_PARAMETERS]
+            mailed = _sent_mails(self.auditlog, chunk)
+            for shift in chunk:
+                if (shift.id, _template_id(shift), shift.user_email) in mailed:
+                    self._hashes[shift.id] = shift.content_hash
+                    self._dates[shift.id] = shift.date
+        self.auditlog.store_shift_hashes(self.organisation, self._hashes, self._dates)
+        self._hashes = {}
+        self._dates = {}
+        self._covered = []
 
-def send_shift_mails(auditlog: AuditLog, mailer: Mailer, shifts: Iterable[Shift]):
-    env = create_jinja_environment()
 
+def parse_csv(f: str | TextIO) -> Iterator[Shift]:
+    """Parse a shift export.
+
+    `f` can be the CSV data or a text stream. Shifts are parsed while they
+    are iterated over, so a stream does not have to be read into memory.
+    """
+    if isinstance(f, str):
+        f = io.StringIO(f)
+    reader = csv.reader(f, dialect=csv.unix_dialect)
+    header = next(reader, None)
+    if header is None:
+        return
+    (
+        id_column,
+        group_id_column,
+        group_name_column,
+        date_column,
+        start_time_column,
+        end_time_column,
+        user_id_column,
+        user_name_column,
+        user_email_column,
+        comments_column,
+    ) = column_indexes(header, SHIFT_COLUMNS)
+    debug = debug_enabled(logger)
+    # Only count the time spent in here, not in the code handling the shifts.
+    started = time.perf_counter()
+    elapsed = 0.0
+    count = 0
+    for row in reader:
+        if not row:
+            continue
+        if debug:
+            logger.debug("parsing CSV record", data=row)
+        shift = Shift(
+            id=int(row[id_column]),
+            group_id=int(row[group_id_column]),
+            group_name=row[group_name_column],
+            date=parse_date(row[date_column]),
+            start_time=parse_time(row[start_time_column]),
+            end_time=parse_time(row[end_time_column]),
+            user_id=row[user_id_column] or None,
+            user_name=row[user_name_column] or None,
+            user_email=row[user_email_column] or None,
+            comments=row[comments_column],
+        )
+        count += 1
+        elapsed += time.perf_counter() - started
+        yield shift
+        started = time.perf_counter()
+    elapsed += time.perf_counter() - started
+    SHIFTS_PARSED.inc(count)
+    PARSE_SECONDS.inc(elapsed)
+
+
+def covered_shift_chunks(
+    auditlog: AuditLog, shifts: Iterable[Shift]
+) -> Iterator[tuple[list[Shift], set[tuple[int, str, str]]]]:
+    """Group covered shifts in chunks, together with their logged mails.
+
+    Shifts from before the archived part of the audit log are skipped, as
+    there is no record of the mails sent for them any more.
+    """
+    archived_before = auditlog.archived_before()
+    chunk: list[Shift] = []
     for shift in shifts:
-        _send_shift_mail(env, auditlog, mailer, shift)
+        if not shift.is_covered:
+            logger.debug("shift is not covered, skipping", shift_id=shift.id)
+            MAILS_SKIPPED.inc(reason="not_covered")
+            continue
+        if archived_before is not None and shift.date < archived_before:
+            logger.debug("shift is archived, skipping", shift_id=shift.id)
+            MAILS_SKIPPED.inc(reason="archived")
+            continue
+        chunk.append(shift)
+        if len(chunk) == MAX_QUERY_PARAMETERS:
+            yield chunk, _sent_mails(auditlog, chunk)
+            chunk = []
+    if chunk:
+        yield chunk, _sent_mails(auditlog, chunk)
+
+
+@tracing.traced("auditlog.sent_mails")
+def _sent_mails(auditlog: AuditLog, shifts: list[Shift]) -> set[tuple[int, str, str]]:
+    """Mails that were sent, or are waiting in the outbox to be sent."""
+    shift_ids = [shift.id for shift in shifts]
+    return auditlog.sent_mails(shift_ids) | auditlog.queued_mails(shift_ids)
+
+
+@tracing.traced("send_shift_mails")
+def send_shift_mails(
+    auditlog: AuditLog,
+    mailer: Mailer | MailerPool,
+    shifts: Iterable[Shift],
+    template_cache_dir: Path | None = None,
+    render_workers: int = 0,
+    templates: CompiledTemplates | None = None,
+    template_dir: Path | None = None,
+    digest: str = "off",
+    organisation: str = "",
+) -> int:
+    """Send a mail for every covered shift that was not mailed yet.
+
+    All mails are rendered and stored in the outbox of the audit log first,
+    and then sent from the outbox. If sending fails, the next run continues
+    with the mails that are still in the outbox, without rendering them
+    again.
+
+    With `digest` a volunteer with several new shifts gets a single mail
+    listing all of them, see `DIGEST_MODES`. Digests are not rendered in
+    `render_workers`.
+
+    Mails are queued for `organisation`, and only mails queued for the same
+    organisation are sent, as every organisation has its own mailer.
+
+    Pass `templates` to reuse compiled templates between calls. Returns the
+    number of mails that were sent.
+    """
+    if render_workers and digest == "off":
+        from .pipeline import ShiftMailPipeline
+
+        # Mails left over from an earlier run go first.
+        count = drain_outbox(auditlog, mailer, organisation=organisation)
+        pipeline = ShiftMailPipeline(
+            auditlog,
+            mailer,
+            template_cache_dir=template_cache_dir,
+            template_dir=template_dir,
+            render_workers=render_workers,
+            organisation=organisation,
+        )
+        return count + pipeline.run(shifts)["send"].items
+
+    if templates is None:
+        templates = CompiledTemplates(
+            create_jinja_environment(template_dir=template_dir), template_cache_dir
+        )
+
+    if digest != "off":
+        _enqueue_digests(
+            auditlog,
+            templates,
+            shifts,
+            same_group=digest == "same-group",
+            organisation=organisation,
+        )
+        return drain_outbox(auditlog, mailer, organisation=organisation)
+
+    for covered, sent_mails in covered_shift_chunks(auditlog, shifts):
+        for shift in covered:
+            with shift_context(shift), tracing.span("shift"):
+                mail = render_shift_mail(templates, sent_mails, shift)
+                if mail is not None:
+                    enqueue_mail(auditlog, mail, organisation=organisation)
+    return drain_outbox(auditlog, mailer, organisation=organisation)
+
+
+def _enqueue_digests(
+    auditlog: AuditLog,
+    templates: CompiledTemplates,
+    shifts: Iterable[Shift],
+    same_group: bool,
+    organisation: str = "",
+) -> None:
+    """Render and queue a digest mail for every volunteer with new shifts.
+
+    Volunteers with a single new shift, and with `same_group` volunteers
+    with new shifts in different groups, get a mail per shift instead. So
+    do all volunteers if there is no digest template.
+    """
+    new_shifts: dict[str, list[Shift]] = {}
+    for covered, sent_mails in covered_shift_chunks(auditlog, shifts):
+        for shift in covered:
+            with shift_context(shift):
+                template_id = _shift_template_id(templates, sent_mails, shift)
+            if template_id is None:
+                continue
+            assert shift.user_email is not None
+            new_shifts.setdefault(shift.user_email, []).append(shift)
+
+    has_digest_template = templates.exists(DIGEST_TEMPLATE)
+    if not has_digest_template:
+        logger.warning("no digest template, sending a mail per shift")
+    for email, user_shifts in new_shifts.items():
+        if (
+            len(user_shifts) == 1
+            or not has_digest_template
+            or (same_group and len({shift.group_id for shift in user_shifts}) > 1)
+        ):
+            for shift in user_shifts:
+                with shift_context(shift), tracing.span("shift"):
+                    mail = render_shift_mail(templates, set(), shift)
+                    if mail is not None:
+                        enqueue_mail(auditlog, mail, organisation=organisation)
+            continue
+        with bound_contextvars(user_email=email), tracing.span("digest"):
+            digest = _render_digest_mail(templates, user_shifts)
+            if digest is not None:
+                enqueue_digest(auditlog, digest, organisation=organisation)
+
+
+def enqueue_digest(
+    auditlog: AuditLog, mail: "DigestMail", organisation: str = ""
+) -> QueuedMail | None:
+    first = mail.shifts[0]
+    assert first.user_email is not None
+    queued = auditlog.enqueue_mail(
+        first.id,
+        DIGEST_TEMPLATE,
+        first.user_email,
+        first.user_name,
+        mail.subject,
+        mail.html,
+        make_msgid(),
+        shifts=[(shift.id, _template_id(shift)) for shift in mail.shifts],
+        shift_dates={shift.id: shift.date for shift in mail.shifts},
+        organisation=organisation,
+    )
+    if queued is not None:
+        DIGEST_SHIFTS.inc(len(mail.shifts))
+    return queued
+
+
+def enqueue_mail(
+    auditlog: AuditLog,
+    mail: "ShiftMail",
+    lease: bool = False,
+    organisation: str = "",
+) -> QueuedMail | None:
+    shift = mail.shift
+    assert shift.user_email is not None
+    return auditlog.enqueue_mail(
+        shift.id,
+        mail.template_id,
+        shift.user_email,
+        shift.user_name,
+        mail.subject,
+        mail.html,
+        make_msgid(),
+        lease=lease,
+        shift_dates={shift.id: shift.date},
+        organisation=organisation,
+    )
 
 
-def create_jinja_environment(locale: str = "nl_NL") -> jinja2.Environment:
+def _queued_mail_context(mail: QueuedMail):
+    return bound_contextvars(
+        shift_id=mail.shift_id, user_email=mail.email, attempt=mail.attempts
+    )
+
+
+def deliver_mail(
+    auditlog: AuditLog, mailer: Mailer | MailerPool, mail: QueuedMail
+) -> None:
+    """Send a leased mail from the outbox and log it."""
+    try:
+        msg_id = mailer.send(
+            to_addr=mail.email,
+            to_name=mail.name,
+            subject=mail.subject,
+            html=mail.html,
+            msg_id=mail.msg_id,
+        )
+    except Exception as e:
+        logger.exception("sending shift email failed")
+        auditlog.fail_mail(mail, repr(e))
+        raise
+    _complete_mail(auditlog, mail, msg_id)
+
+
+def _complete_mail(auditlog: AuditLog, mail: QueuedMail, msg_id: str) -> None:
+    if auditlog.complete_mail(mail, msg_id):
+        logger.info("shift email successfully sent")
+    else:
+        logger.warning("shift email sent after its lease expired", msg_id=msg_id)
+    MAILS_SENT.inc()
+
+
+@tracing.traced("drain_outbox")
+def drain_outbox(
+    auditlog: AuditLog,
+    mailer: Mailer | MailerPool,
+    batch_size: int = OUTBOX_BATCH_SIZE,
+    organisation: str = "",
+) -> int:
+    """Send the mails `organisation` queued, returning the number sent.
+
+    Mails are leased in small batches, and the lease on the rest of a batch
+    is renewed while it is sent, so a slow or rate limited SMTP server does
+    not let another run lease the same mails. If a mail can not be sent,
+    the mails that were already sent are logged, the rest of the batch is
+    released again and the error is raised.
+    """
+    count = 0
+    try:
+        while batch := auditlog.lease_mails(batch_size, organisation):
+            if isinstance(mailer, MailerPool):
+                count += _drain_concurrently(auditlog, mailer, batch)
+                continue
+            renewed = time.monotonic()
+            for i, mail in enumerate(batch):
+                if time.monotonic() - renewed > LEASE_RENEW_INTERVAL:
+                    auditlog.renew_lease(batch[i:])
+                    renewed = time.monotonic()
+                with _queued_mail_context(mail), tracing.span("send"):
+                    try:
+                        deliver_mail(auditlog, mailer, mail)
+                    except Exception:
+                        auditlog.release_mails(batch[i + 1 :])
+                        raise
+                count += 1
+    finally:
+        _report_outbox(auditlog)
+    return count
+
+
+def _drain_concurrently(
+    auditlog: AuditLog, mailer: MailerPool, batch: list[QueuedMail]
+) -> int:
+    pending: dict[Future, QueuedMail] = {}
+    for mail in batch:
+        with _queued_mail_context(mail):
+            future = mailer.submit(
+                to_addr=mail.email,
+                to_name=mail.name,
+                subject=mail.subject,
+                html=mail.html,
+                msg_id=mail.msg_id,
+            )
+        pending[future] = mail
+
+    # Every successful mail must be logged before we give up on a failed one.
+    error = None
+    count = 0
+    renewed = time.monotonic()
+    while pending:
+        done, _ = wait(
+            pending, timeout=LEASE_RENEW_INTERVAL, return_when=FIRST_COMPLETED
+        )
+        if time.monotonic() - renewed > LEASE_RENEW_INTERVAL:
+            auditlog.renew_lease(pending.values())
+            renewed = time.monotonic()
+        for future in done:
+            mail = pending.pop(future)
+            with _queued_mail_context(mail):
+                try:
+                    msg_id = future.result()
+                except Exception as e:
+                    logger.exception("sending shift email failed")
+                    auditlog.fail_mail(mail, repr(e))
+                    error = error or e
+                    continue
+                _complete_mail(auditlog, mail, msg_id)
+                count += 1
+    if error is not None:
+        raise error
+    return count
+
+
+def _report_outbox(auditlog: AuditLog) -> None:
+    stats = auditlog.outbox_stats()
+    OUTBOX_DEPTH.set(stats.depth)
+    OUTBOX_AGE.set(stats.oldest_age or 0)
+    OUTBOX_FAILED.set(stats.failed)
+    if stats.depth:
+        logger.warning(
+            "mails left in outbox",
+            depth=stats.depth,
+            oldest_age=round(stats.oldest_age or 0),
+            failed=stats.failed,
+        )
+    if stats.failed:
+        logger.warning(
+            "mails failed too often and are not sent any more,"
+            " use `inzetbooster audit requeue` to retry them",
+            failed=stats.failed,
+        )
+
+
+@functools.lru_cache(maxsize=1024)
+def _format_date(value: datetime.date, locale: str) -> str:
+    """Format a date for mail templates, cached as Babel is slow."""
+    from babel.dates import format_date
+
+    return format_date(value, "EEEE d MMMM", locale=locale)
+
+
+def create_jinja_environment(
+    locale: str = "nl_NL", template_dir: Path | None = None
+) -> jinja2.Environment:
+    """Create the environment for mail templates.
+
+    Templates in `template_dir` take precedence over the bundled templates.
+    """
+    loader: jinja2.BaseLoader = jinja2.PackageLoader("inzetbooster")
+    if template_dir is not None:
+        loader = jinja2.ChoiceLoader([jinja2.FileSystemLoader(template_dir), loader])
     env = jinja2.Environment(
-        loader=jinja2.PackageLoader("inzetbooster"),
+        loader=loader,
         autoescape=jinja2.select_autoescape(),
     )
 
     def filter_date_format(value: datetime.date):
-        return format_date(value, "EEEE d MMMM", locale=locale)
+        return _format_date(value, locale)
 
     env.filters["format_date"] = filter_date_format
     return env
 
 
-def _send_shift_mail(
-    env: jinja2.Environment, auditlog: AuditLog, mailer: Mailer, shift: Shift
-) -> None:
-    with bound_contextvars(
+@dataclass
+class ShiftMail:
+    shift: Shift
+    template_id: str
+    subject: str
+    html: str
+
+
+@dataclass
+class DigestMail:
+    shifts: list[Shift]
+    subject: str
+    html: str
+
+
+def shift_context(shift: Shift):
+    """Bind the details of `shift` to the log messages in the block."""
+    return bound_contextvars(
         shift_id=shift.id,
         group_id=shift.group_id,
         group_name=shift.group_name,
         comments=shift.comments,
         user_email=shift.user_email,
         date=f'{shift.date.strftime("%Y-%m-%d")} {shift.start_time.strftime("%H:%M")}',
-    ):
-        if not shift.is_covered:
-            logger.debug("shift is not covered, skipping")
-            return
-        mail_template_id = f"shift-{shift.group_id}.html"
-        if auditlog.was_mail_send(shift.id, mail_template_id, shift.user_email):
-            logger.debug("email already send for this shift")
-            return
-        logger.debug("generating email for shift")
+    )
+
+
+def _template_id(shift: Shift) -> str:
+    return f"shift-{shift.group_id}.html"
 
-        try:
-            template = env.get_template(mail_template_id)
-        except jinja2.TemplateNotFound:
-            logger.error(
-                "template was not found, can not send email", template=mail_template_id
+
+def _shift_template_id(
+    templates: CompiledTemplates,
+    sent_mails: set[tuple[int, str, str]],
+    shift: Shift,
+) -> str | None:
+    """The template for the mail for `shift`, or None if no mail is needed.
+
+    Shifts of groups without a template never get a mail, not even in a
+    digest: the template is how a group opts in to mails.
+    """
+    mail_template_id = _template_id(shift)
+    if (shift.id, mail_template_id, shift.user_email) in sent_mails:
+        logger.debug("email already send for this shift")
+        MAILS_SKIPPED.inc(reason="already_sent")
+        return None
+    if templates.is_missing(mail_template_id):
+        # The error was logged for the first shift of this group
+        logger.debug("no template for group, skipping", template=mail_template_id)
+        MAILS_SKIPPED.inc(reason="no_template")
+        return None
+    if not templates.exists(mail_template_id):
+        logger.error(
+            "template was not found, can not send email", template=mail_template_id
+        )
+        MAILS_SKIPPED.inc(reason="no_template")
+        return None
+    return mail_template_id
+
+
+def render_shift_mail(
+    templates: CompiledTemplates,
+    sent_mails: set[tuple[int, str, str]],
+    shift: Shift,
+) -> ShiftMail | None:
+    """Render the mail for `shift`, or return None if no mail is needed."""
+    mail_template_id = _shift_template_id(templates, sent_mails, shift)
+    if mail_template_id is None:
+        return None
+    logger.debug("generating email for shift")
+
+    subject = f"Aanmelding dienst {shift.group_name}"
+    try:
+        with RENDER_SECONDS.time(), tracing.span("render"), tracing.profile_render():
+            html = templates.render(
+                mail_template_id,
+                {
+                    "subject": subject,
+                    "name": shift.user_name,
+                    "date": shift.date,
+                    "start_time": shift.start_time,
+                    "end_time": shift.end_time,
+                },
             )
-            return
-        subject = f"Aanmelding dienst {shift.group_name}"
-        mjml = template.render(
-            {
-                "subject": subject,
-                "name": shift.user_name,
-                "date": shift.date,
-                "start_time": shift.start_time,
-                "end_time": shift.end_time,
-            }
+    except jinja2.TemplateNotFound:
+        logger.error(
+            "template was not found, can not send email", template=mail_template_id
         )
-        html = mjml2html(mjml)
-        msg_id = mailer.send(
-            to_addr=shift.user_email,
-            to_name=shift.user_name,
-            subject=subject,
-            html=html,
+        MAILS_SKIPPED.inc(reason="no_template")
+        return None
+    return ShiftMail(shift, mail_template_id, subject, html)
+
+
+def _render_digest_mail(
+    templates: CompiledTemplates, shifts: list[Shift]
+) -> DigestMail | None:
+    shifts = sorted(shifts, key=lambda shift: (shift.date, shift.start_time))
+    logger.debug("generating digest email", shifts=len(shifts))
+    subject = f"Aanmelding {len(shifts)} diensten"
+    try:
+        with RENDER_SECONDS.time(), tracing.span("render"), tracing.profile_render():
+            html = templates.render(
+                DIGEST_TEMPLATE,
+                {"subject": subject, "name": shifts[0].user_name, "shifts": shifts},
+            )
+    except jinja2.TemplateNotFound:
+        logger.error(
+            "template was not found, can not send email", template=DIGEST_TEMPLATE
         )
-        logger.info("shift email successfully sent")
-        auditlog.log_mail(shift.id, mail_template_id, shift.user_email, msg_id)
+        MAILS_SKIPPED.inc(len(shifts), reason="no_template")
+        return None
+    return DigestMail(shifts, subject, html)
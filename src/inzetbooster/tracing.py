@@ -0,0 +1,148 @@
+import contextlib
+import cProfile
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, ContextManager, Iterator, TypeVar
+
+from structlog.contextvars import get_contextvars
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+_tracer: "Tracer | None" = None
+_NOOP = contextlib.nullcontext()
+
+
+class Tracer:
+    """Collect timing spans for a Chrome trace (chrome://tracing, Perfetto).
+
+    Every span includes the structlog context variables at the time it was
+    recorded, so spans can be correlated with log lines (shift_id, group_id,
+    org, etc.).
+    """
+
+    origin: float
+    events: list[dict[str, Any]]
+    render_profile: cProfile.Profile | None
+
+    def __init__(self, profile_render: bool = False):
+        self.origin = time.perf_counter()
+        self.events = []
+        self.render_profile = cProfile.Profile() if profile_render else None
+        self._threads: dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args: Any) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started, time.perf_counter(), **args)
+
+    def record(self, name: str, started: float, finished: float, **args: Any) -> None:
+        """Add a span, with start and end times from `time.perf_counter`."""
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "cat": name.split(".", 1)[0],
+            "ph": "X",
+            "ts": round((started - self.origin) * 1_000_000, 3),
+            "dur": round((finished - started) * 1_000_000, 3),
+            "pid": os.getpid(),
+            "tid": thread.ident,
+            "args": {**get_contextvars(), **args},
+        }
+        with self._lock:
+            self.events.append(event)
+            self._threads.setdefault(thread.ident or 0, thread.name)
+
+    def trace(self) -> dict[str, Any]:
+        with self._lock:
+            events = list(self.events)
+            threads = dict(self._threads)
+        metadata = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": os.getpid(),
+                "tid": tid,
+                "args": {"name": name},
+            }
+            for tid, name in threads.items()
+        ]
+        return {"traceEvents": metadata + events, "displayTimeUnit": "ms"}
+
+    def write(self, directory: Path) -> list[Path]:
+        """Write the trace, and the render profile if enabled, to `directory`."""
+        directory.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        trace_path = directory / f"trace-{stamp}.json"
+        with open(trace_path, "w", encoding="utf-8") as f:
+            json.dump(self.trace(), f, default=str)
+        paths = [trace_path]
+        if self.render_profile is not None:
+            profile_path = directory / f"render-{stamp}.prof"
+            self.render_profile.dump_stats(profile_path)
+            paths.append(profile_path)
+        return paths
+
+
+def enable(profile_render: bool = False) -> Tracer:
+    global _tracer
+    _tracer = Tracer(profile_render)
+    return _tracer
+
+
+def disable() -> None:
+    global _tracer
+    _tracer = None
+
+
+def span(name: str, **args: Any) -> ContextManager[None]:
+    """Time a block of code, if tracing is enabled."""
+    tracer = _tracer
+    if tracer is None:
+        return _NOOP
+    return tracer.span(name, **args)
+
+
+def traced(name: str) -> Callable[[F], F]:
+    """Decorator to record a span for every call of a function."""
+
+    def decorator(func: F) -> F:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            tracer = _tracer
+            if tracer is None:
+                return func(*args, **kwargs)
+            with tracer.span(name):
+                return func(*args, **kwargs)
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+def record(name: str, started: float, finished: float, **args: Any) -> None:
+    tracer = _tracer
+    if tracer is not None:
+        tracer.record(name, started, finished, **args)
+
+
+@contextlib.contextmanager
+def profile_render() -> Iterator[None]:
+    """Run the block under cProfile, if render profiling is enabled."""
+    tracer = _tracer
+    if tracer is None or tracer.render_profile is None:
+        yield
+        return
+    tracer.render_profile.enable()
+    try:
+        yield
+    finally:
+        tracer.render_profile.disable()
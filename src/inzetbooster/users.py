@@ -1,16 +1,18 @@
 import csv
+import dataclasses
 import datetime
 import io
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import BinaryIO, Iterable
 
 import structlog
-from openpyxl import load_workbook
+
+from .parsing import column_indexes, debug_enabled, parse_date, parse_time
 
 logger = structlog.stdlib.get_logger(__name__)
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Person:
     id: str
     firstname: str
@@ -30,35 +32,158 @@ class Person:
     def is_manegeplan_user(self) -> bool:
         return self.id.startswith("PRS")
 
-    @classmethod
-    def from_record(cls, record: dict[str, str]):
-        logger.debug("parsing CSV record", data=record)
-        return Person(
-            id=record["Gebruiker_id"],
-            firstname=record["Voornaam"],
-            preposition=record["Tussen"],
-            surname=record["Achternaam"],
-            email=record["Email"],
-            username=record["Gebruikersnaam"] or None,
-            exempt=record["Vrijgesteld"] == "true",
-            activated_date=_parse_date(record["Actief_datum"]),
-            deactived_date=_parse_date(record["Inactief_datum"]),
-            role=record["Rol_en_rechten"],
-            last_login=datetime.datetime.strptime(
-                record["Laatste_login"], "%Y-%m-%d %H:%M"
-            )
-            if record["Laatste_login"]
-            else None,
-        )
-
 
 def _parse_date(value: str) -> datetime.date | None:
-    return datetime.datetime.strptime(value, "%d-%m-%Y").date() if value else None
+    return parse_date(value) if value else None
+
+
+def _parse_login(value: str) -> datetime.datetime | None:
+    if not value:
+        return None
+    # Logins are formatted as yyyy-mm-dd HH:MM
+    if len(value) == 16 and value[10] == " ":
+        try:
+            return datetime.datetime.combine(
+                datetime.date.fromisoformat(value[:10]), parse_time(value[11:])
+            )
+        except ValueError:
+            pass
+    return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M")
+
+
+PERSON_COLUMNS = (
+    "Gebruiker_id",
+    "Voornaam",
+    "Tussen",
+    "Achternaam",
+    "Email",
+    "Gebruikersnaam",
+    "Vrijgesteld",
+    "Actief_datum",
+    "Inactief_datum",
+    "Rol_en_rechten",
+    "Laatste_login",
+)
 
 
 def parse_csv(f: str) -> Iterable[Person]:
-    reader = csv.DictReader(io.StringIO(f, newline=""), dialect=csv.unix_dialect)
-    return [Person.from_record(row) for row in reader]
+    reader = csv.reader(io.StringIO(f, newline=""), dialect=csv.unix_dialect)
+    header = next(reader, None)
+    if header is None:
+        return []
+    (
+        id_column,
+        firstname_column,
+        preposition_column,
+        surname_column,
+        email_column,
+        username_column,
+        exempt_column,
+        activated_column,
+        deactivated_column,
+        role_column,
+        last_login_column,
+    ) = column_indexes(header, PERSON_COLUMNS)
+    debug = debug_enabled(logger)
+    people = []
+    for row in reader:
+        if not row:
+            continue
+        if debug:
+            logger.debug("parsing CSV record", data=row)
+        people.append(
+            Person(
+                id=row[id_column],
+                firstname=row[firstname_column],
+                preposition=row[preposition_column],
+                surname=row[surname_column],
+                email=row[email_column],
+                username=row[username_column] or None,
+                exempt=row[exempt_column] == "true",
+                activated_date=_parse_date(row[activated_column]),
+                deactived_date=_parse_date(row[deactivated_column]),
+                role=row[role_column],
+                last_login=_parse_login(row[last_login_column]),
+            )
+        )
+    return people
+
+
+@dataclass
+class UserChanges:
+    """Changes needed to bring inzetrooster in line with a list of people."""
+
+    add: list[Person] = field(default_factory=list)
+    update: list[Person] = field(default_factory=list)
+    deactivate: list[Person] = field(default_factory=list)
+    unchanged: list[Person] = field(default_factory=list)
+
+    def __bool__(self) -> bool:
+        return bool(self.add or self.update or self.deactivate)
+
+    def active(self) -> list[Person]:
+        """Return everybody who should be active after the sync."""
+        return self.unchanged + self.add + self.update
+
+
+def _is_active(person: Person, today: datetime.date) -> bool:
+    return person.deactived_date is None or person.deactived_date > today
+
+
+def diff_users(
+    wanted: Iterable[Person],
+    existing: Iterable[Person],
+    today: datetime.date | None = None,
+) -> UserChanges:
+    """Compare the people from manegeplan with the existing inzetrooster users.
+
+    People are matched on their id, or on their email address if the id is
+    not known. `existing` must include inactive users. Users that were not
+    created from manegeplan are never deactivated.
+    """
+    if today is None:
+        today = datetime.date.today()
+    existing_by_id = {person.id: person for person in existing}
+    existing_by_email = {
+        person.email.casefold(): person
+        for person in existing_by_id.values()
+        if person.email
+    }
+
+    changes = UserChanges()
+    matched: set[str] = set()
+    for person in wanted:
+        current = existing_by_id.get(person.id)
+        if current is None and person.email:
+            current = existing_by_email.get(person.email.casefold())
+        if current is None or current.id in matched:
+            changes.add.append(person)
+            continue
+        matched.add(current.id)
+        desired = dataclasses.replace(person, id=current.id, deactived_date=None)
+        if _is_active(current, today) and (
+            current.firstname,
+            current.preposition,
+            current.surname,
+            current.email,
+        ) == (
+            desired.firstname,
+            desired.preposition,
+            desired.surname,
+            desired.email,
+        ):
+            changes.unchanged.append(desired)
+        else:
+            changes.update.append(desired)
+
+    for person in existing_by_id.values():
+        if person.id in matched or not _is_active(person, today):
+            continue
+        if person.is_manegeplan_user():
+            changes.deactivate.append(person)
+        else:
+            changes.unchanged.append(person)
+    return changes
 
 
 def create_csv(people: Iterable[Person]) -> str:
@@ -83,26 +208,43 @@ def create_csv(people: Iterable[Person]) -> str:
     return output.getvalue()
 
 
-def read_manegeplan_export(fn: str | BinaryIO) -> Iterable[Person]:
-    wb = load_workbook(fn)
-    if (sheet := wb.active) is None:
-        raise ValueError("workbook has no active sheet")
+MANEGEPLAN_COLUMNS = (
+    "Persoon_ID",
+    "Roepnaam",
+    "Tussenvoegsels",
+    "Achternaam",
+    "E_Mail",
+)
 
-    rows = sheet.rows
-    column_names = [h.value for h in next(rows)]
-    while not column_names[-1]:
-        column_names = column_names[:-1]
 
-    for row_cells in rows:
-        if all(c.value is None for c in row_cells):
-            continue
-        data = {column: cell.value for column, cell in zip(column_names, row_cells)}
-
-        yield Person(
-            id=data["Persoon_ID"],
-            firstname=data["Roepnaam"] or "",
-            preposition=data["Tussenvoegsels"] or "",
-            surname=data["Achternaam"] or "",
-            email=data["E_Mail"] or "",
-
-        )
+def read_manegeplan_export(fn: str | BinaryIO) -> Iterable[Person]:
+    from openpyxl import load_workbook
+
+    # Read-only mode streams the sheet instead of loading all cells and
+    # styles into memory first.
+    wb = load_workbook(fn, read_only=True, data_only=True)
+    try:
+        if (sheet := wb.active) is None:
+            raise ValueError("workbook has no active sheet")
+
+        rows = sheet.iter_rows(values_only=True)
+        header = [str(value) if value is not None else "" for value in next(rows)]
+        columns = column_indexes(header, MANEGEPLAN_COLUMNS)
+        width = max(columns) + 1
+
+        for row in rows:
+            if all(value is None for value in row):
+                continue
+            if len(row) < width:
+                row = row + (None,) * (width - len(row))
+            id, firstname, preposition, surname, email = (row[i] for i in columns)
+
+            yield Person(
+                id=id,
+                firstname=firstname or "",
+                preposition=preposition or "",
+                surname=surname or "",
+                email=email or "",
+            )
+    finally:
+        wb.close()
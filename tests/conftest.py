@@ -0,0 +1,22 @@
+from typing import Iterator
+
+import pytest
+from aiosmtpd.controller import Controller
+
+from fakeinzetrooster import FakeInzetrooster, RecordingHandler, free_port, serving
+
+
+@pytest.fixture
+def inzetrooster_server() -> Iterator[FakeInzetrooster]:
+    with serving(FakeInzetrooster()) as server:
+        yield server
+
+
+@pytest.fixture
+def smtp_server() -> Iterator[Controller]:
+    controller = Controller(RecordingHandler(), hostname="127.0.0.1", port=free_port())
+    controller.start()
+    try:
+        yield controller
+    finally:
+        controller.stop()
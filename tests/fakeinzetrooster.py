@@ -0,0 +1,206 @@
+"""Local stand-ins for inzetrooster and an SMTP server.
+
+Used by the tests and by `benchmarks/endtoend.py`.
+"""
+
+import secrets
+import socket
+import threading
+from contextlib import contextmanager
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+from urllib.parse import parse_qs
+
+from aiosmtpd.handlers import Sink
+
+
+class FakeInzetrooster(ThreadingHTTPServer):
+    """Local stand-in for the inzetrooster admin pages.
+
+    Sessions are tracked with a cookie. Admin pages redirect to the login
+    page when the session is missing or expired, and forms are rejected with
+    a 422 when the CSRF token does not belong to the session.
+
+    The exports are served from `shifts_csv` and `users_csv`, and the export
+    page offers `groups` to shard the shift export by.
+
+    Faults can be injected with `faults`: every request takes the first
+    entry, which is either a status code to respond with or "drop" to close
+    the connection without responding.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        shifts_csv: str | bytes = (
+            "Dienst_id,Groep_id,Groep_naam,Datum,Starttijd,Eindtijd,"
+            "Gebruiker_id,Naam,Email,Opmerkingen\n"
+        ),
+        users_csv: str | bytes = "Id,Email\n",
+        groups: list[tuple[int, str]] | None = None,
+        organisation: str = "test",
+        username: str = "admin",
+        password: str = "secret",
+    ) -> None:
+        super().__init__(("127.0.0.1", 0), FakeInzetroosterHandler)
+        self.shifts_csv = shifts_csv
+        self.users_csv = users_csv
+        self.groups = groups if groups is not None else [(1, "Bar")]
+        self.organisation = organisation
+        self.username = username
+        self.password = password
+        self.sessions: dict[str, str] = {}
+        self.requests: list[tuple[str, str]] = []
+        self.logins = 0
+        self.faults: list[int | str] = []
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def expire_sessions(self) -> None:
+        with self.lock:
+            self.sessions.clear()
+
+    def request_count(self) -> int:
+        """Return the number of requests since the last call."""
+        with self.lock:
+            count = len(self.requests)
+            self.requests.clear()
+        return count
+
+
+class FakeInzetroosterHandler(BaseHTTPRequestHandler):
+    server: FakeInzetrooster
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def _session(self) -> str | None:
+        cookie = SimpleCookie(self.headers.get("Cookie", ""))
+        if "_session" not in cookie:
+            return None
+        session_id = cookie["_session"].value
+        return session_id if session_id in self.server.sessions else None
+
+    def _send(
+        self,
+        status: int,
+        body: str | bytes = b"",
+        content_type: str = "text/html",
+        headers: dict[str, str] | None = None,
+    ) -> None:
+        data = body.encode("utf-8") if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _page(self, csrf_token: str, body: str = "") -> str:
+        return f'<html><meta name="csrf-token" content="{csrf_token}">{body}</html>'
+
+    def _handle(self) -> None:
+        server = self.server
+        # Read the body first, so the connection can be reused after any
+        # response.
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with server.lock:
+            server.requests.append((self.command, self.path))
+            fault = server.faults.pop(0) if server.faults else None
+        if fault == "drop":
+            self.close_connection = True
+            return
+        if fault is not None:
+            return self._send(int(fault), "Bad gateway")
+        org, _, path = self.path.split("?")[0].strip("/").partition("/")
+        if org != server.organisation:
+            return self._send(404)
+
+        if path == "login":
+            if self.command == "GET":
+                return self._send(200, self._page("LOGIN"))
+            form = parse_qs(body.decode())
+            if form.get("username") != [server.username] or form.get("password") != [
+                server.password
+            ]:
+                return self._send(200, "Geen geldige gebruikersnaam")
+            session_id = secrets.token_hex(8)
+            with server.lock:
+                server.sessions[session_id] = secrets.token_hex(8)
+                server.logins += 1
+            return self._send(
+                302,
+                headers={
+                    "Location": f"/{org}/admin",
+                    "Set-Cookie": f"_session={session_id}; Path=/{org}",
+                },
+            )
+
+        session_id = self._session()
+        if session_id is None:
+            return self._send(302, headers={"Location": f"/{org}/login"})
+        csrf_token = server.sessions[session_id]
+
+        if self.command == "GET":
+            if path == "admin/shifts/export":
+                options = "".join(
+                    f'<option value="{group_id}">{name}</option>'
+                    for group_id, name in server.groups
+                )
+                select = f'<select name="group_ids[]">{options}</select>'
+                return self._send(200, self._page(csrf_token, select))
+            return self._send(200, self._page(csrf_token))
+
+        if csrf_token.encode() not in body:
+            return self._send(422, "Invalid authenticity token")
+        if path == "admin/shifts/export.csv":
+            return self._send(200, server.shifts_csv, "text/csv")
+        if path == "admin/people/export.csv":
+            return self._send(200, server.users_csv, "text/csv")
+        if path in {"admin/person_imports", "admin/people/destroy/all"}:
+            return self._send(
+                302, headers={"Location": f"{server.base_url}/{org}/admin"}
+            )
+        return self._send(404)
+
+    def do_GET(self) -> None:
+        self._handle()
+
+    def do_POST(self) -> None:
+        self._handle()
+
+
+@contextmanager
+def serving(server: FakeInzetrooster) -> Iterator[FakeInzetrooster]:
+    """Serve requests in a background thread until the block ends."""
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class RecordingHandler(Sink):
+    """SMTP handler that accepts all mail and records the envelopes."""
+
+    def __init__(self) -> None:
+        self.messages: list[tuple[str, list[str]]] = []
+
+    async def handle_DATA(self, server, session, envelope) -> str:
+        self.messages.append((envelope.mail_from, envelope.rcpt_tos))
+        return "250 OK"
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
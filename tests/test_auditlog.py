@@ -1,4 +1,15 @@
-from inzetbooster.auditlog import AuditLog
+import datetime
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import time
+
+from click.testing import CliRunner
+
+from inzetbooster.auditlog import MIGRATIONS, OUTBOX_MAX_ATTEMPTS, AuditLog
+from inzetbooster.cli import main
 
 
 def test_mail_log() -> None:
@@ -11,3 +22,339 @@ def test_mail_log() -> None:
         assert not auditor.was_mail_send(145, "shift-cancelled", "alice@example.com")
     finally:
         auditor.close()
+
+
+def test_sent_mails() -> None:
+    try:
+        auditor = AuditLog(path=":memory:")
+        assert auditor.sent_mails([145, 146]) == set()
+        auditor.log_mail(145, "bar-shift", "alice@example.com", "msgid")
+        auditor.log_mail(147, "bar-shift", "bob@example.com", "msgid")
+        assert auditor.sent_mails([145, 146]) == {
+            (145, "bar-shift", "alice@example.com")
+        }
+        assert len(auditor.sent_mails(range(1000))) == 2
+    finally:
+        auditor.close()
+
+
+def test_migrate_existing_database(tmp_path) -> None:
+    path = str(tmp_path / "audit.db")
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE mail_log (id INTEGER PRIMARY KEY, ts INTEGER NOT NULL, shift_id INTEGER NOT NULL, content_id TEXT NOT NULL, email TEXT NOT NULL, msg_id TEXT NOT NULL)"
+    )
+    db.execute(
+        "INSERT INTO mail_log (ts, shift_id, content_id, email, msg_id) VALUES (0, 145, 'bar-shift', 'alice@example.com', 'msgid')"
+    )
+    db.commit()
+    db.close()
+
+    try:
+        auditor = AuditLog(path=path)
+        assert auditor.was_mail_send(145, "bar-shift", "alice@example.com")
+        (version,) = auditor.db.execute("PRAGMA user_version").fetchone()
+        assert version == len(MIGRATIONS)
+        plan = auditor.db.execute(
+            "EXPLAIN QUERY PLAN SELECT ts FROM mail_log WHERE shift_id=? AND content_id=? AND email=?",
+            (145, "bar-shift", "alice@example.com"),
+        ).fetchall()
+        assert "mail_log_shift" in plan[0][-1]
+    finally:
+        auditor.close()
+
+
+def test_batched_mail_log(tmp_path) -> None:
+    try:
+        auditor = AuditLog(path=str(tmp_path / "audit.db"), batch_size=3)
+        (journal_mode,) = auditor.db.execute("PRAGMA journal_mode").fetchone()
+        assert journal_mode == "wal"
+        auditor.log_mail(145, "bar-shift", "alice@example.com", "msgid")
+        auditor.log_mail(146, "bar-shift", "alice@example.com", "msgid")
+        assert auditor._unsynced == 2
+        assert auditor.was_mail_send(146, "bar-shift", "alice@example.com")
+        auditor.log_mail(147, "bar-shift", "alice@example.com", "msgid")
+        assert auditor._unsynced == 0
+    finally:
+        auditor.close()
+
+
+CRASHING_SENDER = """
+import os, signal, sys
+from inzetbooster.auditlog import AuditLog
+
+db_path, sent_path, crash_after = sys.argv[1], sys.argv[2], int(sys.argv[3])
+auditor = AuditLog(db_path, batch_size=50)
+with open(sent_path, "a") as sent:
+    for shift_id in range(200):
+        if auditor.was_mail_send(shift_id, "bar-shift", "alice@example.com"):
+            continue
+        sent.write(f"{shift_id}\\n")
+        sent.flush()
+        auditor.log_mail(shift_id, "bar-shift", "alice@example.com", "msgid")
+        crash_after -= 1
+        if crash_after == 0:
+            os.kill(os.getpid(), signal.SIGKILL)
+auditor.close()
+"""
+
+
+def test_batched_mail_log_survives_crash(tmp_path) -> None:
+    db_path = str(tmp_path / "audit.db")
+    sent_path = tmp_path / "sent.txt"
+
+    def run(crash_after: int) -> int:
+        return subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                CRASHING_SENDER,
+                db_path,
+                str(sent_path),
+                str(crash_after),
+            ],
+            env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+        ).returncode
+
+    # Crash in the middle of the second batch
+    assert run(75) == -signal.SIGKILL
+    assert run(0) == 0
+    sent = sent_path.read_text().split()
+    assert sorted(sent, key=int) == [str(i) for i in range(200)]
+
+
+def test_outbox(monkeypatch) -> None:
+    auditor = AuditLog(path=":memory:")
+    try:
+        alice = auditor.enqueue_mail(
+            145, "bar-shift", "alice@example.com", "Alice", "Bar", "<p>", "<a@x>"
+        )
+        assert alice is not None
+        assert (
+            auditor.enqueue_mail(
+                145, "bar-shift", "alice@example.com", "Alice", "Bar", "<p>", "<b@x>"
+            )
+            is None
+        )
+        bob = auditor.enqueue_mail(
+            146, "bar-shift", "bob@example.com", "Bob", "Bar", "<p>", "<c@x>"
+        )
+        assert bob is not None
+        assert auditor.queued_mails([145]) == {(145, "bar-shift", "alice@example.com")}
+
+        leased = auditor.lease_mails()
+        assert [mail.msg_id for mail in leased] == ["<a@x>", "<c@x>"]
+        assert all(mail.attempts == 1 for mail in leased)
+        # Leased mails are not handed out twice
+        assert auditor.lease_mails() == []
+
+        auditor.complete_mail(leased[0], "<a@x>")
+        assert auditor.was_mail_send(145, "bar-shift", "alice@example.com")
+        assert auditor.queued_mails([145, 146]) == {
+            (146, "bar-shift", "bob@example.com")
+        }
+
+        auditor.release_mails([leased[1]])
+        (bob,) = auditor.lease_mails()
+        assert bob.attempts == 1
+
+        auditor.fail_mail(bob, "connection refused")
+        assert auditor.lease_mails() == []
+        monkeypatch.setattr("inzetbooster.auditlog.OUTBOX_RETRY_DELAY", -1)
+        # The retry delay passed
+        auditor.db.execute("UPDATE outbox SET lease_until=0")
+        for attempt in range(2, 6):
+            (bob,) = auditor.lease_mails()
+            assert bob.attempts == attempt
+            auditor.fail_mail(bob, "connection refused")
+        # Gave up after OUTBOX_MAX_ATTEMPTS
+        assert auditor.lease_mails() == []
+
+        stats = auditor.outbox_stats()
+        assert stats.depth == 1
+        assert stats.failed == 1
+        assert stats.oldest_age is not None and stats.oldest_age >= 0
+    finally:
+        auditor.close()
+
+
+def test_outbox_digest() -> None:
+    auditor = AuditLog(path=":memory:")
+    try:
+        shifts = [(145, "bar-shift"), (146, "cleaning-shift")]
+        digest = auditor.enqueue_mail(
+            145,
+            "digest",
+            "alice@example.com",
+            "Alice",
+            "2x",
+            "<p>",
+            "<a@x>",
+            shifts=shifts,
+        )
+        assert digest is not None
+        assert auditor.queued_mails([146]) == {
+            (146, "cleaning-shift", "alice@example.com")
+        }
+        # A shift can not be in two queued digests
+        assert (
+            auditor.enqueue_mail(
+                147,
+                "digest",
+                "alice@example.com",
+                "Alice",
+                "2x",
+                "<p>",
+                "<c@x>",
+                shifts=[(147, "bar-shift"), (145, "bar-shift")],
+            )
+            is None
+        )
+
+        leased = {mail.msg_id: mail for mail in auditor.lease_mails()}
+        assert set(leased) == {"<a@x>"}
+        assert leased["<a@x>"].shifts == tuple(shifts)
+        auditor.complete_mail(leased["<a@x>"], "<a@x>")
+        assert auditor.sent_mails([145, 146, 147]) == {
+            (145, "bar-shift", "alice@example.com"),
+            (146, "cleaning-shift", "alice@example.com"),
+        }
+        assert auditor.queued_mails([145, 146, 147]) == set()
+    finally:
+        auditor.close()
+
+
+def log_shift_mail(auditor: AuditLog, shift_id: int, date: datetime.date) -> None:
+    auditor.enqueue_mail(
+        shift_id,
+        "bar-shift",
+        "alice@example.com",
+        "Alice",
+        "Bar",
+        "<p>",
+        f"<{shift_id}@x>",
+        shift_dates={shift_id: date},
+    )
+    (mail,) = auditor.lease_mails()
+    auditor.complete_mail(mail, mail.msg_id)
+
+
+def test_compact(tmp_path) -> None:
+    path = str(tmp_path / "audit.db")
+    archive = str(tmp_path / "archive.db")
+    today = datetime.date.today()
+    # A database from before incremental vacuuming
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE mail_log (id INTEGER PRIMARY KEY, ts INTEGER NOT NULL, shift_id INTEGER NOT NULL, content_id TEXT NOT NULL, email TEXT NOT NULL, msg_id TEXT NOT NULL)"
+    )
+    db.execute(
+        "INSERT INTO mail_log (ts, shift_id, content_id, email, msg_id) VALUES (?, 1, 'bar-shift', 'alice@example.com', '<1@x>')",
+        (time.time() - 3 * 365 * 86400,),
+    )
+    db.commit()
+    db.close()
+
+    auditor = AuditLog(path)
+    try:
+        log_shift_mail(auditor, 2, today - datetime.timedelta(days=100))
+        log_shift_mail(auditor, 3, today - datetime.timedelta(days=10))
+        log_shift_mail(auditor, 4, today + datetime.timedelta(days=100))
+        auditor.store_shift_hashes("myorg", {2: "a", 3: "b"})
+        # Hashes of shifts that were never mailed are pruned by date
+        auditor.store_shift_hashes(
+            "myorg",
+            {5: "c", 6: "d"},
+            {5: today - datetime.timedelta(days=100), 6: today},
+        )
+        assert auditor.archived_before() is None
+
+        result = auditor.compact(archive, 30)
+        assert result.archived == 2
+        assert result.archived_before == today - datetime.timedelta(days=30)
+        assert auditor.archived_before() == result.archived_before
+        assert auditor.last_compacted() is not None
+        assert auditor.sent_mails(range(5)) == {
+            (3, "bar-shift", "alice@example.com"),
+            (4, "bar-shift", "alice@example.com"),
+        }
+        assert auditor.shift_hashes([2, 3, 5, 6]) == {3: "b", 6: "d"}
+        assert auditor.db.execute("PRAGMA auto_vacuum").fetchone() == (2,)
+
+        # Compacting again with a longer retention keeps the archived date
+        assert auditor.compact(archive, 60).archived == 0
+        assert auditor.archived_before() == result.archived_before
+    finally:
+        auditor.close()
+
+    db = sqlite3.connect(archive)
+    rows = db.execute(
+        "SELECT shift_id, msg_id, shift_date FROM mail_log ORDER BY shift_id"
+    ).fetchall()
+    db.close()
+    date = (today - datetime.timedelta(days=100)).isoformat()
+    assert rows == [(1, "<1@x>", None), (2, "<2@x>", date)]
+
+
+def test_compact_command(tmp_path) -> None:
+    path = tmp_path / "audit.db"
+    auditor = AuditLog(str(path))
+    log_shift_mail(auditor, 1, datetime.date.today() - datetime.timedelta(days=400))
+    auditor.close()
+    result = CliRunner().invoke(main, ["--auditlog", str(path), "audit", "compact"])
+    assert result.exit_code == 0, result.output
+    assert "Archived 1 entries" in result.output
+    assert (tmp_path / "audit-archive.db").exists()
+
+
+def test_outbox_expired_lease(monkeypatch) -> None:
+    auditor = AuditLog(path=":memory:")
+    try:
+        auditor.enqueue_mail(
+            145, "bar-shift", "alice@example.com", "Alice", "Bar", "<p>", "<a@x>"
+        )
+        monkeypatch.setattr("inzetbooster.auditlog.OUTBOX_LEASE", -1)
+        (slow,) = auditor.lease_mails()
+        # The lease expired, so another run leases the mail as well
+        (fast,) = auditor.lease_mails()
+        auditor.renew_lease([slow])
+        assert auditor.complete_mail(fast, "<a@x>")
+        assert not auditor.complete_mail(slow, "<a@x>")
+        auditor.fail_mail(slow, "too late")
+        assert auditor.db.execute("SELECT COUNT(*) FROM mail_log").fetchone() == (1,)
+        assert auditor.outbox_stats().depth == 0
+    finally:
+        auditor.close()
+
+
+def test_requeue_and_purge_failed_mails(tmp_path) -> None:
+    path = tmp_path / "audit.db"
+    auditor = AuditLog(str(path))
+    for shift_id in (145, 146):
+        auditor.enqueue_mail(
+            shift_id, "bar-shift", "alice@example.com", None, "Bar", "<p>", "<a@x>"
+        )
+    with auditor.db:
+        auditor.db.execute("UPDATE outbox SET attempts=?", (OUTBOX_MAX_ATTEMPTS,))
+    assert auditor.outbox_stats().failed == 2
+    assert auditor.lease_mails() == []
+    auditor.close()
+
+    result = CliRunner().invoke(main, ["--auditlog", str(path), "audit", "requeue"])
+    assert "Requeued 2 mails" in result.output
+    auditor = AuditLog(str(path))
+    assert auditor.outbox_stats().failed == 0
+    assert len(auditor.lease_mails()) == 2
+    with auditor.db:
+        auditor.db.execute(
+            "UPDATE outbox SET attempts=? WHERE shift_id=145", (OUTBOX_MAX_ATTEMPTS,)
+        )
+    auditor.store_shift_hashes("test", {145: "a", 146: "b"})
+    auditor.close()
+
+    result = CliRunner().invoke(main, ["--auditlog", str(path), "audit", "purge"])
+    assert "Removed 1 mails" in result.output
+    auditor = AuditLog(str(path))
+    assert auditor.queued_mails([145, 146]) == {(146, "bar-shift", "alice@example.com")}
+    assert auditor.shift_hashes([145, 146]) == {146: "b"}
+    auditor.close()
@@ -0,0 +1,111 @@
+import os
+import random
+import signal
+from pathlib import Path
+
+from aiosmtpd.controller import Controller
+
+from inzetbooster.runner import ShiftMailRunner
+from inzetbooster.daemon import Scheduler
+from inzetbooster.session import SessionStore
+
+from fakeinzetrooster import FakeInzetrooster
+
+
+def test_next_delay_backoff() -> None:
+    scheduler = Scheduler(lambda: None, 10, jitter=0, max_backoff=60)
+    assert scheduler.next_delay() == 10
+    scheduler.failures = 2
+    assert scheduler.next_delay() == 40
+    scheduler.failures = 5
+    assert scheduler.next_delay() == 60
+
+
+def test_next_delay_jitter() -> None:
+    scheduler = Scheduler(lambda: None, 10, jitter=0.5, rng=random.Random(1))
+    delays = [scheduler.next_delay() for _ in range(100)]
+    assert all(5 <= delay <= 15 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_run_once_counts_failures() -> None:
+    def fail() -> None:
+        raise RuntimeError("boom")
+
+    scheduler = Scheduler(fail, 10)
+    scheduler.run_once()
+    scheduler.run_once()
+    assert scheduler.failures == 2
+    scheduler.job = lambda: None
+    scheduler.run_once()
+    assert scheduler.failures == 0
+    assert scheduler.runs == 3
+
+
+def test_stops_on_sigterm() -> None:
+    def job() -> None:
+        os.kill(os.getpid(), signal.SIGTERM)
+
+    previous = signal.getsignal(signal.SIGTERM)
+    scheduler = Scheduler(job, 3600)
+    scheduler.run_forever()
+    assert scheduler.runs == 1
+    assert signal.getsignal(signal.SIGTERM) is previous
+
+
+def test_serve_keeps_session(
+    inzetrooster_server: FakeInzetrooster,
+    smtp_server: Controller,
+    tmp_path: Path,
+) -> None:
+    inzetrooster_server.shifts_csv += (
+        "1,10736,Bar,13-01-2024,16:00,18:00,7,Alice,alice@example.com,\n"
+    )
+    obj = {
+        "user": inzetrooster_server.username,
+        "password": inzetrooster_server.password,
+        "orgs": [inzetrooster_server.organisation],
+        "base_url": inzetrooster_server.base_url,
+        "session_store": SessionStore(tmp_path / "sessions.json"),
+        "http_retries": 3,
+        "http_timeout": 5,
+        "auditlog": str(tmp_path / "audit.db"),
+        "auditlog_batch_size": 1,
+        "auditlog_batch_interval": None,
+        "audit_retention": None,
+        "audit_archive": str(tmp_path / "audit-archive.db"),
+    }
+    runner = ShiftMailRunner(
+        obj,
+        persistent=True,
+        email_from_addr="coordinator@example.com",
+        email_from_name="Coordinator",
+        smtp_server=smtp_server.hostname,
+        smtp_port=smtp_server.port,
+        smtp_use_ssl=False,
+        smtp_connections=1,
+        smtp_rate_limit=None,
+        render_workers=0,
+        template_cache=tmp_path / "templates",
+        incremental=False,
+        full_refresh_after=24,
+        from_date=None,
+        to_date=None,
+    )
+
+    def job() -> None:
+        runner.run()
+        if scheduler.runs == 2:
+            scheduler.stop()
+
+    scheduler = Scheduler(job, 0.01)
+    try:
+        scheduler.run_forever()
+    finally:
+        runner.close()
+    assert scheduler.runs == 3
+    assert scheduler.failures == 0
+    assert inzetrooster_server.logins == 1
+    assert smtp_server.handler.messages == [
+        ("coordinator@example.com", ["alice@example.com"])
+    ]
@@ -1,4 +1,20 @@
-from inzetbooster.inzetrooster import get_csrf
+import asyncio
+import csv
+import datetime
+from urllib.parse import parse_qs
+
+import httpx
+from inzetbooster import inzetrooster
+from inzetbooster.inzetrooster import (
+    DEACTIVATE_USERS_PAGE,
+    AsyncInzetrooster,
+    Inzetrooster,
+    _export_shifts_form,
+    _merge_exports,
+    _shard_export_form,
+    export_shifts_for_organisations,
+    get_csrf,
+)
 import pytest
 
 
@@ -27,3 +43,222 @@ def test_get_csrf(html: str, csrf_token: str) -> None:
 def test_get_csrf_no_token() -> None:
     with pytest.raises(ValueError, match="no CSRF token found"):
         get_csrf(html="<html>Hello</html>")
+
+
+EXPORT_PAGE = """
+<html>
+  <meta name="csrf-token" content="EXPORT">
+  <select name="group_ids[]">
+    <option value="10736">Bar</option>
+    <option value="11703">Schoonmaak</option>
+  </select>
+</html>
+"""
+
+
+def fake_inzetrooster(request: httpx.Request) -> httpx.Response:
+    org, path = request.url.path.strip("/").split("/", 1)
+    if path == "login":
+        if request.method == "GET":
+            return httpx.Response(200, html='<meta name="csrf-token" content="LOGIN">')
+        return httpx.Response(200, html="Welkom")
+    if path == "admin/shifts/export":
+        return httpx.Response(200, html=EXPORT_PAGE)
+    if path == "admin/shifts/export.csv":
+        form = parse_qs(request.content.decode())
+        assert form["authenticity_token"] == ["EXPORT"]
+        assert form["group_ids[]"] == ["10736", "11703"]
+        return httpx.Response(
+            200, text=f"export for {org}", headers={"content-type": "text/csv"}
+        )
+    if path in {"admin/people/export", "admin/people/destroy/all"}:
+        if request.method == "GET":
+            return httpx.Response(
+                200, html=f'<meta name="csrf-token" content="{path}">'
+            )
+        return httpx.Response(302, headers={"location": "/"})
+    return httpx.Response(404)
+
+
+def test_async_prefetch_csrf() -> None:
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append((request.method, request.url.path))
+        return fake_inzetrooster(request)
+
+    async def run() -> None:
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        async with client:
+            ir = AsyncInzetrooster(client, "myorg")
+            await ir.login("jane", "secret")
+            await ir.prefetch_csrf(DEACTIVATE_USERS_PAGE)
+            requests.clear()
+            await ir.make_all_users_inactive()
+
+    asyncio.run(run())
+    assert requests == [("POST", "/myorg/admin/people/destroy/all")]
+
+
+def test_export_shifts_for_organisations() -> None:
+    transport = httpx.MockTransport(fake_inzetrooster)
+    exports = asyncio.run(
+        export_shifts_for_organisations(
+            ["org1", "org2"], "jane", "secret", transport=transport
+        )
+    )
+    assert exports == {"org1": "export for org1", "org2": "export for org2"}
+
+
+def test_get_csrf_does_not_use_html5lib(monkeypatch: pytest.MonkeyPatch) -> None:
+    def fail(html: str) -> None:
+        raise AssertionError("html5lib should not be used")
+
+    monkeypatch.setattr(inzetrooster, "to_soup", fail)
+    assert get_csrf(html=EXPORT_PAGE) == "EXPORT"
+
+
+def test_export_shifts_form() -> None:
+    data = _export_shifts_form(EXPORT_PAGE)
+    assert data["authenticity_token"] == "EXPORT"
+    assert data["group_ids[]"] == ["10736", "11703"]
+
+
+def test_export_shifts_form_window() -> None:
+    data = _export_shifts_form(
+        EXPORT_PAGE, datetime.date(2024, 3, 1), datetime.date(2024, 3, 31)
+    )
+    assert data["from_date"] == "2024-03-01"
+    assert data["to_date"] == "2024-03-31"
+
+
+def test_export_shifts_form_fallback(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(inzetrooster._PageScanner, "scan", lambda self, html: None)
+    data = _export_shifts_form(EXPORT_PAGE)
+    assert data["authenticity_token"] == "EXPORT"
+    assert data["group_ids[]"] == ["10736", "11703"]
+
+
+def test_stream_shifts() -> None:
+    csv_data = 'a,b\r\n1,"multi\r\nline ✓"\r\n2,x\r\n'.encode()
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("export.csv"):
+            # Deliver the export in tiny chunks to split lines and characters
+            chunks = [csv_data[i : i + 3] for i in range(0, len(csv_data), 3)]
+            return httpx.Response(
+                200,
+                content=iter(chunks),
+                headers={"content-type": "text/csv"},
+            )
+        return fake_inzetrooster(request)
+
+    with httpx.Client(transport=httpx.MockTransport(handler)) as client:
+        ir = Inzetrooster(client, "myorg")
+        ir.is_logged_in = True
+        with ir.stream_shifts() as f:
+            assert list(csv.reader(f)) == [
+                ["a", "b"],
+                ["1", "multi\r\nline ✓"],
+                ["2", "x"],
+            ]
+
+
+SHARD_HEADER = "Dienst_id,Groep_id,Groep_naam,Datum,Starttijd,Eindtijd\n"
+SHARD_ROWS = [
+    "3,11703,Schoonmaak,02-01-2024,09:00,12:00\n",
+    "1,10736,Bar,01-01-2024,16:00,18:00\n",
+    "4,10736,Bar,15-02-2024,16:00,18:00\n",
+    "2,11703,Schoonmaak,01-01-2024,18:00,20:00\n",
+]
+
+
+def sharded_inzetrooster(request: httpx.Request) -> httpx.Response:
+    """Export that only returns the shifts in the requested groups and dates."""
+    if not request.url.path.endswith("export.csv"):
+        return fake_inzetrooster(request)
+    form = parse_qs(request.content.decode())
+    from_date = datetime.date.fromisoformat(form["from_date"][0])
+    to_date = datetime.date.fromisoformat(form["to_date"][0])
+    rows = []
+    for row in SHARD_ROWS:
+        _, group_id, _, date, *_ = row.split(",")
+        date = datetime.datetime.strptime(date, "%d-%m-%Y").date()
+        if group_id in form["group_ids[]"] and from_date <= date <= to_date:
+            rows.append(row)
+    return httpx.Response(
+        200, text=SHARD_HEADER + "".join(rows), headers={"content-type": "text/csv"}
+    )
+
+
+SHARDED_EXPORT = (
+    '"Dienst_id","Groep_id","Groep_naam","Datum","Starttijd","Eindtijd"\n'
+    '"1","10736","Bar","01-01-2024","16:00","18:00"\n'
+    '"2","11703","Schoonmaak","01-01-2024","18:00","20:00"\n'
+    '"3","11703","Schoonmaak","02-01-2024","09:00","12:00"\n'
+    '"4","10736","Bar","15-02-2024","16:00","18:00"\n'
+)
+
+
+@pytest.mark.parametrize(["shard_by", "shards"], [("group", 2), ("date", 3)])
+def test_stream_shifts_sharded(shard_by: str, shards: int) -> None:
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request.url.path)
+        return sharded_inzetrooster(request)
+
+    with httpx.Client(transport=httpx.MockTransport(handler)) as client:
+        ir = Inzetrooster(client, "myorg")
+        ir.is_logged_in = True
+        export = ir.export_shifts(
+            datetime.date(2024, 1, 1), datetime.date(2024, 3, 1), shard_by=shard_by
+        )
+    assert export == SHARDED_EXPORT
+    assert requests.count("/myorg/admin/shifts/export.csv") == shards
+
+
+def test_export_shifts_for_organisations_sharded() -> None:
+    transport = httpx.MockTransport(sharded_inzetrooster)
+    exports = asyncio.run(
+        export_shifts_for_organisations(
+            ["org1"],
+            "jane",
+            "secret",
+            transport=transport,
+            from_date=datetime.date(2024, 1, 1),
+            to_date=datetime.date(2024, 3, 1),
+            shard_by="group",
+            shard_concurrency=1,
+        )
+    )
+    assert exports == {"org1": SHARDED_EXPORT}
+
+
+def test_shard_export_form_by_date() -> None:
+    data = _export_shifts_form(
+        EXPORT_PAGE, datetime.date(2024, 1, 1), datetime.date(2024, 3, 1)
+    )
+    shards = _shard_export_form(data, "date")
+    assert [(form["from_date"], form["to_date"]) for _, form in shards] == [
+        ("2024-01-01", "2024-01-28"),
+        ("2024-01-29", "2024-02-25"),
+        ("2024-02-26", "2024-03-01"),
+    ]
+    assert all(form["group_ids[]"] == ["10736", "11703"] for _, form in shards)
+
+
+def test_merge_exports() -> None:
+    merged = _merge_exports(
+        [
+            "Dienst_id,Datum,Starttijd\n2,01-01-2024,18:00\n1,01-01-2024,16:00\n",
+            "",
+            "Starttijd,Datum,Dienst_id\n16:00,01-01-2024,1\n09:00,02-01-2024,3\n",
+        ]
+    )
+    assert merged.splitlines() == [
+        '"Dienst_id","Datum","Starttijd"',
+        '"1","01-01-2024","16:00"',
+        '"2","01-01-2024","18:00"',
+        '"3","02-01-2024","09:00"',
+    ]
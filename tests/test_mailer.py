@@ -0,0 +1,53 @@
+import time
+
+from aiosmtpd.controller import Controller
+
+from inzetbooster.mailer import Mailer, MailerPool, RateLimiter
+
+
+def mailer_options(controller: Controller) -> dict:
+    return {
+        "smtp_server": controller.hostname,
+        "smtp_port": controller.port,
+        "from_address": "coordinator@example.com",
+    }
+
+
+def test_mailer_send(smtp_server: Controller) -> None:
+    mailer = Mailer(**mailer_options(smtp_server))
+    msg_id = mailer.send("alice@example.com", "Alice", "Hello", "<p>Hi</p>")
+    mailer.close()
+    assert msg_id.startswith("<")
+    assert smtp_server.handler.messages == [
+        ("coordinator@example.com", ["alice@example.com"])
+    ]
+
+
+def test_mailer_reconnects(smtp_server: Controller) -> None:
+    mailer = Mailer(**mailer_options(smtp_server))
+    mailer.smtp.close()
+    mailer.send("alice@example.com", "Alice", "Hello", "<p>Hi</p>")
+    mailer.close()
+    assert len(smtp_server.handler.messages) == 1
+
+
+def test_mailer_pool(smtp_server: Controller) -> None:
+    with MailerPool(size=3, **mailer_options(smtp_server)) as pool:
+        futures = [
+            pool.submit(f"user{i}@example.com", f"User {i}", "Hello", "<p>Hi</p>")
+            for i in range(10)
+        ]
+        msg_ids = {future.result() for future in futures}
+        assert len(pool._mailers) <= 3
+    assert len(msg_ids) == 10
+    assert sorted(rcpt for _, (rcpt,) in smtp_server.handler.messages) == sorted(
+        f"user{i}@example.com" for i in range(10)
+    )
+
+
+def test_rate_limiter() -> None:
+    limiter = RateLimiter(50)
+    start = time.monotonic()
+    for _ in range(6):
+        limiter.wait()
+    assert time.monotonic() - start >= 0.1
@@ -0,0 +1,130 @@
+import datetime
+import os
+from pathlib import Path
+
+import jinja2
+import pytest
+from mjml import mjml2html
+
+from inzetbooster import mailtemplates, shifts
+from inzetbooster.mailtemplates import CompiledTemplates
+from inzetbooster.shifts import create_jinja_environment
+
+CONTEXT = {
+    "subject": "Aanmelding dienst Bar",
+    "name": "Alice <Alice>",
+    "date": datetime.date(2024, 1, 13),
+    "start_time": datetime.time(16, 0),
+    "end_time": datetime.time(18, 0),
+}
+
+
+def test_render_matches_mjml() -> None:
+    env = create_jinja_environment()
+    templates = CompiledTemplates(env)
+    expected = mjml2html(env.get_template("shift-10736.html").render(CONTEXT))
+    assert templates.render("shift-10736.html", CONTEXT) == expected
+
+
+def test_render_uses_disk_cache(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    env = create_jinja_environment()
+    html = CompiledTemplates(env, tmp_path).render("shift-10736.html", CONTEXT)
+    assert len(list(tmp_path.glob("*.html"))) == 1
+
+    def fail(mjml: str) -> str:
+        raise AssertionError("MJML should not be called")
+
+    monkeypatch.setattr(mailtemplates, "mjml2html", fail)
+    assert CompiledTemplates(env, tmp_path).render("shift-10736.html", CONTEXT) == html
+
+
+def test_render_falls_back_if_tags_are_mangled(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    calls = []
+
+    def fake_mjml2html(mjml: str) -> str:
+        calls.append(mjml)
+        return mjml.replace("{{", "").replace("}}", "")
+
+    monkeypatch.setattr(mailtemplates, "mjml2html", fake_mjml2html)
+    templates = CompiledTemplates(create_jinja_environment())
+    html = templates.render("shift-10736.html", CONTEXT)
+    assert "Alice &lt;Alice&gt;" in html
+    templates.render("shift-10736.html", CONTEXT)
+    # One failed compile, followed by a full render for every mail
+    assert len(calls) == 3
+
+
+def test_template_dir_overrides_bundled_templates(tmp_path: Path) -> None:
+    (tmp_path / "shift-10736.html").write_text("Hallo {{ name }}")
+    env = create_jinja_environment(template_dir=tmp_path)
+    assert env.get_template("shift-10736.html").render(name="Alice") == "Hallo Alice"
+    assert env.get_template("shift-11703.html") is not None
+
+
+def test_missing_template_is_remembered() -> None:
+    templates = CompiledTemplates(create_jinja_environment())
+    assert not templates.is_missing("shift-1.html")
+    with pytest.raises(jinja2.TemplateNotFound):
+        templates.render("shift-1.html", CONTEXT)
+    assert templates.is_missing("shift-1.html")
+    assert not templates.is_missing("shift-10736.html")
+
+
+def test_render_uses_bytecode_cache(
+    tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    env = create_jinja_environment()
+    html = CompiledTemplates(env, tmp_path).render("shift-10736.html", CONTEXT)
+    assert len(list(tmp_path.glob("__jinja2_*.cache"))) == 1
+
+    env = create_jinja_environment()
+
+    def fail(*args, **kwargs) -> None:
+        raise AssertionError("template should not be compiled")
+
+    monkeypatch.setattr(env, "compile", fail)
+    assert CompiledTemplates(env, tmp_path).render("shift-10736.html", CONTEXT) == html
+
+
+def test_refresh_reloads_changed_templates(tmp_path: Path) -> None:
+    path = tmp_path / "shift-1.html"
+    path.write_text(
+        "<mjml><mj-body><mj-text>Hallo {{ name }}</mj-text></mj-body></mjml>"
+    )
+    templates = CompiledTemplates(create_jinja_environment(template_dir=tmp_path))
+    with pytest.raises(jinja2.TemplateNotFound):
+        templates.render("shift-2.html", {})
+    assert "Hallo Alice" in templates.render("shift-1.html", {"name": "Alice"})
+
+    path.write_text("<mjml><mj-body><mj-text>Dag {{ name }}</mj-text></mj-body></mjml>")
+    os.utime(path, (path.stat().st_atime, path.stat().st_mtime + 10))
+    templates.refresh()
+    assert "Dag Alice" in templates.render("shift-1.html", {"name": "Alice"})
+
+    (tmp_path / "shift-2.html").write_text("Hoi {{ name }}")
+    templates.refresh()
+    assert not templates.is_missing("shift-2.html")
+    assert templates.exists("shift-2.html")
+
+
+def test_preload() -> None:
+    templates = CompiledTemplates(create_jinja_environment())
+    templates.preload()
+    assert set(templates._templates) == {
+        "shift-10736.html",
+        "shift-11703.html",
+        "shift-12079.html",
+    }
+
+
+def test_format_date_is_cached() -> None:
+    env = create_jinja_environment()
+    template = env.from_string("{{ date | format_date }}")
+    shifts._format_date.cache_clear()
+    for _ in range(3):
+        assert template.render(date=datetime.date(2024, 1, 13)) == "zaterdag 13 januari"
+    assert shifts._format_date.cache_info().hits == 2
@@ -0,0 +1,135 @@
+import urllib.request
+from pathlib import Path
+
+import httpx
+from aiosmtpd.controller import Controller
+
+from inzetbooster import inzetrooster, mailer, shifts
+from inzetbooster.auditlog import AuditLog
+from inzetbooster.metrics import (
+    CONTENT_TYPE,
+    Counter,
+    Gauge,
+    Histogram,
+    Registry,
+    start_http_server,
+    write_textfile,
+)
+
+
+def test_render() -> None:
+    registry = Registry()
+    counter = Counter("requests_total", "Requests", ["path"], registry=registry)
+    gauge = Gauge("temperature", "Temperature", registry=registry)
+    histogram = Histogram(
+        "latency_seconds", "Latency", registry=registry, buckets=(0.1, 1)
+    )
+    counter.inc(path='/a"b')
+    counter.inc(2, path="/c")
+    gauge.set(21.5)
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests",
+        "# TYPE requests_total counter",
+        'requests_total{path="/a\\"b"} 1.0',
+        'requests_total{path="/c"} 2.0',
+        "# HELP temperature Temperature",
+        "# TYPE temperature gauge",
+        "temperature 21.5",
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1.0',
+        'latency_seconds_bucket{le="1.0"} 2.0',
+        'latency_seconds_bucket{le="+Inf"} 3.0',
+        "latency_seconds_sum 5.55",
+        "latency_seconds_count 3.0",
+    ]
+
+
+def test_write_textfile(tmp_path: Path) -> None:
+    registry = Registry()
+    Counter("runs_total", "Runs", registry=registry).inc()
+    path = tmp_path / "inzetbooster.prom"
+    write_textfile(path, registry)
+    assert path.read_text() == registry.render()
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_http_server() -> None:
+    registry = Registry()
+    Counter("runs_total", "Runs", registry=registry).inc()
+    server = start_http_server(0, "127.0.0.1", registry)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url) as response:
+            assert response.headers["Content-Type"] == CONTENT_TYPE
+            assert response.read().decode() == registry.render()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_metered_transport() -> None:
+    endpoint = {"endpoint": "admin/shifts/export.csv"}
+    requests = {"method": "POST", "status": "200", **endpoint}
+    count = inzetrooster.REQUEST_SECONDS.count(**requests)
+    size = inzetrooster.RESPONSE_BYTES.value(**endpoint)
+
+    class Chunks(httpx.SyncByteStream):
+        def __iter__(self):
+            yield b"a,"
+            yield b"b"
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if "stream" in request.headers:
+            return httpx.Response(200, stream=Chunks())
+        return httpx.Response(200, text="a,b")
+
+    transport = httpx.MockTransport(handler)
+    with inzetrooster.create_client(transport) as client:
+        with client.stream(
+            "POST",
+            "https://example.com/org/admin/shifts/export.csv",
+            headers={"stream": "1"},
+        ) as response:
+            response.read()
+        client.post("https://example.com/org/admin/shifts/export.csv")
+
+    assert inzetrooster.REQUEST_SECONDS.count(**requests) == count + 2
+    assert inzetrooster.RESPONSE_BYTES.value(**endpoint) == size + 6
+
+
+def test_smtp_metrics(smtp_server: Controller) -> None:
+    sends = mailer.SMTP_SEND_SECONDS.count()
+    connections = mailer.SMTP_CONNECTIONS.value()
+    m = mailer.Mailer(
+        smtp_server=smtp_server.hostname,
+        smtp_port=smtp_server.port,
+        from_address="coordinator@example.com",
+    )
+    m.smtp.close()
+    m.send("alice@example.com", "Alice", "Hello", "<p>Hi</p>")
+    m.close()
+    assert mailer.SMTP_SEND_SECONDS.count() == sends + 1
+    assert mailer.SMTP_CONNECTIONS.value() == connections + 2
+    assert mailer.SMTP_FAILURES.value(error="SMTPServerDisconnected") >= 1
+
+
+def test_shift_metrics() -> None:
+    parsed = shifts.SHIFTS_PARSED.value()
+    not_covered = shifts.MAILS_SKIPPED.value(reason="not_covered")
+    export = (
+        "Dienst_id,Groep_id,Groep_naam,Datum,Starttijd,Eindtijd,"
+        "Gebruiker_id,Naam,Email,Opmerkingen\n"
+        "1,10736,Bar,13-01-2024,16:00,18:00,,,,\n"
+        "2,10736,Bar,13-01-2024,18:00,20:00,,,,\n"
+    )
+    auditlog = AuditLog(":memory:")
+    chunks = list(shifts.covered_shift_chunks(auditlog, shifts.parse_csv(export)))
+    auditlog.close()
+    assert chunks == []
+    assert shifts.SHIFTS_PARSED.value() == parsed + 2
+    assert shifts.MAILS_SKIPPED.value(reason="not_covered") == not_covered + 2
@@ -0,0 +1,186 @@
+import threading
+from pathlib import Path
+
+import pytest
+import structlog
+from click.testing import CliRunner
+
+from inzetbooster.cli import main
+from inzetbooster.organisations import (
+    Organisation,
+    OrganisationResult,
+    fan_out,
+    format_summary,
+    load_config,
+)
+
+from fakeinzetrooster import FakeInzetrooster
+
+CONFIG = """
+[defaults]
+smtp_server = "smtp.example.com"
+email_from_addr = "coordinator@example.com"
+
+[organisations.first]
+user = "admin"
+password = "secret"
+template_dir = "templates/first"
+
+[organisations.second]
+user = "other"
+password = "secret"
+smtp_server = "mail.example.com"
+"""
+
+
+def test_load_config(tmp_path: Path) -> None:
+    path = tmp_path / "config.toml"
+    path.write_text(CONFIG)
+    assert load_config(path) == [
+        Organisation(
+            "first",
+            "admin",
+            "secret",
+            {
+                "smtp_server": "smtp.example.com",
+                "email_from_addr": "coordinator@example.com",
+                "template_dir": tmp_path / "templates" / "first",
+            },
+        ),
+        Organisation(
+            "second",
+            "other",
+            "secret",
+            {
+                "smtp_server": "mail.example.com",
+                "email_from_addr": "coordinator@example.com",
+            },
+        ),
+    ]
+
+
+@pytest.mark.parametrize(
+    ["config", "error"],
+    [
+        ("", "no organisations configured"),
+        ('[organisations.first]\nuser = "admin"', "organisation first has no password"),
+        (
+            '[organisations.first]\nuser = "a"\npassword = "b"\nsmtp = "c"',
+            "unknown settings for organisation first: smtp",
+        ),
+    ],
+)
+def test_load_config_errors(tmp_path: Path, config: str, error: str) -> None:
+    path = tmp_path / "config.toml"
+    path.write_text(config)
+    with pytest.raises(ValueError, match=error):
+        load_config(path)
+
+
+def test_fan_out() -> None:
+    organisations = [Organisation(name, "user", "password") for name in "abcd"]
+    running = 0
+    max_running = 0
+    lock = threading.Lock()
+    bound = {}
+
+    def func(organisation: Organisation) -> int:
+        nonlocal running, max_running
+        bound[organisation.name] = structlog.contextvars.get_contextvars()["org"]
+        with lock:
+            running += 1
+            max_running = max(max_running, running)
+        threading.Event().wait(0.05)
+        with lock:
+            running -= 1
+        if organisation.name == "c":
+            raise RuntimeError("boom")
+        return 2
+
+    results = fan_out(organisations, func, workers=2)
+    assert [result.name for result in results] == ["a", "b", "c", "d"]
+    assert [result.mails for result in results] == [2, 2, None, 2]
+    assert [result.ok for result in results] == [True, True, False, True]
+    assert max_running == 2
+    assert bound == {name: name for name in "abcd"}
+
+
+def test_format_summary() -> None:
+    summary = format_summary(
+        [
+            OrganisationResult("first", 1.5, 3),
+            OrganisationResult("second", 0.25, None, RuntimeError("boom")),
+        ],
+        1.75,
+    )
+    assert summary.splitlines() == [
+        "organisation   seconds   mails  status",
+        "first             1.50       3  ok",
+        "second            0.25       -  failed: boom",
+        "total             1.75       3  1 failed",
+    ]
+
+
+def test_export_shifts_with_config(
+    inzetrooster_server: FakeInzetrooster, tmp_path: Path
+) -> None:
+    config = tmp_path / "config.toml"
+    config.write_text(f"""
+        [organisations.test]
+        user = "{inzetrooster_server.username}"
+        password = "{inzetrooster_server.password}"
+
+        [organisations.unknown]
+        user = "{inzetrooster_server.username}"
+        password = "{inzetrooster_server.password}"
+        """)
+    result = CliRunner().invoke(
+        main,
+        [
+            "--config",
+            str(config),
+            "--base-url",
+            inzetrooster_server.base_url,
+            "--no-reuse-session",
+            "export-shifts",
+        ],
+    )
+    assert result.exit_code == 1
+    assert inzetrooster_server.shifts_csv in result.stdout
+    summary = result.stderr.splitlines()
+    assert summary[1].split()[0] == "test"
+    assert summary[1].endswith("ok")
+    assert summary[2].split()[0] == "unknown"
+    assert "failed" in summary[2]
+
+
+def test_export_shifts_with_shard_export_setting(
+    inzetrooster_server: FakeInzetrooster, tmp_path: Path
+) -> None:
+    config = tmp_path / "config.toml"
+    config.write_text(f"""
+        [organisations.test]
+        user = "{inzetrooster_server.username}"
+        password = "{inzetrooster_server.password}"
+        shard_export = "date"
+        """)
+    result = CliRunner().invoke(
+        main,
+        [
+            "--config",
+            str(config),
+            "--base-url",
+            inzetrooster_server.base_url,
+            "--no-reuse-session",
+            "export-shifts",
+            "--from-date",
+            "2024-01-01",
+            "--to-date",
+            "2024-03-01",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    exports = [
+        path for _, path in inzetrooster_server.requests if path.endswith("export.csv")
+    ]
+    assert len(exports) == 3
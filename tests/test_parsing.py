@@ -0,0 +1,45 @@
+import datetime
+
+import pytest
+from inzetbooster.parsing import column_indexes, parse_date, parse_time
+
+
+@pytest.mark.parametrize(
+    ["value", "date"],
+    [
+        ("13-01-2024", datetime.date(2024, 1, 13)),
+        ("29-02-2024", datetime.date(2024, 2, 29)),
+        ("1-2-2024", datetime.date(2024, 2, 1)),
+    ],
+)
+def test_parse_date(value: str, date: datetime.date) -> None:
+    assert parse_date(value) == date
+
+
+@pytest.mark.parametrize("value", ["31-02-2024", "2024-01-13", "13-01-24", ""])
+def test_parse_date_invalid(value: str) -> None:
+    with pytest.raises(ValueError):
+        parse_date(value)
+
+
+@pytest.mark.parametrize(
+    ["value", "time"],
+    [
+        ("16:00", datetime.time(16, 0)),
+        ("9:30", datetime.time(9, 30)),
+    ],
+)
+def test_parse_time(value: str, time: datetime.time) -> None:
+    assert parse_time(value) == time
+
+
+@pytest.mark.parametrize("value", ["24:00", "16.00", ""])
+def test_parse_time_invalid(value: str) -> None:
+    with pytest.raises(ValueError):
+        parse_time(value)
+
+
+def test_column_indexes() -> None:
+    assert column_indexes(["a", "b", "c"], ("c", "a")) == [2, 0]
+    with pytest.raises(ValueError, match="missing CSV columns: d"):
+        column_indexes(["a", "b", "c"], ("a", "d"))
@@ -0,0 +1,95 @@
+import datetime
+import logging
+from unittest.mock import Mock
+
+import pytest
+import structlog
+
+from inzetbooster import logs
+from inzetbooster.auditlog import AuditLog
+from inzetbooster.pipeline import ShiftMailPipeline
+from inzetbooster.shifts import Shift
+
+
+def make_shift(id: int, **kw) -> Shift:
+    args = {
+        "id": id,
+        "group_id": 10736,
+        "group_name": "Bar",
+        "date": datetime.date(2024, 1, 13),
+        "start_time": datetime.time(16, 0),
+        "end_time": datetime.time(18, 0),
+        "user_id": "PRS2921",
+        "user_name": "Alice Alice",
+        "user_email": "alice@example.com",
+        "comments": "",
+    }
+    args.update(kw)
+    return Shift(**args)
+
+
+@pytest.fixture
+def auditlog():
+    auditlog = AuditLog(":memory:")
+    try:
+        yield auditlog
+    finally:
+        auditlog.close()
+
+
+def test_pipeline(auditlog: AuditLog) -> None:
+    auditlog.log_mail(2, "shift-10736.html", "alice@example.com", "<old>")
+    mailer = Mock()
+    mailer.send.side_effect = lambda **kw: f"<{kw['to_addr']}>"
+    shifts = [
+        make_shift(1),
+        make_shift(2),
+        make_shift(3, user_id=None, user_name=None, user_email=None),
+        make_shift(4, group_id=404),
+        make_shift(5, user_email="bob@example.com"),
+    ]
+    stats = ShiftMailPipeline(auditlog, mailer, render_workers=2, queue_size=1).run(
+        shifts
+    )
+    assert sorted(call.kwargs["to_addr"] for call in mailer.send.call_args_list) == [
+        "alice@example.com",
+        "bob@example.com",
+    ]
+    assert auditlog.sent_mails([1, 5]) == {
+        (1, "shift-10736.html", "alice@example.com"),
+        (5, "shift-10736.html", "bob@example.com"),
+    }
+    assert stats["producer"].items == 3
+    assert stats["render"].items == 2
+    assert stats["send"].items == 2
+    assert stats["send"].max_queue_depth <= 1
+
+
+def test_pipeline_send_failure(auditlog: AuditLog) -> None:
+    mailer = Mock()
+    mailer.send.side_effect = ConnectionError("SMTP server is gone")
+    pipeline = ShiftMailPipeline(auditlog, mailer, render_workers=1, queue_size=1)
+    with pytest.raises(ConnectionError):
+        pipeline.run(make_shift(i) for i in range(20))
+    assert auditlog.sent_mails(range(20)) == set()
+    # Aborted stages still report when they stopped
+    for stats in pipeline.stats.values():
+        assert stats.seconds >= 0
+
+
+def test_render_workers_use_log_settings(
+    auditlog: AuditLog, capfd: pytest.CaptureFixture, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr(logs, "_settings", None)
+    logs.configure(logging.WARNING, json=True)
+    try:
+        mailer = Mock()
+        mailer.send.return_value = "<msgid>"
+        pipeline = ShiftMailPipeline(auditlog, mailer, render_workers=1)
+        pipeline.run([make_shift(1), make_shift(2, group_id=404)])
+    finally:
+        structlog.reset_defaults()
+    out, err = capfd.readouterr()
+    assert "generating email" not in out
+    # The missing template is logged as JSON
+    assert '"event": "template was not found, can not send email"' in out
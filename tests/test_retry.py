@@ -0,0 +1,145 @@
+import random
+
+import httpx
+import pytest
+from inzetbooster.inzetrooster import Inzetrooster, create_client
+from inzetbooster.retry import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+from fakeinzetrooster import FakeInzetrooster
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def client(
+    server: FakeInzetrooster, breaker: CircuitBreaker, sleeps: list[float]
+) -> httpx.Client:
+    return create_client(retries=3, timeout=5, breaker=breaker, sleep=sleeps.append)
+
+
+def login(server: FakeInzetrooster, client: httpx.Client) -> Inzetrooster:
+    ir = Inzetrooster(client, server.organisation, base_url=server.base_url)
+    ir.login(server.username, server.password)
+    return ir
+
+
+def test_retry_policy() -> None:
+    policy = RetryPolicy(retries=2, backoff=1, max_backoff=3, rng=random.Random(1))
+    get = httpx.Request("GET", "https://example.com/")
+    post = httpx.Request("POST", "https://example.com/")
+    export = httpx.Request(
+        "POST", "https://example.com/", extensions={"inzetbooster.idempotent": True}
+    )
+    assert policy.should_retry(get, 0, status=502)
+    assert not policy.should_retry(get, 2, status=502)
+    assert not policy.should_retry(get, 0, status=500)
+    assert not policy.should_retry(post, 0, status=502)
+    assert policy.should_retry(export, 0, status=502)
+    assert policy.should_retry(post, 0, error=httpx.ConnectError("refused"))
+    assert not policy.should_retry(post, 0, error=httpx.ReadTimeout("timeout"))
+    assert policy.should_retry(get, 0, error=httpx.ReadTimeout("timeout"))
+
+    assert all(0 <= policy.delay(attempt) <= 3 for attempt in range(10))
+    response = httpx.Response(503, headers={"Retry-After": "2"})
+    assert policy.delay(0, response) == 2
+
+
+def test_circuit_breaker() -> None:
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10, clock=clock)
+    request = httpx.Request("GET", "https://example.com/")
+    breaker.record_failure()
+    breaker.check(request)
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.check(request)
+
+    clock.now = 10
+    breaker.check(request)
+    assert breaker.state == "half-open"
+    # Only one trial request at a time
+    with pytest.raises(CircuitOpenError):
+        breaker.check(request)
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    clock.now = 20
+    breaker.check(request)
+    breaker.record_success()
+    assert breaker.state == "closed"
+    breaker.check(request)
+
+
+def test_circuit_breaker_lost_trial() -> None:
+    clock = Clock()
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, clock=clock)
+    request = httpx.Request("GET", "https://example.com/")
+    breaker.record_failure()
+
+    # The trial request is cancelled, so its outcome is never recorded
+    clock.now = 10
+    breaker.check(request)
+    clock.now = 19
+    with pytest.raises(CircuitOpenError):
+        breaker.check(request)
+    clock.now = 20
+    breaker.check(request)
+    assert breaker.state == "half-open"
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_export_retries_bad_gateway(inzetrooster_server: FakeInzetrooster) -> None:
+    sleeps: list[float] = []
+    with client(inzetrooster_server, CircuitBreaker(), sleeps) as c:
+        ir = login(inzetrooster_server, c)
+        inzetrooster_server.faults = [502, "drop", 503]
+        inzetrooster_server.requests.clear()
+        assert ir.export_shifts() == inzetrooster_server.shifts_csv
+    assert len(sleeps) == 3
+    assert inzetrooster_server.requests[-2:] == [
+        ("GET", "/test/admin/shifts/export"),
+        ("POST", "/test/admin/shifts/export.csv"),
+    ]
+
+
+def test_export_csv_post_is_retried(inzetrooster_server: FakeInzetrooster) -> None:
+    sleeps: list[float] = []
+    with client(inzetrooster_server, CircuitBreaker(), sleeps) as c:
+        ir = login(inzetrooster_server, c)
+        assert ir.export_users() == inzetrooster_server.users_csv
+        inzetrooster_server.faults = [504]
+        assert ir.export_users() == inzetrooster_server.users_csv
+    assert len(sleeps) == 1
+
+
+def test_import_is_not_retried(inzetrooster_server: FakeInzetrooster) -> None:
+    sleeps: list[float] = []
+    with client(inzetrooster_server, CircuitBreaker(), sleeps) as c:
+        ir = login(inzetrooster_server, c)
+        ir.export_users()
+        inzetrooster_server.faults = [502]
+        inzetrooster_server.requests.clear()
+        with pytest.raises(AssertionError):
+            ir.import_users("Id,Email\n")
+    assert sleeps == []
+    assert inzetrooster_server.requests == [("POST", "/test/admin/person_imports")]
+
+
+def test_circuit_opens_when_server_is_down(
+    inzetrooster_server: FakeInzetrooster,
+) -> None:
+    sleeps: list[float] = []
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    inzetrooster_server.faults = [503] * 10
+    with client(inzetrooster_server, breaker, sleeps) as c:
+        with pytest.raises(CircuitOpenError):
+            login(inzetrooster_server, c)
+        with pytest.raises(CircuitOpenError):
+            login(inzetrooster_server, c)
+    assert len(inzetrooster_server.requests) == 3
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import threading
+from pathlib import Path
+
+import httpx
+import pytest
+from inzetbooster.inzetrooster import Inzetrooster, export_shifts_for_organisations
+from inzetbooster.session import Session, SessionStore
+
+from fakeinzetrooster import FakeInzetrooster
+
+
+def login(
+    server: FakeInzetrooster, store: SessionStore, client: httpx.Client
+) -> Inzetrooster:
+    ir = Inzetrooster(
+        client, server.organisation, session_store=store, base_url=server.base_url
+    )
+    ir.login(server.username, server.password)
+    return ir
+
+
+def test_session_store(tmp_path: Path) -> None:
+    store = SessionStore(tmp_path / "sessions.json")
+    assert store.load("org", "user") is None
+
+    session = Session(
+        cookies=[{"name": "a", "value": "b", "domain": "x", "path": "/"}],
+        csrf_token="TOKEN",
+    )
+    store.save("org", "user", session)
+    assert store.load("org", "user") == session
+    assert store.load("org", "other") is None
+    assert os.stat(store.path).st_mode & 0o777 == 0o600
+
+    store.delete("org", "user")
+    assert store.load("org", "user") is None
+
+
+def test_session_store_corrupt_file(tmp_path: Path) -> None:
+    path = tmp_path / "sessions.json"
+    path.write_text("{not json")
+    assert SessionStore(path).load("org", "user") is None
+
+
+def test_session_store_concurrent_saves(tmp_path: Path) -> None:
+    store = SessionStore(tmp_path / "sessions.json")
+
+    def save(organisation: str) -> None:
+        for i in range(25):
+            store.save(organisation, "user", Session(csrf_token=str(i)))
+
+    threads = [threading.Thread(target=save, args=(f"org{i}",)) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for i in range(4):
+        assert store.load(f"org{i}", "user") == Session(csrf_token="24")
+    assert os.listdir(tmp_path) == ["sessions.json"]
+
+
+def test_reuse_session(inzetrooster_server: FakeInzetrooster, tmp_path: Path) -> None:
+    store = SessionStore(tmp_path / "sessions.json")
+    with httpx.Client(follow_redirects=True) as client:
+        login(inzetrooster_server, store, client).export_users()
+    assert inzetrooster_server.logins == 1
+
+    inzetrooster_server.requests.clear()
+    with httpx.Client(follow_redirects=True) as client:
+        ir = login(inzetrooster_server, store, client)
+        assert ir.export_users() == inzetrooster_server.users_csv
+    assert inzetrooster_server.logins == 1
+    # The stored CSRF token is used, so only the export itself is requested
+    assert inzetrooster_server.requests == [("POST", "/test/admin/people/export.csv")]
+
+
+def test_expired_session(inzetrooster_server: FakeInzetrooster, tmp_path: Path) -> None:
+    store = SessionStore(tmp_path / "sessions.json")
+    with httpx.Client(follow_redirects=True) as client:
+        login(inzetrooster_server, store, client)
+    inzetrooster_server.expire_sessions()
+
+    with httpx.Client(follow_redirects=True) as client:
+        ir = login(inzetrooster_server, store, client)
+        assert inzetrooster_server.logins == 1
+        with ir.stream_shifts() as export:
+            assert export.read() == inzetrooster_server.shifts_csv
+        inzetrooster_server.expire_sessions()
+        ir.make_all_users_inactive()
+    assert inzetrooster_server.logins == 3
+
+    # The new session was stored
+    inzetrooster_server.requests.clear()
+    with httpx.Client(follow_redirects=True) as client:
+        login(inzetrooster_server, store, client).export_users()
+    assert inzetrooster_server.logins == 3
+
+
+def test_invalid_credentials(
+    inzetrooster_server: FakeInzetrooster, tmp_path: Path
+) -> None:
+    store = SessionStore(tmp_path / "sessions.json")
+    with httpx.Client(follow_redirects=True) as client:
+        ir = Inzetrooster(
+            client,
+            inzetrooster_server.organisation,
+            session_store=store,
+            base_url=inzetrooster_server.base_url,
+        )
+        with pytest.raises(ValueError, match="invalid credentials"):
+            ir.login(inzetrooster_server.username, "wrong")
+    assert store.load(inzetrooster_server.organisation, "admin") is None
+
+
+def test_async_export_reuses_session(
+    inzetrooster_server: FakeInzetrooster, tmp_path: Path
+) -> None:
+    store = SessionStore(tmp_path / "sessions.json")
+
+    def export() -> dict[str, str]:
+        return asyncio.run(
+            export_shifts_for_organisations(
+                [inzetrooster_server.organisation],
+                inzetrooster_server.username,
+                inzetrooster_server.password,
+                base_url=inzetrooster_server.base_url,
+                session_store=store,
+            )
+        )
+
+    expected = {inzetrooster_server.organisation: inzetrooster_server.shifts_csv}
+    assert export() == expected
+    assert export() == expected
+    assert inzetrooster_server.logins == 1
+
+    inzetrooster_server.expire_sessions()
+    assert export() == expected
+    assert inzetrooster_server.logins == 2
+    # The sync client uses the session stored by the async one
+    with httpx.Client(follow_redirects=True) as client:
+        login(inzetrooster_server, store, client).export_users()
+    assert inzetrooster_server.logins == 2
@@ -1,9 +1,21 @@
+import csv
+import dataclasses
 import datetime
-from typing import Any
-from unittest.mock import Mock, ANY
+import io
+from concurrent.futures import Future
+from typing import Any, Iterator
+from unittest.mock import Mock, ANY, patch
 
 import pytest
-from inzetbooster.shifts import Shift, parse_csv, send_shift_mails
+from inzetbooster.auditlog import AuditLog
+from inzetbooster.mailer import MailerPool
+from inzetbooster.shifts import (
+    Shift,
+    ShiftSnapshot,
+    drain_outbox,
+    parse_csv,
+    send_shift_mails,
+)
 
 
 @pytest.mark.parametrize(
@@ -81,8 +93,12 @@ from inzetbooster.shifts import Shift, parse_csv, send_shift_mails
         ),
     ],
 )
-def test_from_record(record: dict[str, str], shift: Shift):
-    assert Shift.from_record(record) == shift
+def test_parse_csv_record(record: dict[str, str], shift: Shift):
+    output = io.StringIO()
+    writer = csv.DictWriter(output, record.keys(), dialect=csv.unix_dialect)
+    writer.writeheader()
+    writer.writerow(record)
+    assert list(parse_csv(output.getvalue())) == [shift]
 
 
 @pytest.mark.parametrize(
@@ -112,7 +128,7 @@ def test_parse_csv():
 "2891448","12079","Bar met ervaring","13-01-2024"," Zaterdag","15:30","18:30","03:00","PRS2921","Alice Alice","alice@example.com","","","","","","","Nieuwjaarsborrel"
 "2926209","10736","Bar","13-01-2024"," Zaterdag","16:00","18:00","02:00","","","","","","","","","",""
 """
-    assert parse_csv(input) == [
+    assert list(parse_csv(input)) == [
         Shift(
             id=2891448,
             group_id=12079,
@@ -140,9 +156,24 @@ def test_parse_csv():
     ]
 
 
-def test_send_shift_mails_uncovered_shift() -> None:
-    auditlog = Mock()
+@pytest.fixture
+def auditlog() -> Iterator[Mock]:
+    """An in-memory audit log that records calls."""
+    db = AuditLog(":memory:")
+    try:
+        yield Mock(wraps=db)
+    finally:
+        db.close()
+
+
+@pytest.fixture
+def mailer() -> Mock:
     mailer = Mock()
+    mailer.send.return_value = "<msgid@example.com>"
+    return mailer
+
+
+def test_send_shift_mails_uncovered_shift(auditlog: Mock, mailer: Mock) -> None:
     send_shift_mails(
         auditlog,
         mailer,
@@ -161,14 +192,12 @@ def test_send_shift_mails_uncovered_shift() -> None:
             ),
         ],
     )
-    auditlog.was_mail_send.assert_not_called()
+    auditlog.sent_mails.assert_not_called()
     mailer.send.assert_not_called()
 
 
-def test_send_shift_mails_new_shift() -> None:
-    auditlog = Mock()
-    mailer = Mock()
-    auditlog.was_mail_send.return_value = False
+def test_send_shift_mails_new_shift(auditlog: Mock, mailer: Mock) -> None:
+    auditlog.sent_mails.return_value = set()
     send_shift_mails(
         auditlog,
         mailer,
@@ -187,21 +216,23 @@ def test_send_shift_mails_new_shift() -> None:
             ),
         ],
     )
-    auditlog.was_mail_send.assert_called_once_with(
-        2926209, "shift-10736.html", "alice@example.com"
-    )
+    auditlog.sent_mails.assert_called_once()
+    assert list(auditlog.sent_mails.call_args.args[0]) == [2926209]
     mailer.send.assert_called_once_with(
         to_addr="alice@example.com",
         to_name="Alice Alice",
         subject="Aanmelding dienst Bar",
         html=ANY,
+        msg_id=ANY,
     )
+    assert auditlog.was_mail_send(2926209, "shift-10736.html", "alice@example.com")
+    assert auditlog.outbox_stats().depth == 0
 
 
-def test_send_shift_mails_already_send() -> None:
-    auditlog = Mock()
-    mailer = Mock()
-    auditlog.was_mail_send.return_value = True
+def test_send_shift_mails_already_send(auditlog: Mock, mailer: Mock) -> None:
+    auditlog.sent_mails.return_value = {
+        (2926209, "shift-10736.html", "alice@example.com")
+    }
     send_shift_mails(
         auditlog,
         mailer,
@@ -220,16 +251,13 @@ def test_send_shift_mails_already_send() -> None:
             ),
         ],
     )
-    auditlog.was_mail_send.assert_called_once_with(
-        2926209, "shift-10736.html", "alice@example.com"
-    )
+    auditlog.sent_mails.assert_called_once()
+    assert list(auditlog.sent_mails.call_args.args[0]) == [2926209]
     mailer.send.assert_not_called()
 
 
-def test_send_shift_mails_missing_template() -> None:
-    auditlog = Mock()
-    mailer = Mock()
-    auditlog.was_mail_send.return_value = False
+def test_send_shift_mails_missing_template(auditlog: Mock, mailer: Mock) -> None:
+    auditlog.sent_mails.return_value = set()
     send_shift_mails(
         auditlog,
         mailer,
@@ -248,7 +276,248 @@ def test_send_shift_mails_missing_template() -> None:
             ),
         ],
     )
-    auditlog.was_mail_send.assert_called_once_with(
-        2926209, "shift-404.html", "alice@example.com"
+    auditlog.sent_mails.assert_called_once()
+    mailer.send.assert_not_called()
+
+
+def test_send_shift_mails_mailer_pool(auditlog: Mock) -> None:
+    auditlog.sent_mails.return_value = set()
+    mailer = Mock(spec=MailerPool)
+    future: Future = Future()
+    future.set_result("<msgid@example.com>")
+    mailer.submit.return_value = future
+    send_shift_mails(
+        auditlog,
+        mailer,
+        [
+            Shift(
+                id=2926209,
+                group_id=10736,
+                group_name="Bar",
+                date=datetime.date(2024, 1, 13),
+                start_time=datetime.time(16, 0),
+                end_time=datetime.time(18, 0),
+                user_id="PRS2921",
+                user_name="Alice Alice",
+                user_email="alice@example.com",
+                comments="Nieuwjaarsborrel",
+            ),
+        ],
+    )
+    mailer.submit.assert_called_once_with(
+        to_addr="alice@example.com",
+        to_name="Alice Alice",
+        subject="Aanmelding dienst Bar",
+        html=ANY,
+        msg_id=ANY,
+    )
+    auditlog.complete_mail.assert_called_once_with(ANY, "<msgid@example.com>")
+    assert auditlog.was_mail_send(2926209, "shift-10736.html", "alice@example.com")
+
+
+def test_send_shift_mails_resumes_outbox(
+    auditlog: Mock, mailer: Mock, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr("inzetbooster.auditlog.OUTBOX_RETRY_DELAY", -1)
+    alice = Shift(
+        id=2926209,
+        group_id=10736,
+        group_name="Bar",
+        date=datetime.date(2024, 1, 13),
+        start_time=datetime.time(16, 0),
+        end_time=datetime.time(18, 0),
+        user_id="PRS2921",
+        user_name="Alice Alice",
+        user_email="alice@example.com",
+        comments="",
+    )
+    bob = dataclasses.replace(
+        alice, id=2926210, user_id="PRS2922", user_name="Bob", user_email="bob@x.nl"
     )
+    mailer.send.side_effect = ["<msgid@example.com>", ConnectionRefusedError()]
+    with pytest.raises(ConnectionRefusedError):
+        send_shift_mails(auditlog, mailer, [alice, bob])
+    failed_msg_id = mailer.send.call_args.kwargs["msg_id"]
+    assert auditlog.outbox_stats().depth == 1
+    assert auditlog.enqueue_mail.call_count == 2
+
+    mailer.send.reset_mock(side_effect=True)
+    send_shift_mails(auditlog, mailer, [alice, bob])
+    # Bob's mail is sent from the outbox, with the same message id
+    mailer.send.assert_called_once_with(
+        to_addr="bob@x.nl", to_name="Bob", subject=ANY, html=ANY, msg_id=failed_msg_id
+    )
+    assert auditlog.enqueue_mail.call_count == 2
+    assert auditlog.was_mail_send(2926210, "shift-10736.html", "bob@x.nl")
+    assert auditlog.outbox_stats().depth == 0
+
+
+def test_send_shift_mails_outbox_per_organisation(
+    auditlog: Mock, mailer: Mock, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr("inzetbooster.auditlog.OUTBOX_RETRY_DELAY", -1)
+    shift = Shift(
+        id=2926209,
+        group_id=10736,
+        group_name="Bar",
+        date=datetime.date(2024, 1, 13),
+        start_time=datetime.time(16, 0),
+        end_time=datetime.time(18, 0),
+        user_id="PRS2921",
+        user_name="Alice Alice",
+        user_email="alice@example.com",
+        comments="",
+    )
+    mailer.send.side_effect = ConnectionRefusedError()
+    with pytest.raises(ConnectionRefusedError):
+        send_shift_mails(auditlog, mailer, [shift], organisation="a")
+
+    # Another organisation does not send the mail through its own mailer
+    other_mailer = Mock()
+    assert send_shift_mails(auditlog, other_mailer, [], organisation="b") == 0
+    other_mailer.send.assert_not_called()
+
+    mailer.send.reset_mock(side_effect=True)
+    assert send_shift_mails(auditlog, mailer, [], organisation="a") == 1
+    assert auditlog.was_mail_send(2926209, "shift-10736.html", "alice@example.com")
+
+
+def test_drain_outbox_renews_lease(
+    auditlog: Mock, mailer: Mock, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    monkeypatch.setattr("inzetbooster.shifts.LEASE_RENEW_INTERVAL", -1)
+    for i in range(3):
+        auditlog.enqueue_mail(
+            i, "shift-10736.html", f"{i}@x.nl", None, "", "", f"<{i}>"
+        )
+    assert drain_outbox(auditlog, mailer) == 3
+    assert auditlog.renew_lease.call_count == 3
+    assert len(auditlog.sent_mails(range(3))) == 3
+
+
+@pytest.fixture
+def volunteer_shifts() -> list[Shift]:
+    bar = Shift(
+        id=1,
+        group_id=10736,
+        group_name="Bar",
+        date=datetime.date(2024, 1, 20),
+        start_time=datetime.time(16, 0),
+        end_time=datetime.time(18, 0),
+        user_id="PRS2921",
+        user_name="Alice Alice",
+        user_email="alice@example.com",
+        comments="",
+    )
+    return [
+        bar,
+        dataclasses.replace(bar, id=2, group_id=11703, date=datetime.date(2024, 1, 13)),
+        dataclasses.replace(
+            bar, id=3, user_id="PRS2922", user_name="Bob", user_email="bob@x.nl"
+        ),
+        dataclasses.replace(bar, id=4, group_id=404),
+    ]
+
+
+def test_send_shift_mails_digest(
+    auditlog: Mock, mailer: Mock, volunteer_shifts: list[Shift]
+) -> None:
+    assert send_shift_mails(auditlog, mailer, volunteer_shifts, digest="all") == 2
+    assert mailer.send.call_count == 2
+    alice, bob = sorted(
+        (call.kwargs for call in mailer.send.call_args_list),
+        key=lambda kwargs: kwargs["to_addr"],
+    )
+    assert alice["subject"] == "Aanmelding 2 diensten"
+    # Ordered by date
+    assert alice["html"].index("13 januari") < alice["html"].index("20 januari")
+    assert bob["subject"] == "Aanmelding dienst Bar"
+    assert auditlog.sent_mails(range(5)) == {
+        (1, "shift-10736.html", "alice@example.com"),
+        (2, "shift-11703.html", "alice@example.com"),
+        (3, "shift-10736.html", "bob@x.nl"),
+    }
+
+    mailer.send.reset_mock()
+    send_shift_mails(auditlog, mailer, volunteer_shifts, digest="all")
+    send_shift_mails(auditlog, mailer, volunteer_shifts)
     mailer.send.assert_not_called()
+
+
+def test_send_shift_mails_digest_same_group(
+    auditlog: Mock, mailer: Mock, volunteer_shifts: list[Shift]
+) -> None:
+    send_shift_mails(auditlog, mailer, volunteer_shifts, digest="same-group")
+    assert sorted(call.kwargs["subject"] for call in mailer.send.call_args_list) == [
+        "Aanmelding dienst Bar",
+        "Aanmelding dienst Bar",
+        "Aanmelding dienst Bar",
+    ]
+    assert len(auditlog.sent_mails(range(5))) == 3
+
+
+def test_send_shift_mails_skips_archived_shifts(
+    auditlog: Mock, mailer: Mock, volunteer_shifts: list[Shift], tmp_path
+) -> None:
+    alice, _, bob, _ = volunteer_shifts
+    bob = dataclasses.replace(bob, date=datetime.date.today())
+    auditlog.compact(str(tmp_path / "archive.db"), 30)
+    send_shift_mails(auditlog, mailer, [alice, bob])
+    mailer.send.assert_called_once()
+    assert mailer.send.call_args.kwargs["to_addr"] == "bob@x.nl"
+
+
+def test_shift_snapshot() -> None:
+    auditlog = AuditLog(":memory:")
+    try:
+        bar = Shift(
+            id=1,
+            group_id=10736,
+            group_name="Bar",
+            date=datetime.date(2024, 1, 13),
+            start_time=datetime.time(16, 0),
+            end_time=datetime.time(18, 0),
+            comments="",
+        )
+        cleaning = dataclasses.replace(bar, id=2, group_id=11703)
+
+        snapshot = ShiftSnapshot(auditlog, "myorg")
+        assert snapshot.full_refresh
+        assert list(snapshot.changed([bar, cleaning])) == [bar, cleaning]
+        snapshot.commit()
+
+        snapshot = ShiftSnapshot(auditlog, "myorg")
+        assert not snapshot.full_refresh
+        covered = dataclasses.replace(bar, user_id="PRS2921")
+        assert list(snapshot.changed([covered, cleaning])) == [covered]
+        # Without a commit the changes are seen again
+        snapshot = ShiftSnapshot(auditlog, "myorg")
+        assert list(snapshot.changed([covered, cleaning])) == [covered]
+
+        snapshot = ShiftSnapshot(auditlog, "myorg", full_refresh_after=0)
+        assert list(snapshot.changed([bar, cleaning])) == [bar, cleaning]
+
+        # Only new and changed hashes are stored
+        uncovered = dataclasses.replace(bar, start_time=datetime.time(17, 0))
+        snapshot = ShiftSnapshot(auditlog, "myorg", full_refresh_after=0)
+        assert list(snapshot.changed([uncovered, cleaning])) == [uncovered, cleaning]
+        with patch.object(auditlog, "store_shift_hashes") as store:
+            snapshot.commit()
+        store.assert_called_once_with(
+            "myorg", {1: uncovered.content_hash}, {1: uncovered.date}
+        )
+    finally:
+        auditlog.close()
+
+
+def test_shift_snapshot_skips_unmailed_shifts(
+    auditlog: Mock, mailer: Mock, volunteer_shifts: list[Shift]
+) -> None:
+    snapshot = ShiftSnapshot(auditlog, "myorg")
+    send_shift_mails(auditlog, mailer, snapshot.changed(volunteer_shifts))
+    assert mailer.send.call_count == 3
+    snapshot.commit()
+
+    # The group without a template may get one before the next run
+    snapshot = ShiftSnapshot(auditlog, "myorg")
+    assert list(snapshot.changed(volunteer_shifts)) == volunteer_shifts[3:]
@@ -0,0 +1,65 @@
+import subprocess
+import sys
+
+import pytest
+
+# Modules that are slow to import and only needed by some commands
+HEAVY_MODULES = {"babel", "bs4", "html5lib", "jinja2", "mjml", "openpyxl"}
+
+# Generous, so the test only fails if a command starts importing far more
+# than it needs. Measured in microseconds of import time.
+STARTUP_BUDGET = 500_000
+
+
+def import_times(*modules: str) -> dict[str, int]:
+    """Import modules in a fresh interpreter and return the import times.
+
+    Returns the cumulative import time per top level module, as reported by
+    `python -X importtime`. The fastest of three runs is used to reduce the
+    effect of a busy machine.
+    """
+    code = "; ".join(f"import {module}" for module in modules)
+    best: dict[str, int] | None = None
+    for _ in range(3):
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        times = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "cumulative" in line:
+                continue
+            _, cumulative, name = line[len("import time:") :].split("|")
+            if not name.startswith("  "):
+                times[name.strip()] = int(cumulative)
+        if best is None or sum(times.values()) < sum(best.values()):
+            best = times
+    assert best is not None
+    return best
+
+
+def imported(times: dict[str, int]) -> set[str]:
+    return {name.split(".")[0] for name in times}
+
+
+@pytest.mark.parametrize(
+    ["command", "modules", "allowed"],
+    [
+        ("--help", [], set()),
+        ("export-shifts", ["inzetbooster.inzetrooster"], set()),
+        ("send-shift-mails", ["inzetbooster.runner"], {"jinja2"}),
+        ("serve", ["inzetbooster.runner", "inzetbooster.daemon"], {"jinja2"}),
+        (
+            "sync-users-from-manegeplan",
+            ["inzetbooster.users", "inzetbooster.inzetrooster"],
+            set(),
+        ),
+    ],
+)
+def test_startup_imports(command: str, modules: list[str], allowed: set[str]):
+    times = import_times("inzetbooster.cli", *modules)
+    assert imported(times) & HEAVY_MODULES <= allowed
+    total = sum(time for name, time in times.items() if name != "site")
+    assert total < STARTUP_BUDGET, f"{command} takes {total / 1000:.0f}ms to import"
@@ -0,0 +1,77 @@
+import datetime
+import json
+import pstats
+from pathlib import Path
+from typing import Iterator
+from unittest.mock import Mock
+
+import pytest
+from structlog.contextvars import bound_contextvars
+
+from inzetbooster import tracing
+from inzetbooster.auditlog import AuditLog
+from inzetbooster.shifts import Shift, send_shift_mails
+
+
+@pytest.fixture
+def tracer() -> Iterator[tracing.Tracer]:
+    tracer = tracing.enable(profile_render=True)
+    try:
+        yield tracer
+    finally:
+        tracing.disable()
+
+
+def test_disabled() -> None:
+    @tracing.traced("double")
+    def double(x: int) -> int:
+        return x * 2
+
+    with tracing.span("noop"):
+        assert double(2) == 4
+    tracing.record("noop", 0, 1)
+    with tracing.profile_render():
+        pass
+
+
+def test_spans_include_context(tracer: tracing.Tracer) -> None:
+    with bound_contextvars(org="test"):
+        with tracing.span("outer", rows=3):
+            with tracing.span("inner"):
+                pass
+    outer, inner = sorted(tracer.events, key=lambda event: event["ts"])
+    assert outer["name"] == "outer"
+    assert outer["ph"] == "X"
+    assert outer["args"] == {"org": "test", "rows": 3}
+    assert inner["args"] == {"org": "test"}
+    assert outer["ts"] <= inner["ts"]
+    assert inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]
+
+
+def test_send_shift_mails_trace(tracer: tracing.Tracer, tmp_path: Path) -> None:
+    auditlog = AuditLog(":memory:")
+    mailer = Mock()
+    mailer.send.return_value = "<msgid@example.com>"
+    shift = Shift(
+        id=2926209,
+        group_id=10736,
+        group_name="Bar",
+        date=datetime.date(2024, 1, 13),
+        start_time=datetime.time(16, 0),
+        end_time=datetime.time(18, 0),
+        user_id="PRS2921",
+        user_name="Alice Alice",
+        user_email="alice@example.com",
+        comments="",
+    )
+    send_shift_mails(auditlog, mailer, [shift])
+    auditlog.close()
+
+    trace_path, profile_path = tracer.write(tmp_path / "profile")
+    trace = json.loads(trace_path.read_text())
+    spans = {
+        event["name"]: event for event in trace["traceEvents"] if event["ph"] == "X"
+    }
+    assert {"send_shift_mails", "shift", "render", "auditlog.sent_mails"} <= set(spans)
+    assert spans["render"]["args"]["shift_id"] == 2926209
+    assert pstats.Stats(str(profile_path)).total_calls > 0
@@ -1,8 +1,9 @@
+import dataclasses
 import datetime
 from pathlib import Path
 
 import pytest
-from inzetbooster.users import Person, parse_csv, read_manegeplan_export
+from inzetbooster.users import Person, diff_users, parse_csv, read_manegeplan_export
 
 
 @pytest.mark.parametrize(
@@ -123,3 +124,45 @@ def test_parse_csv():
             last_login=None,
         ),
     ]
+
+
+def test_diff_users() -> None:
+    today = datetime.date(2024, 4, 1)
+    unchanged = Person("PRS1", "Alice", "", "Smith", "alice@example.com")
+    renamed = Person("PRS2", "Bob", "", "Jones", "bob@example.com")
+    reactivated = Person("PRS3", "Carol", "", "White", "carol@example.com")
+    new_id = Person("PRS9", "Dave", "", "Brown", "Dave@example.com")
+    added = Person("PRS5", "Eve", "", "Black", "eve@example.com")
+    existing = [
+        dataclasses.replace(unchanged, username="alice", exempt=False),
+        dataclasses.replace(renamed, surname="Smith"),
+        dataclasses.replace(reactivated, deactived_date=datetime.date(2024, 1, 1)),
+        Person("PRS4", "Dave", "", "Brown", "dave@example.com"),
+        Person("PRS6", "Frank", "", "Gone", "frank@example.com"),
+        Person("PRS7", "Gina", "", "Gone", "gina@example.com", deactived_date=today),
+        Person("2", "Coordinator", "", "Club", "coordinator@example.com"),
+    ]
+    changes = diff_users(
+        [unchanged, renamed, reactivated, new_id, added], existing, today
+    )
+    assert changes.add == [added]
+    assert changes.update == [
+        renamed,
+        reactivated,
+        dataclasses.replace(new_id, id="PRS4"),
+    ]
+    assert [person.id for person in changes.deactivate] == ["PRS6"]
+    assert [person.id for person in changes.unchanged] == ["PRS1", "2"]
+    assert [person.id for person in changes.active()] == [
+        "PRS1",
+        "2",
+        "PRS5",
+        "PRS2",
+        "PRS3",
+        "PRS4",
+    ]
+
+
+def test_diff_users_in_sync() -> None:
+    alice = Person("PRS1", "Alice", "", "Smith", "alice@example.com")
+    assert not diff_users([alice], [alice])